@@ -0,0 +1,449 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from app.config import (WHISPER_MODEL, SPEAKER_IDENTIFICATION_MODEL, GPT_4_MODEL, SUMMARY_PROMPT_TEMPLATE,
+                        SUMMARY_PARAMETERS, CHUNK_SUMMARY_PROMPT_TEMPLATE, MERGE_SUMMARY_PROMPT_TEMPLATE,
+                        CHUNK_SUMMARY_PARAMETERS, SUMMARY_CHUNK_TOKENS, CACHE_MAX_BYTES,
+                        RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_SIMILARITY,
+                        TRANSCRIPTION_WINDOW_SECONDS, TRANSCRIPTION_WINDOW_OVERLAP_SECONDS, SPEAKER_WINDOW_SECONDS,
+                        VAD_ENABLED, VAD_THRESHOLD_DB, VAD_MIN_SPEECH_SECONDS, VAD_MIN_SILENCE_SECONDS,
+                        VAD_PADDING_SECONDS, VAD_MAX_SEGMENT_SECONDS)
+from app.metrics import metrics
+from app.redaction import redaction_fingerprint
+from app.search import STOPWORDS, TOKEN_PATTERN
+from app.storage import StorageManager
+from app.utils import log_event
+
+VAD_PARAMETERS = ([VAD_THRESHOLD_DB, VAD_MIN_SPEECH_SECONDS, VAD_MIN_SILENCE_SECONDS, VAD_PADDING_SECONDS,
+                   VAD_MAX_SEGMENT_SECONDS] if VAD_ENABLED else None)
+
+# Everything besides the audio itself that determines a stage's output. Changing any of these
+# changes the cache key, so stale results are never served after a model or prompt change.
+STAGE_PARAMETERS = {
+    'transcription': {'model': WHISPER_MODEL, 'window_seconds': TRANSCRIPTION_WINDOW_SECONDS,
+                      'overlap_seconds': TRANSCRIPTION_WINDOW_OVERLAP_SECONDS, 'vad': VAD_PARAMETERS},
+    'embedding': {'model': SPEAKER_IDENTIFICATION_MODEL, 'window_seconds': SPEAKER_WINDOW_SECONDS,
+                  'vad': VAD_PARAMETERS},
+    # Recorded while embedding, for the memo metadata
+    'speech_segments': {'vad': VAD_PARAMETERS},
+    # Keyed by the transcript being summarized, which covers every transcription setting
+    'summary': {'model': GPT_4_MODEL,
+                'prompt': SUMMARY_PROMPT_TEMPLATE, 'parameters': SUMMARY_PARAMETERS,
+                'chunk_prompt': CHUNK_SUMMARY_PROMPT_TEMPLATE, 'merge_prompt': MERGE_SUMMARY_PROMPT_TEMPLATE,
+                'chunk_parameters': CHUNK_SUMMARY_PARAMETERS, 'chunk_tokens': SUMMARY_CHUNK_TOKENS},
+    # Keyed by the text being summarized, so unchanged parts of an edited transcript are reused
+    'chunk_summary': {'model': GPT_4_MODEL, 'prompt': CHUNK_SUMMARY_PROMPT_TEMPLATE,
+                      'parameters': CHUNK_SUMMARY_PARAMETERS},
+    'merge_summary': {'model': GPT_4_MODEL, 'prompt': MERGE_SUMMARY_PROMPT_TEMPLATE,
+                      'parameters': [CHUNK_SUMMARY_PARAMETERS, SUMMARY_PARAMETERS]},
+}
+
+# Stages whose input is redacted text: their keys also cover the redaction settings
+REDACTED_STAGES = ('summary',)
+
+INDEX_FILE_NAME = "index"
+# Puts between two saves of the pipeline cache index. Entries written after the last save are
+# found again on lookup, so a crash only loses their access times.
+INDEX_SAVE_EVERY = 32
+RESPONSE_CACHE_FILE_NAME = "responses"
+# Puts between two saves of the response cache; it is also saved by flush(), on close and at exit
+RESPONSE_CACHE_SAVE_EVERY = 16
+# Words that may differ between near-duplicate prompts. Negations change the meaning of a question,
+# so unlike in search they count as content words.
+FILLER_WORDS = STOPWORDS - {"no", "not", "nor", "never"}
+
+def hash_audio_file(audio_file_path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 of an audio file's bytes, reading it in chunks.
+
+    Parameters:
+    - audio_file_path: Path to the audio file.
+    - chunk_size: Number of bytes read at a time.
+
+    Returns:
+    - The hex digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(audio_file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class PipelineCache:
+    """
+    Content-addressed cache of per-memo stage results, stored encrypted through StorageManager.
+
+    Entries are keyed by the hash of the audio bytes plus the parameters of the stage that produced
+    them, so an unchanged memo is recognised no matter where it lives on disk. The total size of the
+    cache is bounded; least recently used entries are evicted first.
+
+    The pipeline's stage workers share one cache, so the index is only read and written under a lock.
+    It is saved every `save_every` puts and on flush(), rather than after each put.
+    """
+
+    def __init__(self, storage_manager=None, max_bytes=CACHE_MAX_BYTES, data_type="cache",
+                 save_every=INDEX_SAVE_EVERY):
+        """
+        Parameters:
+        - storage_manager: StorageManager used to persist entries. A new one is created if omitted.
+        - max_bytes: Maximum total size of cached values before eviction.
+        - data_type: StorageManager data type (sub-directory) holding the cache.
+        - save_every: Number of puts after which the index is saved.
+        """
+        self.storage_manager = storage_manager or StorageManager()
+        self.max_bytes = max_bytes
+        self.data_type = data_type
+        self.save_every = max(1, save_every)
+        self._unsaved_puts = 0
+        self.hits = {}
+        self.misses = {}
+        self._audio_hashes = {}
+        self._lock = threading.RLock()
+        self._index = self._load_index()
+
+    def _load_index(self):
+        if not self.storage_manager.exists(INDEX_FILE_NAME, self.data_type):
+            return {}
+        try:
+            return json.loads(self.storage_manager.load_data(INDEX_FILE_NAME, self.data_type))
+        except Exception as e:
+            log_event(f"Pipeline cache index unreadable, starting empty: {e}")
+            return {}
+
+    def _save_index(self):
+        self.storage_manager.save_data(json.dumps(self._index), INDEX_FILE_NAME, self.data_type)
+        self._unsaved_puts = 0
+
+    def audio_hash(self, audio_file_path):
+        """
+        Return the content hash of an audio file, hashing each version of a file at most once per process.
+        """
+        stat = os.stat(audio_file_path)
+        version = (audio_file_path, stat.st_mtime_ns, stat.st_size)
+        if version not in self._audio_hashes:
+            self._audio_hashes[version] = hash_audio_file(audio_file_path)
+        return self._audio_hashes[version]
+
+    def key(self, stage, audio_file_path):
+        """
+        Build the cache key for a stage's output on a given audio file.
+        """
+        return self._key(stage, self.audio_hash(audio_file_path))
+
+    def _key(self, stage, content_hash):
+        parameters = STAGE_PARAMETERS.get(stage, {})
+        fingerprint = redaction_fingerprint() if stage in REDACTED_STAGES else None
+        if fingerprint is not None:
+            parameters = dict(parameters, redaction=fingerprint)
+        parameters = json.dumps(parameters, sort_keys=True)
+        material = f"{stage}\0{content_hash}\0{parameters}"
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def get(self, stage, audio_file_path):
+        """
+        Look up a cached stage result.
+
+        Returns:
+        - The cached value, or None if there is no entry.
+        """
+        return self._get(stage, self.key(stage, audio_file_path))
+
+    def put(self, stage, audio_file_path, value):
+        """
+        Store a stage result. The value must be JSON serialisable.
+        """
+        self._put(stage, self.key(stage, audio_file_path), value)
+
+    def get_content(self, stage, content):
+        """
+        Look up a stage result keyed by the hash of a text input rather than an audio file.
+
+        Returns:
+        - The cached value, or None if there is no entry.
+        """
+        return self._get(stage, self._key(stage, hashlib.sha256(content.encode()).hexdigest()))
+
+    def put_content(self, stage, content, value):
+        """
+        Store a stage result keyed by the hash of a text input.
+        """
+        self._put(stage, self._key(stage, hashlib.sha256(content.encode()).hexdigest()), value)
+
+    def _miss(self, stage):
+        with self._lock:
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+        metrics.inc("cache_lookups_total", cache="pipeline", stage=stage, result="miss")
+
+    def _get(self, stage, key):
+        with self._lock:
+            present = key in self._index
+        # An entry put after the last index save, before a crash, is still on disk
+        if not present and not self.storage_manager.exists(key, self.data_type):
+            self._miss(stage)
+            return None
+        try:
+            payload = self.storage_manager.load_data(key, self.data_type)
+            value = json.loads(payload)
+        except Exception as e:
+            log_event(f"Dropping unreadable cache entry {key}: {e}")
+            with self._lock:
+                self._index.pop(key, None)
+                self.storage_manager.delete_data(key, self.data_type)
+            self._miss(stage)
+            return None
+        with self._lock:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            if present:
+                # The entry may have been evicted by another worker meanwhile
+                if key in self._index:
+                    self._index[key]['last_access'] = time.time()
+            else:
+                self._index[key] = {'stage': stage, 'size': len(payload), 'last_access': time.time()}
+                self._evict()
+        metrics.inc("cache_lookups_total", cache="pipeline", stage=stage, result="hit")
+        return value
+
+    def _put(self, stage, key, value):
+        payload = json.dumps(value)
+        self.storage_manager.save_data(payload, key, self.data_type)
+        with self._lock:
+            self._index[key] = {'stage': stage, 'size': len(payload), 'last_access': time.time()}
+            self._evict()
+            self._unsaved_puts += 1
+            if self._unsaved_puts >= self.save_every:
+                self._save_index()
+
+    def get_or_compute(self, stage, audio_file_path, compute):
+        """
+        Return the cached result of a stage, running compute() and caching its result on a miss.
+
+        Parameters:
+        - stage: Stage name (a key of STAGE_PARAMETERS).
+        - audio_file_path: Audio file the stage operates on.
+        - compute: Zero-argument callable producing the stage's JSON serialisable result.
+        """
+        value = self.get(stage, audio_file_path)
+        if value is None:
+            value = compute()
+            self.put(stage, audio_file_path, value)
+        return value
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._index.values())
+
+    def _evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['last_access']):
+            if total <= self.max_bytes:
+                break
+            self.storage_manager.delete_data(key, self.data_type)
+            total -= entry['size']
+            del self._index[key]
+        log_event(f"Pipeline cache evicted down to {total} bytes")
+
+    def flush(self):
+        """
+        Save the index, with the entries put and the access times recorded since the last save.
+        """
+        with self._lock:
+            self._save_index()
+
+    def stats(self):
+        """
+        Return hit and miss counters per stage along with the cache size.
+        """
+        with self._lock:
+            stages = sorted(set(self.hits) | set(self.misses))
+            return {
+                'stages': {stage: {'hits': self.hits.get(stage, 0), 'misses': self.misses.get(stage, 0)}
+                           for stage in stages},
+                'entries': len(self._index),
+                'bytes': self.total_bytes(),
+            }
+
+def normalize_prompt(prompt):
+    """
+    Normalise a prompt for cache lookups: lowercase, with whitespace collapsed and outer
+    punctuation stripped, so trivially different spellings of the same request share a key.
+    """
+    return " ".join(prompt.lower().split()).strip(" ?!.")
+
+class ResponseCache:
+    """
+    LRU cache of completion responses with a time-to-live, persisted encrypted through StorageManager.
+
+    Entries are keyed on the normalised prompt, the model and the completion parameters. Lookups can
+    optionally fall back to a near-duplicate match among entries with the same model, parameters and
+    context: a prompt with exactly the same content words (every word but filler words, with
+    negations, names and entity tokens all counting) is reused if the Jaccard similarity of all
+    their words reaches similarity_threshold. This lets a question rephrased with different filler
+    words over the same memo passages skip the API, while "when did I meet Bob" never gets the
+    answer about Alice, nor "did I not approve it" the answer to "did I approve it".
+
+    The cache is saved every `save_every` puts, on flush() and close(), and when the process exits.
+    """
+
+    def __init__(self, storage_manager=None, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, similarity_threshold=RESPONSE_CACHE_SIMILARITY,
+                 data_type="cache", file_name=RESPONSE_CACHE_FILE_NAME, save_every=RESPONSE_CACHE_SAVE_EVERY):
+        """
+        Parameters:
+        - storage_manager: StorageManager used to persist the cache. A new one is created if omitted.
+        - max_entries: Maximum number of responses kept; least recently used ones are evicted first.
+        - ttl_seconds: Age after which a response is no longer served.
+        - similarity_threshold: Minimum Jaccard similarity of all words for a near-duplicate hit (0 disables them).
+        - data_type: StorageManager data type (sub-directory) holding the cache.
+        - file_name: Name of the record the cache is persisted in.
+        - save_every: Number of puts after which the cache is saved.
+        """
+        self.storage_manager = storage_manager or StorageManager()
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.data_type = data_type
+        self.file_name = file_name
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.save_every = max(1, save_every)
+        self._unsaved_puts = 0
+        self._lock = threading.Lock()
+        # Serialises saves, which encrypt and write outside _lock so lookups are not held up
+        self._save_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self):
+        if not self.storage_manager.exists(self.file_name, self.data_type):
+            return
+        try:
+            entries = json.loads(self.storage_manager.load_data(self.file_name, self.data_type))
+        except Exception as e:
+            log_event(f"Response cache unreadable, starting empty: {e}")
+            return
+        for key, entry in entries:
+            self._entries[key] = entry
+
+    def _save(self):
+        with self._save_lock:
+            with self._lock:
+                if not self._unsaved_puts:
+                    return
+                entries = list(self._entries.items())
+                self._unsaved_puts = 0
+            self.storage_manager.save_data(json.dumps(entries), self.file_name, self.data_type)
+
+    def flush(self):
+        """
+        Save the responses put since the last save.
+        """
+        self._save()
+
+    def close(self):
+        self.flush()
+
+    @staticmethod
+    def _scope(model, parameters, context):
+        material = json.dumps([model, parameters, context], sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    @staticmethod
+    def _tokens(prompt):
+        return set(TOKEN_PATTERN.findall(prompt.lower()))
+
+    @staticmethod
+    def _content_words(tokens):
+        return set(tokens) - FILLER_WORDS
+
+    def _expired(self, entry, now):
+        return now - entry['created'] > self.ttl_seconds
+
+    def get(self, prompt, model, parameters, context="", near_duplicates=False):
+        """
+        Look up a cached response.
+
+        Parameters:
+        - prompt: The prompt, or the varying part of it (e.g. the user's question).
+        - model: The completion model.
+        - parameters: The completion parameters.
+        - context: Any other input the response depends on (e.g. the retrieved passages).
+        - near_duplicates: Also accept a similar prompt with the same model, parameters and context.
+
+        Returns:
+        - The cached response, or None.
+        """
+        scope = self._scope(model, parameters, context)
+        key = hashlib.sha256(f"{scope}\0{normalize_prompt(prompt)}".encode()).hexdigest()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc("cache_lookups_total", cache="response", result="hit")
+                return entry['value']
+
+            if near_duplicates and self.similarity_threshold > 0:
+                tokens = self._tokens(prompt)
+                content_words = self._content_words(tokens)
+                best_key, best_similarity = None, 0.0
+                for candidate_key, candidate in self._entries.items():
+                    # Entries from before content words were compared carry no 'tokens' and are not matched
+                    if (candidate['scope'] != scope or self._expired(candidate, now) or 'tokens' not in candidate
+                            or self._content_words(candidate['tokens']) != content_words):
+                        continue
+                    candidate_tokens = set(candidate['tokens'])
+                    similarity = len(tokens & candidate_tokens) / max(1, len(tokens | candidate_tokens))
+                    if similarity > best_similarity:
+                        best_key, best_similarity = candidate_key, similarity
+                if best_key is not None and best_similarity >= self.similarity_threshold:
+                    self._entries.move_to_end(best_key)
+                    self.near_hits += 1
+                    metrics.inc("cache_lookups_total", cache="response", result="near_hit")
+                    return self._entries[best_key]['value']
+
+            self.misses += 1
+            metrics.inc("cache_lookups_total", cache="response", result="miss")
+            return None
+
+    def put(self, prompt, model, parameters, value, context=""):
+        """
+        Store a response. Arguments match get().
+        """
+        scope = self._scope(model, parameters, context)
+        key = hashlib.sha256(f"{scope}\0{normalize_prompt(prompt)}".encode()).hexdigest()
+        with self._lock:
+            self._entries[key] = {'scope': scope, 'tokens': sorted(self._tokens(prompt)),
+                                  'value': value, 'created': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._unsaved_puts += 1
+            due = self._unsaved_puts >= self.save_every
+        if due:
+            self._save()
+
+    def stats(self):
+        """
+        Return hit, near-duplicate hit and miss counters, the overall hit rate and the number of entries.
+        """
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
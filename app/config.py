@@ -3,29 +3,170 @@ import os
 # iCloud Access Configuration
 ICLOUD_USERNAME = os.getenv('ICLOUD_USERNAME', 'default_username')
 ICLOUD_PASSWORD = os.getenv('ICLOUD_PASSWORD', 'default_password')
-ICLOUD_API_URL = 'https://api.icloud.com/'
+ICLOUD_API_URL = os.getenv('ICLOUD_API_URL', 'https://api.icloud.com/')
+# Number of voice memos downloaded in parallel (also the size of the HTTP connection pool)
+IMPORT_CONCURRENCY = int(os.getenv('IMPORT_CONCURRENCY', '8'))
+# Retries for 429 and 5xx responses, with exponential backoff starting at IMPORT_BACKOFF_FACTOR seconds
+IMPORT_MAX_RETRIES = int(os.getenv('IMPORT_MAX_RETRIES', '5'))
+IMPORT_BACKOFF_FACTOR = float(os.getenv('IMPORT_BACKOFF_FACTOR', '0.5'))
+# (connect, read) timeouts in seconds for iCloud requests
+IMPORT_TIMEOUT = (5, 60)
+# Watch mode: iCloud is polled for new or changed memos every WATCH_INTERVAL_SECONDS. Audio files dropped
+# into WATCH_DIRECTORY (if set) are picked up once they have not changed for WATCH_SETTLE_SECONDS, so
+# files still being copied are not processed half-written and a burst of changes is handled once.
+WATCH_INTERVAL_SECONDS = float(os.getenv('WATCH_INTERVAL_SECONDS', '60'))
+WATCH_DIRECTORY = os.getenv('WATCH_DIRECTORY')
+WATCH_SETTLE_SECONDS = float(os.getenv('WATCH_SETTLE_SECONDS', '2'))
+WATCH_SCAN_SECONDS = float(os.getenv('WATCH_SCAN_SECONDS', '1'))
 
 # Whisper Model Configuration
 WHISPER_MODEL = 'whisper-large-v3'
+# Number of worker processes, each holding its own loaded Whisper model
+TRANSCRIPTION_WORKERS = int(os.getenv('TRANSCRIPTION_WORKERS', '2'))
+# Maximum number of batches queued or running at once; bounds memory when feeding a large backlog
+TRANSCRIPTION_QUEUE_SIZE = int(os.getenv('TRANSCRIPTION_QUEUE_SIZE', '8'))
+# Short clips are grouped into batches of up to this many seconds of audio (0 disables batching)
+TRANSCRIPTION_BATCH_SECONDS = float(os.getenv('TRANSCRIPTION_BATCH_SECONDS', '120'))
+# Recordings are decoded incrementally and transcribed in windows of this length (Whisper's own
+# context is 30 seconds). Consecutive windows overlap so words cut at a boundary are heard whole;
+# each segment in the overlap is kept from the window it is more central to.
+TRANSCRIPTION_WINDOW_SECONDS = float(os.getenv('TRANSCRIPTION_WINDOW_SECONDS', '30'))
+TRANSCRIPTION_WINDOW_OVERLAP_SECONDS = float(os.getenv('TRANSCRIPTION_WINDOW_OVERLAP_SECONDS', '4'))
+
+# Voice activity detection: only speech is transcribed and embedded. A frame is speech if it is
+# VAD_THRESHOLD_DB louder than the recording's noise floor; pauses shorter than VAD_MIN_SILENCE_SECONDS
+# do not split a segment, sounds shorter than VAD_MIN_SPEECH_SECONDS are ignored, and segments are
+# padded by VAD_PADDING_SECONDS and split once they reach VAD_MAX_SEGMENT_SECONDS.
+VAD_ENABLED = os.getenv('VAD_ENABLED', 'true').lower() == 'true'
+VAD_THRESHOLD_DB = float(os.getenv('VAD_THRESHOLD_DB', '12'))
+VAD_MIN_SPEECH_SECONDS = float(os.getenv('VAD_MIN_SPEECH_SECONDS', '0.25'))
+VAD_MIN_SILENCE_SECONDS = float(os.getenv('VAD_MIN_SILENCE_SECONDS', '0.6'))
+VAD_PADDING_SECONDS = float(os.getenv('VAD_PADDING_SECONDS', '0.2'))
+VAD_MAX_SEGMENT_SECONDS = float(os.getenv('VAD_MAX_SEGMENT_SECONDS', '30'))
 
 # GPT-4 Configuration
 GPT_4_API_KEY = os.getenv('GPT_4_API_KEY', 'default_api_key')
 GPT_4_MODEL = 'gpt-4'
+# Optional override of the completion API endpoint (e.g. a local fake server for testing)
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE')
+# Summaries requested in parallel, and the account's rate limits they are throttled to
+SUMMARY_CONCURRENCY = int(os.getenv('SUMMARY_CONCURRENCY', '8'))
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', '40000'))
+SUMMARY_MAX_RETRIES = int(os.getenv('SUMMARY_MAX_RETRIES', '5'))
+SUMMARY_PROMPT_TEMPLATE = "Summarize the following voice memo:\n{transcription}"
+SUMMARY_PARAMETERS = {
+    'temperature': 0.5,
+    'max_tokens': 1000,
+    'top_p': 1.0,
+    'frequency_penalty': 0.0,
+    'presence_penalty': 0.0,
+}
+# Transcripts longer than SUMMARY_CHUNK_TOKENS are summarized map-reduce style: chunks are summarized
+# separately, then the partial summaries are merged level by level until one remains.
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '3000'))
+CHUNK_SUMMARY_PROMPT_TEMPLATE = "Summarize this part of a longer voice memo:\n{transcription}"
+MERGE_SUMMARY_PROMPT_TEMPLATE = ("Combine these summaries of consecutive parts of one voice memo into a single "
+                                 "concise summary:\n{summaries}")
+CHUNK_SUMMARY_PARAMETERS = dict(SUMMARY_PARAMETERS, max_tokens=300)
+ANSWER_PROMPT_TEMPLATE = ("Answer the question using only the following excerpts from the user's voice memos.\n\n"
+                          "{context}\n\nQuestion: {question}\nAnswer:")
+ANSWER_PARAMETERS = {
+    'temperature': 0.2,
+    'max_tokens': 500,
+}
 
 # Storage Configuration
 STORAGE_PATH = './data/'
+AUDIO_STORAGE_PATH = os.path.join(STORAGE_PATH, 'audio')
+DATABASE_PATH = os.path.join(STORAGE_PATH, 'memos.db')
+SEARCH_INDEX_PATH = os.path.join(STORAGE_PATH, 'search_index')
+# Number of memos retrieved to answer a query
+SEARCH_TOP_K = int(os.getenv('SEARCH_TOP_K', '5'))
+VECTOR_STORE_PATH = os.path.join(STORAGE_PATH, 'vectors')
+# Local embedding model for semantic retrieval: 'hashing' (no dependencies) or a sentence-transformers model name
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'hashing')
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY', 'default_encryption_key')
+# During a key rotation, the keys data may still be encrypted with (comma-separated, newest first).
+# Remove them once `python -m app.key_rotation` has finished.
+ENCRYPTION_PREVIOUS_KEYS = [key for key in os.getenv('ENCRYPTION_PREVIOUS_KEYS', '').split(',') if key]
+# Threads for bulk encryption and decryption, and for re-encrypting records during a key rotation
+CRYPTO_WORKERS = int(os.getenv('CRYPTO_WORKERS', str(os.cpu_count() or 4)))
+KEY_ROTATION_STATE_PATH = os.path.join(STORAGE_PATH, 'key_rotation.json')
+# Upper bound on the size of the pipeline cache before least recently used entries are evicted
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+# Cache of GPT-4 summaries and answers: size, lifetime, and the word overlap (0-1) above which a
+# rephrased question with the same content words reuses a cached answer. Near-duplicate reuse is
+# off (0) by default; 0.8 lets questions that differ only in filler words share an answer.
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0'))
+
+# Metrics are written in the Prometheus text format to METRICS_PATH every METRICS_INTERVAL_SECONDS,
+# and served at http://127.0.0.1:METRICS_PORT/metrics if METRICS_PORT is set
+METRICS_NAMESPACE = 'voice_memo'
+METRICS_PATH = os.getenv('METRICS_PATH', os.path.join(STORAGE_PATH, 'metrics.prom'))
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0')) or None
+METRICS_INTERVAL_SECONDS = float(os.getenv('METRICS_INTERVAL_SECONDS', '15'))
 
 # User Interaction Configuration
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', 'default_bot_token')
 SMS_API_KEY = os.getenv('SMS_API_KEY', 'default_sms_api_key')
+# Queries are answered by QUERY_CONCURRENCY workers, in order within each chat. A query not answered
+# within QUERY_ACK_SECONDS gets a "working on it" reply that is edited into the answer, and one not
+# answered within QUERY_DEADLINE_SECONDS is given up on. Beyond QUERY_MAX_PENDING waiting queries,
+# new ones are turned away until the backlog clears.
+QUERY_CONCURRENCY = int(os.getenv('QUERY_CONCURRENCY', '8'))
+QUERY_MAX_PENDING = int(os.getenv('QUERY_MAX_PENDING', '200'))
+QUERY_ACK_SECONDS = float(os.getenv('QUERY_ACK_SECONDS', '2'))
+QUERY_DEADLINE_SECONDS = float(os.getenv('QUERY_DEADLINE_SECONDS', '60'))
+# Telegram updates are long-polled for up to TELEGRAM_LONG_POLL_SECONDS per request, unless
+# TELEGRAM_WEBHOOK_URL is set: then Telegram pushes them to a local HTTP server on
+# TELEGRAM_WEBHOOK_LISTEN:TELEGRAM_WEBHOOK_PORT, which the HTTPS webhook URL must forward to.
+TELEGRAM_LONG_POLL_SECONDS = int(os.getenv('TELEGRAM_LONG_POLL_SECONDS', '25'))
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_LISTEN = os.getenv('TELEGRAM_WEBHOOK_LISTEN', '127.0.0.1')
+TELEGRAM_WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', '8443'))
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+# Voice notes sent to the bot are transcribed in the bot process, with a Whisper model loaded when the
+# bot starts, and the reply is edited at most every VOICE_NOTE_EDIT_SECONDS as segments finish. Voice
+# notes longer than VOICE_NOTE_MAX_SECONDS are turned away, as they are transcribed one at a time.
+VOICE_NOTES_ENABLED = os.getenv('VOICE_NOTES_ENABLED', 'true').lower() == 'true'
+VOICE_NOTE_EDIT_SECONDS = float(os.getenv('VOICE_NOTE_EDIT_SECONDS', '1.5'))
+VOICE_NOTE_MAX_SECONDS = float(os.getenv('VOICE_NOTE_MAX_SECONDS', '600'))
 
 # Privacy Configuration
 ANONYMIZATION_SALT = os.getenv('ANONYMIZATION_SALT', 'default_salt')
+# Transcripts are redacted before they are stored, indexed or summarized: phone numbers, email addresses,
+# street addresses and the names listed in REDACTION_TERMS_PATH (one per line, optionally prefixed
+# with a category, e.g. 'ORG: Acme Corp') are replaced with salted tokens, the same for every mention.
+# Bulk redaction runs on REDACTION_WORKERS processes.
+REDACTION_ENABLED = os.getenv('REDACTION_ENABLED', 'true').lower() == 'true'
+REDACTION_TERMS_PATH = os.getenv('REDACTION_TERMS_PATH', os.path.join(STORAGE_PATH, 'redaction_terms.txt'))
+REDACTION_WORKERS = int(os.getenv('REDACTION_WORKERS', str(os.cpu_count() or 4)))
 
 # Metadata Extraction Configuration
 # Using SpeechBrain's pre-trained ECAPA-TDNN model for speaker recognition
 SPEAKER_IDENTIFICATION_MODEL = 'speechbrain/spkrec-ecapa-voxceleb'
+# The ECAPA model is trained on 16 kHz audio; clips are resampled to this rate before embedding
+SPEAKER_SAMPLE_RATE = 16000
+# Windows per encode_batch call, and the cap on audio per batch in seconds
+SPEAKER_EMBEDDING_BATCH_SIZE = int(os.getenv('SPEAKER_EMBEDDING_BATCH_SIZE', '16'))
+SPEAKER_EMBEDDING_MAX_BATCH_SECONDS = float(os.getenv('SPEAKER_EMBEDDING_MAX_BATCH_SECONDS', '600'))
+# Threads decoding and resampling audio ahead of the model
+SPEAKER_EMBEDDING_WORKERS = int(os.getenv('SPEAKER_EMBEDDING_WORKERS', '4'))
+# Recordings are embedded per window of this many seconds, giving one speaker embedding per segment
+SPEAKER_WINDOW_SECONDS = float(os.getenv('SPEAKER_WINDOW_SECONDS', '3'))
+SPEAKER_INDEX_PATH = os.path.join(STORAGE_PATH, 'speakers')
+# Minimum cosine similarity between a segment's ECAPA embedding and a speaker centroid for the
+# segment to be attributed to that speaker; lower values merge more voices into one speaker
+SPEAKER_SIMILARITY_THRESHOLD = float(os.getenv('SPEAKER_SIMILARITY_THRESHOLD', '0.5'))
+
+# Pipeline orchestration: stages that are cheaper in bulk take whatever memos are waiting, up to these
+# batch sizes, so batches grow with the backlog while a single new memo is processed right away
+PIPELINE_EMBEDDING_BATCH_SIZE = int(os.getenv('PIPELINE_EMBEDDING_BATCH_SIZE', '8'))
+PIPELINE_INDEX_BATCH_SIZE = int(os.getenv('PIPELINE_INDEX_BATCH_SIZE', '32'))
+PIPELINE_METADATA_WORKERS = int(os.getenv('PIPELINE_METADATA_WORKERS', '2'))
 
 # Ensure all sensitive information is kept secure and not hardcoded in production environments.
 # Consider using environment variables or secure vaults for storing sensitive configuration in a real-world scenario.
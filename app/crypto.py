@@ -0,0 +1,251 @@
+import base64
+import functools
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from app.config import ENCRYPTION_KEY, ENCRYPTION_PREVIOUS_KEYS, CRYPTO_WORKERS
+
+# Bulk operations hand each worker batches of about this many bytes, so small items do not pay a
+# task per item, and run inline below it
+BULK_BATCH_BYTES = 1024 * 1024
+
+@functools.lru_cache(maxsize=None)
+def derive_stream_key(encryption_key, info=b"voice-memo-storage-stream-v1"):
+    """
+    Derive an AES-256-GCM key from the Fernet ENCRYPTION_KEY. Different uses pass a different
+    info string so they never share a key.
+    """
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=info).derive(base64.urlsafe_b64decode(encryption_key))
+
+@functools.lru_cache(maxsize=None)
+def aes_gcm(key):
+    """
+    Return the AESGCM cipher for a raw key, created once per key.
+    """
+    return AESGCM(key)
+
+@functools.lru_cache(maxsize=None)
+def fernet_for(encryption_key):
+    """
+    Return the Fernet cipher for a key, created once per key.
+    """
+    return Fernet(encryption_key)
+
+def key_fingerprint(encryption_key):
+    """
+    Short identifier of a key that reveals nothing about it, for logs and rotation state.
+    """
+    return hashlib.sha256(derive_stream_key(encryption_key, info=b"voice-memo-key-fingerprint-v1")).hexdigest()[:16]
+
+class KeyRing:
+    """
+    AEAD cipher with the AESGCM interface that encrypts with the current key and decrypts with the
+    current key or, failing that, any previous one. Data written before a key rotation therefore
+    stays readable until it has been re-encrypted.
+    """
+
+    def __init__(self, ciphers):
+        self.ciphers = tuple(ciphers)
+        self.current = self.ciphers[0]
+
+    def encrypt(self, nonce, data, associated_data):
+        return self.current.encrypt(nonce, data, associated_data)
+
+    def decrypt(self, nonce, data, associated_data):
+        for cipher in self.ciphers[:-1]:
+            try:
+                return cipher.decrypt(nonce, data, associated_data)
+            except InvalidTag:
+                pass
+        return self.ciphers[-1].decrypt(nonce, data, associated_data)
+
+    def is_current(self, nonce, data, associated_data):
+        """
+        Check whether data was encrypted with the current key.
+        """
+        try:
+            self.current.decrypt(nonce, data, associated_data)
+            return True
+        except InvalidTag:
+            return False
+
+class CryptoService:
+    """
+    The one place keys are loaded and ciphers are built.
+
+    Keys are parsed on first use and every cipher is created once and reused: Fernet for the
+    token format of privacy and utils, and AES-GCM keys derived per use (storage streams, the
+    database, the indexes) for everything else. While keys are being rotated, ENCRYPTION_KEY is
+    the new key and ENCRYPTION_PREVIOUS_KEYS lists the old ones; data is always written with the
+    new key and read with whichever key it was written with.
+
+    The bulk APIs encrypt or decrypt many items on a thread pool, in batches, preserving order.
+    The ciphers run in OpenSSL, so batches of large items proceed in parallel.
+    """
+
+    def __init__(self, encryption_key=ENCRYPTION_KEY, previous_keys=ENCRYPTION_PREVIOUS_KEYS, workers=CRYPTO_WORKERS):
+        """
+        Parameters:
+        - encryption_key: Fernet key new data is encrypted with.
+        - previous_keys: Fernet keys data may still be encrypted with, newest first.
+        - workers: Threads used by the bulk APIs.
+        """
+        self.encryption_key = encryption_key
+        self.previous_keys = [key for key in previous_keys if key and key != encryption_key]
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._key_rings = {}
+        self._fernet = None
+        self._pool = None
+
+    @property
+    def keys(self):
+        return [self.encryption_key] + self.previous_keys
+
+    def fernet(self):
+        """
+        Return the Fernet cipher encrypting with the current key and decrypting with any key.
+        """
+        if self._fernet is None:
+            self._fernet = MultiFernet([fernet_for(key) for key in self.keys])
+        return self._fernet
+
+    def stream_key(self, info=b"voice-memo-storage-stream-v1", encryption_key=None):
+        """
+        Return the AES-256 key derived for a use from a key (by default the current one).
+        """
+        return derive_stream_key(encryption_key or self.encryption_key, info)
+
+    def aead(self, info, encryption_key=None):
+        """
+        Return the AES-GCM cipher for a use.
+
+        Parameters:
+        - info: The use's key derivation info string.
+        - encryption_key: Fernet key to derive from. Defaults to the current key, in which case the
+          returned KeyRing also decrypts data written with the previous keys.
+        """
+        if encryption_key is not None and encryption_key != self.encryption_key:
+            return aes_gcm(derive_stream_key(encryption_key, info))
+        key_ring = self._key_rings.get(info)
+        if key_ring is None:
+            with self._lock:
+                key_ring = self._key_rings.setdefault(
+                    info, KeyRing([aes_gcm(derive_stream_key(key, info)) for key in self.keys]))
+        return key_ring
+
+    # Fernet tokens
+
+    def encrypt(self, data):
+        """
+        Encrypt a string or bytes into a Fernet token with the current key.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        return self.fernet().encrypt(data)
+
+    def decrypt(self, token):
+        """
+        Decrypt a Fernet token written with the current or a previous key.
+        """
+        return self.fernet().decrypt(token)
+
+    def encrypt_many(self, items):
+        """
+        Encrypt many strings or bytes into Fernet tokens in parallel. Returns the tokens in order.
+        """
+        return self._map(self.encrypt, items)
+
+    def decrypt_many(self, tokens):
+        """
+        Decrypt many Fernet tokens in parallel. Returns the plaintexts in order; raises InvalidToken
+        if any token cannot be decrypted.
+        """
+        return self._map(self.decrypt, tokens)
+
+    # AES-GCM records: a random 12-byte nonce followed by the ciphertext
+
+    def seal(self, data, info, associated_data=None):
+        """
+        Encrypt bytes with the AES-GCM key derived for `info`, bound to `associated_data`.
+        """
+        nonce = os.urandom(12)
+        return nonce + self.aead(info).encrypt(nonce, data, associated_data)
+
+    def open(self, payload, info, associated_data=None):
+        """
+        Decrypt a record written by seal(). Raises InvalidTag if it was tampered with.
+        """
+        return self.aead(info).decrypt(bytes(payload[:12]), bytes(payload[12:]), associated_data)
+
+    def seal_many(self, items, info, associated_data=None):
+        """
+        Encrypt many byte strings in parallel. `associated_data` is None or one value per item.
+        """
+        associated = associated_data if associated_data is not None else [None] * len(items)
+        return self._map(lambda pair: self.seal(pair[0], info, pair[1]), list(zip(items, associated)))
+
+    def open_many(self, payloads, info, associated_data=None):
+        """
+        Decrypt many records written by seal() or seal_many() in parallel.
+        """
+        associated = associated_data if associated_data is not None else [None] * len(payloads)
+        return self._map(lambda pair: self.open(pair[0], info, pair[1]), list(zip(payloads, associated)))
+
+    def map(self, function, items):
+        """
+        Apply a function to every item on the crypto thread pool, e.g. to re-encrypt many files.
+        Returns the results in order.
+        """
+        items = list(items)
+        if self.workers == 1 or len(items) < 2:
+            return [function(item) for item in items]
+        return list(self._executor().map(function, items))
+
+    def _map(self, function, items):
+        items = list(items)
+        total = sum(len(item[0] if isinstance(item, tuple) else item) for item in items)
+        if self.workers == 1 or total < BULK_BATCH_BYTES or len(items) < 2:
+            return [function(item) for item in items]
+        # Contiguous batches of roughly equal size, at least a few per worker to even out stragglers
+        batch_bytes = max(BULK_BATCH_BYTES, total // (self.workers * 4))
+        batches, batch, size = [], [], 0
+        for item in items:
+            batch.append(item)
+            size += len(item[0] if isinstance(item, tuple) else item)
+            if size >= batch_bytes:
+                batches.append(batch)
+                batch, size = [], 0
+        if batch:
+            batches.append(batch)
+        results = []
+        for batch_results in self._executor().map(lambda batch: [function(item) for item in batch], batches):
+            results.extend(batch_results)
+        return results
+
+    def _executor(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="crypto")
+        return self._pool
+
+    def close(self):
+        """
+        Stop the bulk worker threads. The service stays usable; they are restarted on demand.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+# Process-wide service, configured from ENCRYPTION_KEY and ENCRYPTION_PREVIOUS_KEYS
+crypto = CryptoService()
+
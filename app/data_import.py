@@ -1,6 +1,49 @@
+import os
+import json
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-from utils import log_event, check_and_create_directory, save_json_file, load_encryption_key, encrypt_data
-from config import ICLOUD_USERNAME, ICLOUD_PASSWORD, ICLOUD_API_URL, STORAGE_PATH, ENCRYPTION_KEY
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.utils import log_event, check_and_create_directory, save_json_file, load_encryption_key, encrypt_data
+from app.config import (ICLOUD_USERNAME, ICLOUD_PASSWORD, ICLOUD_API_URL, STORAGE_PATH, AUDIO_STORAGE_PATH, ENCRYPTION_KEY,
+                    IMPORT_CONCURRENCY, IMPORT_MAX_RETRIES, IMPORT_BACKOFF_FACTOR, IMPORT_TIMEOUT)
+from app.storage import StorageManager
+from app.metrics import metrics
+from app.registry import registry
+
+# Memo records are named after sanitized memo IDs, which never contain a dot, so no memo can
+# overwrite the manifest. Manifests saved before were named "manifest".
+MANIFEST_FILE_NAME = "import.manifest"
+LEGACY_MANIFEST_FILE_NAME = "manifest"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# The import manifest is saved after this many imported memos or this many seconds, whichever comes
+# first, and at the end of the import
+MANIFEST_SAVE_EVERY = 64
+MANIFEST_SAVE_SECONDS = 5.0
+
+def create_http_session(pool_size=IMPORT_CONCURRENCY, max_retries=IMPORT_MAX_RETRIES,
+                        backoff_factor=IMPORT_BACKOFF_FACTOR):
+    """
+    Create a requests session with a connection pool sized for concurrent downloads and
+    automatic retries with exponential backoff on 429 and 5xx responses.
+    """
+    retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset({"GET", "POST"}), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+registry.register("http_session", create_http_session)
+
+def get_http_session():
+    """
+    Return the shared iCloud HTTP session, creating it on first use.
+    """
+    return registry.get("http_session")
 
 def authenticate_icloud(username, password):
     """
@@ -8,7 +51,8 @@ def authenticate_icloud(username, password):
     This is a simplified example and might not reflect the actual iCloud API.
     """
     auth_url = f"{ICLOUD_API_URL}auth"
-    response = requests.post(auth_url, json={"username": username, "password": password})
+    response = get_http_session().post(auth_url, json={"username": username, "password": password},
+                                       timeout=IMPORT_TIMEOUT)
     if response.status_code == 200:
         return response.json().get("token")
     else:
@@ -22,7 +66,7 @@ def fetch_voice_memos(session_token):
     """
     voice_memos_url = f"{ICLOUD_API_URL}voice_memos"
     headers = {"Authorization": f"Bearer {session_token}"}
-    response = requests.get(voice_memos_url, headers=headers)
+    response = get_http_session().get(voice_memos_url, headers=headers, timeout=IMPORT_TIMEOUT)
     if response.status_code == 200:
         return response.json().get("voice_memos", [])
     else:
@@ -38,13 +82,217 @@ def save_voice_memos(voice_memos):
     save_json_file(encrypted_voice_memos, f"{STORAGE_PATH}voice_memos_encrypted.json")
     log_event("Voice memos saved and encrypted successfully.")
 
-def import_voice_memos():
+def load_manifest(storage_manager):
+    """
+    Load the local import manifest, mapping memo IDs to the version last imported.
+    """
+    for file_name in (MANIFEST_FILE_NAME, LEGACY_MANIFEST_FILE_NAME):
+        if storage_manager.exists(file_name, "voice_memos"):
+            manifest = json.loads(storage_manager.load_data(file_name, "voice_memos"))
+            # The legacy name may hold the record of a memo whose ID was "manifest"
+            if "id" not in manifest:
+                return manifest
+    return {}
+
+def save_manifest(manifest, storage_manager):
+    """
+    Save the local import manifest, encrypted.
+    """
+    storage_manager.save_data(json.dumps(manifest), MANIFEST_FILE_NAME, "voice_memos")
+
+def memo_version(memo):
+    """
+    Extract the fields used to decide whether a memo changed since the last import.
+    """
+    return {"modified": memo.get("modified"), "size": memo.get("size"), "etag": memo.get("etag")}
+
+def detect_changed_memos(voice_memos, manifest):
+    """
+    Compare the remote memo list with the manifest.
+
+    Parameters:
+    - voice_memos: The memo list returned by fetch_voice_memos.
+    - manifest: The local manifest.
+
+    Returns:
+    - A tuple (changed, removed_ids) with the new or modified memos and the IDs no longer present remotely.
+    """
+    changed = [memo for memo in voice_memos if manifest.get(str(memo["id"])) != memo_version(memo)]
+    remote_ids = {str(memo["id"]) for memo in voice_memos}
+    removed_ids = [memo_id for memo_id in manifest if memo_id not in remote_ids]
+    return changed, removed_ids
+
+def memo_file_name(memo):
+    """
+    Return the name a memo's record and audio file are stored under: its ID reduced to letters,
+    digits, '-' and '_', so that an ID such as '../x' cannot leave the storage directory. IDs that
+    had to be changed get a hash of the original ID appended, so two IDs never share a name.
+    """
+    memo_id = str(memo["id"])
+    name = "".join(c if c.isalnum() or c in "-_" else "_" for c in memo_id)
+    if name != memo_id or not name:
+        name += "-" + hashlib.sha256(memo_id.encode()).hexdigest()[:12]
+    return name
+
+def audio_file_path_for(memo, audio_dir=AUDIO_STORAGE_PATH):
+    """
+    Return the local path a memo's audio is downloaded to.
+    """
+    return os.path.join(audio_dir, memo_file_name(memo) + memo.get("extension", ".m4a"))
+
+def download_voice_memo(session_token, memo, audio_dir=AUDIO_STORAGE_PATH):
+    """
+    Download a memo's audio, resuming a previous partial download when possible.
+
+    The body is streamed to a '.part' file that is renamed into place once complete. If a '.part'
+    file is already present, only the missing byte range is requested; the server's ETag guards
+    against stitching together two different versions of the recording, so a '.part' file is only
+    resumed for memos that have one. A '.part' file that already holds the whole memo, left by an
+    import stopped just before the rename, is renamed into place without a request.
+
+    Parameters:
+    - session_token: The iCloud session token.
+    - memo: A memo entry from fetch_voice_memos.
+    - audio_dir: Directory the audio is saved to.
+
+    Returns:
+    - The path of the downloaded audio file.
+    """
+    check_and_create_directory(audio_dir)
+    file_path = audio_file_path_for(memo, audio_dir)
+    part_path = file_path + ".part"
+    url = f"{ICLOUD_API_URL}voice_memos/{memo['id']}/audio"
+    headers = {"Authorization": f"Bearer {session_token}"}
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and not memo.get("etag"):
+        # Without a validator the part may come from an earlier version of the memo
+        os.remove(part_path)
+        offset = 0
+    if offset and offset == memo.get("size"):
+        os.replace(part_path, file_path)
+        return file_path
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = memo["etag"]
+
+    with metrics.timer("import_download_seconds"), \
+            get_http_session().get(url, headers=headers, stream=True, timeout=IMPORT_TIMEOUT) as response:
+        if response.status_code == 416 and offset:
+            # Nothing left to send: the part is complete, unless the recording is now shorter
+            if memo.get("size") is None:
+                os.replace(part_path, file_path)
+                return file_path
+            os.remove(part_path)
+            log_event(f"Discarding a partial download of voice memo {memo['id']} longer than the memo")
+            raise RuntimeError(f"Download of voice memo {memo['id']} must restart. See event log for details.")
+        if response.status_code == 206:
+            mode = "ab"
+        elif response.status_code == 200:
+            # Full body: either a fresh download or the server ignored/rejected the range.
+            mode, offset = "wb", 0
+        else:
+            log_event(f"Failed to download voice memo {memo['id']}. Status Code: {response.status_code}")
+            raise RuntimeError(f"Download failed for voice memo {memo['id']}. See event log for details.")
+        with open(part_path, mode) as file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                metrics.inc("import_downloaded_bytes_total", len(chunk))
+
+    if memo.get("size") is not None and os.path.getsize(part_path) != memo["size"]:
+        log_event(f"Incomplete download for voice memo {memo['id']}, will resume on next import")
+        raise RuntimeError(f"Download incomplete for voice memo {memo['id']}. See event log for details.")
+    os.replace(part_path, file_path)
+    return file_path
+
+def download_voice_memos(session_token, voice_memos, max_workers=IMPORT_CONCURRENCY, audio_dir=AUDIO_STORAGE_PATH):
+    """
+    Download many memos concurrently over the shared connection pool.
+
+    Parameters:
+    - session_token: The iCloud session token.
+    - voice_memos: The memo entries to download.
+    - max_workers: Maximum number of downloads in flight.
+    - audio_dir: Directory the audio is saved to.
+
+    Returns:
+    - A generator of (memo, file_path, error) tuples in completion order. file_path is None and
+      error holds the message when a download failed.
+    """
+    check_and_create_directory(audio_dir)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(download_voice_memo, session_token, memo, audio_dir): memo for memo in voice_memos}
+        for future in as_completed(futures):
+            memo = futures[future]
+            try:
+                yield memo, future.result(), None
+            except Exception as e:
+                yield memo, None, str(e)
+
+def import_voice_memos_incrementally(session_token, storage_manager=None, on_downloaded=None):
+    """
+    Import only the memos that are new or changed since the last import.
+
+    Each memo record is stored as its own encrypted object. The manifest is saved every
+    MANIFEST_SAVE_EVERY memos or MANIFEST_SAVE_SECONDS, and when the import ends or fails, so an
+    interrupted import picks up where it stopped; after a crash, at most the memos imported since
+    the last save are downloaded again. Memos deleted from iCloud are dropped from the manifest, but
+    their local record, audio and processing results are kept.
+
+    Parameters:
+    - session_token: The iCloud session token.
+    - storage_manager: Optional StorageManager used for the manifest and memo records.
+    - on_downloaded: Optional callable invoked with each audio file path as soon as its download
+      completes, so processing can start while the remaining memos are still downloading.
+
+    Returns:
+    - A list of the audio file paths that were downloaded.
+    """
+    storage_manager = storage_manager or StorageManager()
+    manifest = load_manifest(storage_manager)
+    voice_memos = fetch_voice_memos(session_token)
+    changed, removed_ids = detect_changed_memos(voice_memos, manifest)
+    log_event(f"{len(changed)} new or changed voice memos out of {len(voice_memos)}; "
+              f"{len(removed_ids)} no longer in iCloud")
+    for memo_id in removed_ids:
+        del manifest[memo_id]
+    unsaved, last_save = len(removed_ids), time.monotonic()
+
+    downloaded = []
+    try:
+        for memo, file_path, error in download_voice_memos(session_token, changed):
+            if error is not None:
+                log_event(f"Skipping voice memo {memo['id']}: {error}")
+                continue
+            downloaded.append(file_path)
+            storage_manager.save_data(json.dumps(memo), memo_file_name(memo), "voice_memos")
+            manifest[str(memo["id"])] = memo_version(memo)
+            unsaved += 1
+            if unsaved >= MANIFEST_SAVE_EVERY or time.monotonic() - last_save >= MANIFEST_SAVE_SECONDS:
+                save_manifest(manifest, storage_manager)
+                unsaved, last_save = 0, time.monotonic()
+            if on_downloaded is not None:
+                on_downloaded(file_path)
+    finally:
+        if unsaved:
+            save_manifest(manifest, storage_manager)
+    return downloaded
+
+def import_voice_memos(incremental=True, on_downloaded=None):
     """
     Main function to handle the import process of voice memos from iCloud.
+
+    Parameters:
+    - incremental: Fetch only new or changed memos (default). When False, the full memo list is
+      fetched and saved as a single encrypted blob.
+    - on_downloaded: Optional callable invoked with the path of each memo downloaded by an incremental import.
     """
     try:
         session_token = authenticate_icloud(ICLOUD_USERNAME, ICLOUD_PASSWORD)
-        if session_token:
+        if session_token and incremental:
+            downloaded = import_voice_memos_incrementally(session_token, on_downloaded=on_downloaded)
+            log_event(f"Incremental import completed, {len(downloaded)} voice memos downloaded.")
+        elif session_token:
             voice_memos = fetch_voice_memos(session_token)
             if voice_memos:
                 save_voice_memos(voice_memos)
@@ -0,0 +1,349 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from app.config import DATABASE_PATH, ENCRYPTION_KEY
+from app.crypto import crypto
+from app.registry import registry
+from app.utils import check_and_create_directory, log_event
+
+# Record kinds stored per memo. Text kinds are stored as UTF-8, 'metadata' as JSON.
+RECORD_KINDS = ('transcription', 'summary', 'metadata')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memos (
+    memo_id TEXT PRIMARY KEY,
+    timestamp REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_memos_timestamp ON memos (timestamp);
+
+CREATE TABLE IF NOT EXISTS memo_speakers (
+    memo_id TEXT NOT NULL REFERENCES memos (memo_id) ON DELETE CASCADE,
+    speaker_cluster TEXT NOT NULL,
+    PRIMARY KEY (memo_id, speaker_cluster)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_memo_speakers_cluster ON memo_speakers (speaker_cluster, memo_id);
+
+CREATE TABLE IF NOT EXISTS records (
+    memo_id TEXT NOT NULL REFERENCES memos (memo_id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (memo_id, kind)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS embeddings (
+    memo_id TEXT NOT NULL REFERENCES memos (memo_id) ON DELETE CASCADE,
+    segment INTEGER NOT NULL,
+    dimension INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (memo_id, segment)
+) WITHOUT ROWID;
+
+-- Pipeline stages completed per memo. stage_key identifies the audio and stage parameters the stage
+-- ran with. Not tied to the memos table: stages complete before a memo's first record is saved.
+CREATE TABLE IF NOT EXISTS pipeline_checkpoints (
+    memo_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    stage_key TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (memo_id, stage)
+) WITHOUT ROWID;
+"""
+
+class MemoDatabase:
+    """
+    Embedded SQLite store for transcripts, summaries, metadata and speaker embeddings.
+
+    Every payload is encrypted at rest with AES-GCM, bound to its memo ID and kind so rows
+    cannot be swapped. The columns used for filtering (memo ID, timestamp, speaker cluster)
+    are kept in plain indexed columns so range and speaker queries never decrypt anything.
+    """
+
+    def __init__(self, database_path=DATABASE_PATH, encryption_key=ENCRYPTION_KEY):
+        """
+        Parameters:
+        - database_path: Path of the SQLite database file.
+        - encryption_key: Fernet key the record encryption key is derived from.
+        """
+        check_and_create_directory(os.path.dirname(database_path) or ".")
+        self.database_path = database_path
+        self._aead = crypto.aead(b"voice-memo-database-record-v1", encryption_key)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+
+    def _encrypt(self, memo_id, kind, data):
+        nonce = os.urandom(12)
+        return nonce + self._aead.encrypt(nonce, data, f"{memo_id}\0{kind}".encode())
+
+    def _decrypt(self, memo_id, kind, payload):
+        return self._aead.decrypt(payload[:12], payload[12:], f"{memo_id}\0{kind}".encode())
+
+    def _save_memo(self, memo):
+        memo_id = str(memo['memo_id'])
+        self._connection.execute(
+            "INSERT INTO memos (memo_id, timestamp, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (memo_id) DO UPDATE SET timestamp = COALESCE(excluded.timestamp, memos.timestamp), "
+            "updated_at = excluded.updated_at",
+            (memo_id, memo.get('timestamp'), time.time()))
+
+        for kind in RECORD_KINDS:
+            if memo.get(kind) is None:
+                continue
+            data = json.dumps(memo[kind]) if kind == 'metadata' else memo[kind]
+            self._connection.execute(
+                "INSERT OR REPLACE INTO records (memo_id, kind, payload) VALUES (?, ?, ?)",
+                (memo_id, kind, self._encrypt(memo_id, kind, data.encode())))
+
+        if memo.get('speakers') is not None:
+            self._connection.execute("DELETE FROM memo_speakers WHERE memo_id = ?", (memo_id,))
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO memo_speakers (memo_id, speaker_cluster) VALUES (?, ?)",
+                [(memo_id, str(speaker)) for speaker in memo['speakers']])
+
+        if memo.get('embeddings') is not None:
+            import numpy as np
+            vectors = np.asarray(memo['embeddings'], dtype=np.float32)
+            vectors = vectors.reshape(-1, vectors.shape[-1])
+            self._connection.execute("DELETE FROM embeddings WHERE memo_id = ?", (memo_id,))
+            self._connection.executemany(
+                "INSERT INTO embeddings (memo_id, segment, dimension, vector) VALUES (?, ?, ?, ?)",
+                [(memo_id, segment, vectors.shape[1],
+                  self._encrypt(memo_id, f"embedding:{segment}", vector.tobytes()))
+                 for segment, vector in enumerate(vectors)])
+
+    def save_memo(self, memo_id, **fields):
+        """
+        Insert or update a single memo.
+
+        Parameters:
+        - memo_id: Identifier of the memo.
+        - fields: Any of 'timestamp', 'speakers' (speaker cluster IDs), 'transcription', 'summary',
+          'metadata' (a dictionary) and 'embeddings' (an array of shape (segments, dimension)).
+          Fields left out are kept as they are.
+        """
+        self.bulk_save([dict(fields, memo_id=memo_id)])
+
+    def bulk_save(self, memos):
+        """
+        Insert or update many memos in a single transaction.
+
+        Parameters:
+        - memos: An iterable of dictionaries with a 'memo_id' key and the fields accepted by save_memo.
+        """
+        count = 0
+        with self._lock, self._connection:
+            for memo in memos:
+                self._save_memo(memo)
+                count += 1
+        log_event(f"Saved {count} memos to {self.database_path}")
+
+    def load(self, memo_id, kind):
+        """
+        Load and decrypt one record of a memo.
+
+        Parameters:
+        - memo_id: Identifier of the memo.
+        - kind: One of 'transcription', 'summary' or 'metadata'.
+
+        Returns:
+        - The record (a string, or a dictionary for metadata), or None if it does not exist.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT payload FROM records WHERE memo_id = ? AND kind = ?",
+                                           (str(memo_id), kind)).fetchone()
+        if row is None:
+            return None
+        data = self._decrypt(str(memo_id), kind, row[0]).decode()
+        return json.loads(data) if kind == 'metadata' else data
+
+    def load_embeddings(self, memo_id):
+        """
+        Load a memo's speaker embeddings.
+
+        Returns:
+        - A float32 NumPy array of shape (segments, dimension); empty if none were saved.
+        """
+        import numpy as np
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT segment, dimension, vector FROM embeddings WHERE memo_id = ? ORDER BY segment",
+                (str(memo_id),)).fetchall()
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([np.frombuffer(self._decrypt(str(memo_id), f"embedding:{segment}", vector), dtype=np.float32)
+                         for segment, _, vector in rows])
+
+    def query_memos(self, start=None, end=None, speaker=None, limit=None):
+        """
+        Find memos by time range and/or speaker using the indexed columns only.
+
+        Parameters:
+        - start: Only memos with a timestamp at or after this Unix time.
+        - end: Only memos with a timestamp before this Unix time.
+        - speaker: Only memos containing this speaker cluster ID.
+        - limit: Maximum number of memos returned.
+
+        Returns:
+        - A list of dictionaries with 'memo_id' and 'timestamp', newest first.
+        """
+        sql = "SELECT m.memo_id, m.timestamp FROM memos m"
+        conditions, parameters = [], []
+        if speaker is not None:
+            sql += " JOIN memo_speakers s ON s.memo_id = m.memo_id"
+            conditions.append("s.speaker_cluster = ?")
+            parameters.append(str(speaker))
+        if start is not None:
+            conditions.append("m.timestamp >= ?")
+            parameters.append(start)
+        if end is not None:
+            conditions.append("m.timestamp < ?")
+            parameters.append(end)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY m.timestamp DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(int(limit))
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [{'memo_id': memo_id, 'timestamp': timestamp} for memo_id, timestamp in rows]
+
+    def speakers(self, memo_id):
+        """
+        Return the speaker cluster IDs recorded for a memo.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT speaker_cluster FROM memo_speakers WHERE memo_id = ?",
+                                            (str(memo_id),)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_stage_done(self, memo_id, stage, stage_key):
+        """
+        Record that a pipeline stage completed for a memo.
+
+        Parameters:
+        - memo_id: Identifier of the memo.
+        - stage: Name of the stage.
+        - stage_key: Identifies the audio and parameters the stage ran with (a PipelineCache key).
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pipeline_checkpoints (memo_id, stage, stage_key, completed_at) "
+                "VALUES (?, ?, ?, ?)", (str(memo_id), stage, stage_key, time.time()))
+
+    def completed_stages(self, memo_id):
+        """
+        Return a dictionary mapping each pipeline stage completed for a memo to its stage key.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT stage, stage_key FROM pipeline_checkpoints WHERE memo_id = ?", (str(memo_id),)).fetchall()
+        return dict(rows)
+
+    def delete_memo(self, memo_id):
+        """
+        Delete a memo and all of its records.
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM memos WHERE memo_id = ?", (str(memo_id),))
+            self._connection.execute("DELETE FROM pipeline_checkpoints WHERE memo_id = ?", (str(memo_id),))
+
+    def reencrypt(self, batch_size=500):
+        """
+        Re-encrypt the records and embeddings still encrypted with a previous key (during a key
+        rotation) with the current key, a batch of memos per transaction. Rows saved concurrently
+        are left as they are, since they were written with the current key.
+
+        Returns:
+        - The number of rows rewritten.
+        """
+        if not hasattr(self._aead, "is_current"):
+            return 0
+        rewritten, last_memo_id = 0, ""
+        while True:
+            with self._lock:
+                memo_ids = [row[0] for row in self._connection.execute(
+                    "SELECT memo_id FROM memos WHERE memo_id > ? ORDER BY memo_id LIMIT ?", (last_memo_id, batch_size))]
+                if not memo_ids:
+                    return rewritten
+                placeholders = ",".join("?" * len(memo_ids))
+                records = self._connection.execute(
+                    f"SELECT memo_id, kind, payload FROM records WHERE memo_id IN ({placeholders})", memo_ids).fetchall()
+                embeddings = self._connection.execute(
+                    f"SELECT memo_id, segment, vector FROM embeddings WHERE memo_id IN ({placeholders})", memo_ids).fetchall()
+            last_memo_id = memo_ids[-1]
+
+            updates = []
+            for table, column, key_column, rows, kind_of in (
+                    ("records", "payload", "kind", records, lambda key: key),
+                    ("embeddings", "vector", "segment", embeddings, lambda key: f"embedding:{key}")):
+                for memo_id, key, payload in rows:
+                    associated_data = f"{memo_id}\0{kind_of(key)}".encode()
+                    if self._aead.is_current(payload[:12], payload[12:], associated_data):
+                        continue
+                    data = self._decrypt(memo_id, kind_of(key), payload)
+                    updates.append((f"UPDATE {table} SET {column} = ? WHERE memo_id = ? AND {key_column} = ? AND {column} = ?",
+                                    (self._encrypt(memo_id, kind_of(key), data), memo_id, key, payload)))
+            if updates:
+                with self._lock, self._connection:
+                    for statement, parameters in updates:
+                        rewritten += self._connection.execute(statement, parameters).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+registry.register("database", MemoDatabase)
+
+def save_all_data(audio_file_paths, metadata=None, summaries=None, embeddings=None, database=None,
+                  search_index=None, vector_store=None):
+    """
+    Save the transcription, summary, metadata and speaker embeddings of every processed memo to the
+    memo database in one transaction.
+
+    Parameters:
+    - audio_file_paths: Paths of the processed audio files. The file name (without extension) is the memo ID.
+    - metadata: Optional dictionary mapping audio file paths to their metadata.
+    - summaries: Optional dictionary mapping audio file paths to their summaries.
+    - embeddings: Optional dictionary mapping audio file paths to their speaker embeddings.
+    - database: Optional MemoDatabase; the default database is used if omitted.
+    - search_index: Optional SearchIndex the transcripts are added to; the default index is used if omitted.
+    - vector_store: Optional VectorStore the transcript chunks are added to; the default store is used if omitted.
+    """
+    from app.search import SearchIndex
+    from app.transcription import load_transcription
+    from app.vector_store import VectorStore
+
+    metadata, summaries, embeddings = metadata or {}, summaries or {}, embeddings or {}
+    database = database or MemoDatabase()
+    search_index = search_index or SearchIndex()
+    vector_store = vector_store or VectorStore()
+    transcriptions = []
+
+    def memos():
+        for audio_file_path in audio_file_paths:
+            memo_id = os.path.splitext(os.path.basename(audio_file_path))[0]
+            transcription = load_transcription(memo_id)
+            if transcription is not None:
+                search_index.add_document(memo_id, transcription)
+                transcriptions.append((memo_id, transcription))
+            memo_metadata = metadata.get(audio_file_path)
+            yield {
+                'memo_id': memo_id,
+                'timestamp': memo_metadata.get('timestamp') if memo_metadata else None,
+                'speakers': memo_metadata.get('speakers') if memo_metadata else None,
+                'transcription': transcription,
+                'summary': summaries.get(audio_file_path),
+                'metadata': memo_metadata,
+                'embeddings': embeddings.get(audio_file_path),
+            }
+
+    database.bulk_save(memos())
+    search_index.commit()
+    vector_store.add_memos(transcriptions)
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+from app.config import KEY_ROTATION_STATE_PATH, SEARCH_INDEX_PATH, SPEAKER_INDEX_PATH, VECTOR_STORE_PATH
+from app.crypto import crypto, key_fingerprint
+from app.metrics import metrics
+from app.registry import registry
+from app.storage import StorageManager
+from app.utils import check_and_create_directory, log_event
+
+# Records re-encrypted between two saves of the rotation state
+ROTATION_BATCH_SIZE = 64
+
+metrics.describe("key_rotation_records_total", "Encrypted records and stores checked during a key rotation")
+metrics.describe("key_rotation_store_seconds", "Time to re-encrypt a store during a key rotation")
+
+class KeyRotation:
+    """
+    Re-encrypts everything under STORAGE_PATH with the current ENCRYPTION_KEY after a key change.
+
+    To rotate keys, set ENCRYPTION_KEY to the new key and ENCRYPTION_PREVIOUS_KEYS to the old one,
+    and run the job. Until it finishes, data written with either key stays readable. Records are
+    streamed through the cipher a chunk at a time, several at once on the crypto thread pool; then
+    the database and the indexes rewrite themselves. Records are visited in sorted order, and after
+    every batch the last one finished is saved to `state_path` as a cursor, along with the stores
+    done, so a job that is stopped or crashes resumes where it left off. Once the job has finished,
+    the previous keys can be removed from ENCRYPTION_PREVIOUS_KEYS.
+    """
+
+    def __init__(self, storage_manager=None, state_path=KEY_ROTATION_STATE_PATH):
+        """
+        Parameters:
+        - storage_manager: Optional StorageManager; a new one is created if omitted.
+        - state_path: File the progress is saved to.
+        """
+        self.storage_manager = storage_manager or StorageManager()
+        self.state_path = state_path
+        self._fingerprint = key_fingerprint(crypto.encryption_key)
+        self._stop = threading.Event()
+        self._thread = None
+        self._cursor = None
+        self._stores_done = []
+        self._done_count = 0
+        self._total = 0
+        self.result = None
+
+    def _load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as file:
+                state = json.load(file)
+            # Progress towards another key says nothing about this one
+            if state.get('key') == self._fingerprint:
+                return state
+        return {'key': self._fingerprint, 'cursor': None, 'stores': [], 'finished': False}
+
+    def _save_state(self, finished=False):
+        check_and_create_directory(os.path.dirname(self.state_path) or ".")
+        with open(self.state_path + ".tmp", 'w') as file:
+            json.dump({'key': self._fingerprint, 'cursor': self._cursor, 'stores': self._stores_done,
+                       'finished': finished}, file)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def _records(self):
+        """
+        The encrypted records, as [data_type, file_name] pairs in sorted order.
+        """
+        for data_type in sorted(self.storage_manager.ENCRYPTED_DATA_TYPES):
+            for file_name in self.storage_manager.list_data(data_type):
+                yield [data_type, file_name]
+
+    def _stores(self):
+        """
+        The stores with their own encrypted files, as (name, factory) pairs. Stores never written
+        to are skipped rather than created.
+        """
+        from app import database, search, vector_store  # noqa: F401 (registers the stores)
+        from app.speaker_index import SpeakerIndex
+
+        stores = [("database", lambda: registry.get("database"))]
+        if os.path.isdir(SEARCH_INDEX_PATH):
+            stores.append(("search_index", lambda: registry.get("search_index")))
+        if os.path.isdir(VECTOR_STORE_PATH):
+            stores.append(("vector_store", lambda: registry.get("vector_store")))
+        if os.path.isdir(SPEAKER_INDEX_PATH):
+            stores.append(("speaker_index", SpeakerIndex))
+        return stores
+
+    def _reencrypt_record(self, unit):
+        data_type, file_name = unit
+        try:
+            rewritten = self.storage_manager.reencrypt(file_name, data_type)
+        except FileNotFoundError:
+            # Deleted since it was listed
+            rewritten = False
+        metrics.inc("key_rotation_records_total", result="rewritten" if rewritten else "current")
+        return rewritten
+
+    def run(self):
+        """
+        Run the rotation to completion, or until stop() is called.
+
+        Returns:
+        - A dictionary with the number of records 'rewritten' and already 'current', whether the
+          rotation 'finished', and the 'seconds' taken.
+        """
+        start = time.perf_counter()
+        state = self._load_state()
+        self._cursor = state.get('cursor')
+        # State saved by earlier versions lists every finished record and store in 'done'
+        legacy_done = set(state.get('done', []))
+        self._stores_done = state.get('stores', [name for name in legacy_done if "/" not in name])
+        records, skipped = [], 0
+        for unit in self._records():
+            if (self._cursor is not None and unit <= self._cursor) or "/".join(unit) in legacy_done:
+                skipped += 1
+            else:
+                records.append(unit)
+        stores = [(name, factory) for name, factory in self._stores() if name not in self._stores_done]
+        self._done_count = skipped + len(self._stores_done)
+        self._total = self._done_count + len(records) + len(stores)
+        log_event(f"Rotating encryption keys: {len(records)} records and {len(stores)} stores left",
+                  key=self._fingerprint, resumed=self._done_count)
+
+        rewritten = current = 0
+        for offset in range(0, len(records), ROTATION_BATCH_SIZE):
+            if self._stop.is_set():
+                break
+            batch = records[offset:offset + ROTATION_BATCH_SIZE]
+            results = crypto.map(self._reencrypt_record, batch)
+            rewritten += sum(results)
+            current += len(results) - sum(results)
+            self._cursor = batch[-1]
+            self._done_count += len(batch)
+            self._save_state()
+
+        for name, factory in stores:
+            if self._stop.is_set():
+                break
+            with metrics.timer("key_rotation_store_seconds", store=name):
+                store = factory()
+                count = store.reencrypt()
+            log_event(f"Re-encrypted the {name}" + (f" ({count} rows)" if count is not None else ""))
+            metrics.inc("key_rotation_records_total", result="store")
+            self._stores_done.append(name)
+            self._done_count += 1
+            self._save_state()
+
+        finished = self._done_count >= self._total
+        if finished:
+            self._save_state(finished=True)
+        self.result = {'rewritten': rewritten, 'current': current, 'finished': finished,
+                       'seconds': round(time.perf_counter() - start, 3)}
+        log_event(f"Key rotation {'finished' if finished else 'stopped'}: {rewritten} records re-encrypted, "
+                  f"{current} already current", **self.result)
+        return self.result
+
+    def progress(self):
+        """
+        Return the number of records and stores done and the total, e.g. for a status display.
+        """
+        return {'done': self._done_count, 'total': self._total}
+
+    def start(self):
+        """
+        Run the rotation on a background thread.
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_logged, name="key-rotation", daemon=True)
+        self._thread.start()
+
+    def _run_logged(self):
+        try:
+            self.run()
+        except Exception as e:
+            log_event(f"Key rotation failed, it resumes on the next run: {e}", level="error")
+
+    def stop(self):
+        """
+        Stop after the current batch, saving the progress, and wait for the background thread.
+        """
+        self._stop.set()
+        self.wait()
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.result
+
+if __name__ == "__main__":
+    if crypto.previous_keys:
+        print(json.dumps(KeyRotation().run()))
+    else:
+        print("Set ENCRYPTION_PREVIOUS_KEYS to the keys being replaced to rotate to ENCRYPTION_KEY.")
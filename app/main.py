@@ -1,47 +1,79 @@
+import argparse
 import sys
-from data_import import import_voice_memos
-from transcription import transcribe_all_voice_memos
-from metadata_extraction import extract_all_metadata
-from summarization import summarize_all_transcriptions
-from storage import save_all_data
-from user_interaction import start_interaction_service
-from metadata_extraction import extract_speaker_embeddings
-from utils import log_event
+from app.data_import import import_voice_memos
+from app.transcription import list_audio_files
+from app.user_interaction import start_interaction_service
+from app.cache import PipelineCache
+from app.crypto import crypto
+from app.key_rotation import KeyRotation
+from app.metrics import metrics
+from app.pipeline import MemoPipeline
+from app.registry import registry
+from app.watcher import MemoWatcher
+from app.utils import log_event
 
-def main():
-    try:
-        log_event("Starting Voice Memo AI Assistant...")
-
-        # Step 1: Import voice memos from iCloud
-        log_event("Importing voice memos from iCloud...")
-        import_voice_memos()
-
-        # Step 2: Transcribe all imported voice memos
-        log_event("Transcribing voice memos...")
-        audio_file_paths = transcribe_all_voice_memos()  # Get the paths of all transcribed audio files
+def process_backlog(pipeline):
+    """
+    Import new memos and run them, and any memo whose processing did not finish before, through the pipeline.
+    """
+    # Each memo enters the pipeline (transcription, speaker identification, metadata, summarization,
+    # indexing) as soon as it is downloaded
+    log_event("Importing and processing voice memos...")
+    import_voice_memos(on_downloaded=pipeline.submit)
 
-        # New Step: Extract Speaker Embeddings
-        log_event("Extracting speaker embeddings...")
-        for path in audio_file_paths:
-            extract_speaker_embeddings(path)
+    # Catch up on memos whose processing did not finish before; completed stages are skipped
+    for audio_file_path in list_audio_files():
+        pipeline.submit(audio_file_path)
+    results = pipeline.join()
 
-        # Step 3: Extract metadata from all voice memos
-        log_event("Extracting metadata from voice memos...")
-        extract_all_metadata()
+    failed = {memo_id: result['error'] for memo_id, result in results.items() if result['status'] == 'failed'}
+    for memo_id, error in failed.items():
+        log_event(f"Voice memo {memo_id} was not fully processed ({error}); it is retried on the next run")
+    log_event(f"Processed {len(results) - len(failed)} voice memos, {len(failed)} failed")
+    # Where the time went, per stage, for spotting the bottleneck
+    for series, summary in sorted(metrics.snapshot()['histograms'].items()):
+        if series.startswith("pipeline_stage_seconds"):
+            log_event(f"{series}: {summary['count']} runs, {summary['sum']:.1f}s in total", **summary)
+    metrics.write()
 
-        # Step 4: Summarize all transcriptions
-        log_event("Summarizing transcriptions...")
-        summarize_all_transcriptions()
-
-        # Step 5: Save all data securely
-        log_event("Saving all data securely...")
-        save_all_data()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Voice Memo AI Assistant")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep importing and processing new memos while serving queries")
+    args = parser.parse_args(argv)
+    try:
+        log_event("Starting Voice Memo AI Assistant...")
+        cache = PipelineCache()
+        metrics.start_exporter()
+        # The speaker model loads while the first memos download and transcribe
+        registry.warm(["speaker_embedder"], background=True)
+        if crypto.previous_keys:
+            # Data written with the old keys stays readable while it is re-encrypted in the background
+            KeyRotation().start()
 
-        # Step 6: Start user interaction service (SMS/Telegram)
-        log_event("Starting user interaction service...")
-        start_interaction_service()
+        if args.watch:
+            # Memos are processed in the background and become searchable as they finish
+            with MemoPipeline(cache=cache) as pipeline:
+                # Voice notes sent to the bot join the same pipeline
+                registry.set("memo_pipeline", pipeline)
+                for audio_file_path in list_audio_files():
+                    pipeline.submit(audio_file_path)
+                watcher = MemoWatcher(pipeline)
+                watcher.start()
+                try:
+                    log_event("Voice Memo AI Assistant is ready for use.")
+                    start_interaction_service()
+                finally:
+                    watcher.stop()
+        else:
+            with MemoPipeline(cache=cache) as pipeline:
+                process_backlog(pipeline)
+            log_event(f"Pipeline cache stats: {cache.stats()}")
 
-        log_event("Voice Memo AI Assistant is ready for use.")
+            # Start user interaction service (SMS/Telegram)
+            log_event("Starting user interaction service...")
+            log_event("Voice Memo AI Assistant is ready for use.")
+            start_interaction_service()
     except Exception as e:
         log_event(f"An error occurred: {e}")
         sys.exit(1)
@@ -1,24 +1,240 @@
 import os
-from utils import log_event, load_json_file, save_json_file
-from config import STORAGE_PATH
-from speechbrain.pretrained import SpeakerRecognition
-from utils import load_audio_file
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.utils import log_event, load_json_file, save_json_file
+from app.config import (STORAGE_PATH, SPEAKER_IDENTIFICATION_MODEL, SPEAKER_SAMPLE_RATE, SPEAKER_EMBEDDING_BATCH_SIZE,
+                    SPEAKER_EMBEDDING_MAX_BATCH_SECONDS, SPEAKER_EMBEDDING_WORKERS, SPEAKER_WINDOW_SECONDS,
+                    VAD_ENABLED)
+from app.utils import iter_audio_windows
+from app.vad import iter_speech_segments, detect_speech_segments
+from app.database import MemoDatabase
+from app.speaker_index import SpeakerIndex
+from app.registry import registry
 
-# Initialize the SpeakerRecognition model
-model = SpeakerRecognition.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb", savedir="pretrained_models/spkrec-ecapa-voxceleb")
+# Windows shorter than this (the end of a recording) carry too little speech for a speaker embedding
+MIN_WINDOW_SECONDS = 0.5
+
+class SpeakerEmbedder:
+    """
+    Reusable handle on the ECAPA-TDNN speaker model that embeds many audio windows per model call.
+
+    Recordings are decoded incrementally in a thread pool, downmixed and resampled to the model's
+    sample rate and cut into fixed-length windows, each of which gets its own embedding. With voice
+    activity detection, only the speech is cut into windows. Windows
+    from all files are queued through a bounded queue and encoded in batches, so memory is bounded
+    by the batch rather than by the length of the recordings, and decoding runs ahead of the model.
+    The windows in a batch have the same length except for the last window of a file; padding is
+    masked out by passing their relative lengths to encode_batch.
+    """
+
+    def __init__(self, source=SPEAKER_IDENTIFICATION_MODEL, sample_rate=SPEAKER_SAMPLE_RATE,
+                 batch_size=SPEAKER_EMBEDDING_BATCH_SIZE, max_batch_seconds=SPEAKER_EMBEDDING_MAX_BATCH_SECONDS,
+                 workers=SPEAKER_EMBEDDING_WORKERS, window_seconds=SPEAKER_WINDOW_SECONDS, vad=VAD_ENABLED):
+        """
+        Parameters:
+        - source: SpeechBrain model to load.
+        - sample_rate: Sample rate the model expects.
+        - batch_size: Maximum number of windows per encode_batch call.
+        - max_batch_seconds: Maximum audio per batch, bounding memory.
+        - workers: Threads used to decode and resample audio.
+        - window_seconds: Length of the window each embedding is computed over.
+        - vad: Embed only the speech found by voice activity detection.
+        """
+        from speechbrain.pretrained import SpeakerRecognition
+
+        self.model = SpeakerRecognition.from_hparams(source=source, savedir=os.path.join("pretrained_models",
+                                                                                        source.split("/")[-1]))
+        self.sample_rate = sample_rate
+        self.batch_size = max(1, min(batch_size, int(max_batch_seconds // window_seconds)))
+        self.workers = workers
+        self.window_seconds = window_seconds
+        self.vad = vad
+
+    def encode_waveforms(self, waveforms):
+        """
+        Embed a list of 1-D waveforms at the model's sample rate in one model call.
+
+        Returns:
+        - A float32 NumPy array of shape (len(waveforms), embedding_dimension).
+        """
+        import torch
+
+        waveforms = [torch.as_tensor(waveform) for waveform in waveforms]
+        lengths = torch.tensor([len(waveform) for waveform in waveforms], dtype=torch.float32)
+        batch = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True)
+        with torch.no_grad():
+            embeddings = self.model.encode_batch(batch, wav_lens=lengths / lengths.max())
+        return embeddings.squeeze(1).cpu().numpy()
+
+    def _decode(self, path, windows, stop, speech_segments=None):
+        """
+        Decode one file into the window queue, followed by an end marker (None, or the error). With
+        voice activity detection, the file's speech segments are appended to speech_segments.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    windows.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        try:
+            if self.vad:
+                size = int(self.window_seconds * self.sample_rate)
+
+                def speech():
+                    for start, end, audio in iter_speech_segments(path, self.sample_rate):
+                        if speech_segments is not None:
+                            speech_segments.append([round(start, 3), round(end, 3)])
+                        yield audio
+
+                windows_of_file = (audio[offset:offset + size] for audio in speech()
+                                   for offset in range(0, len(audio), size))
+            else:
+                windows_of_file = (window for _, window in iter_audio_windows(path, self.sample_rate,
+                                                                              self.window_seconds))
+            for window in windows_of_file:
+                # A trailing scrap too short to characterise a voice is dropped.
+                if len(window) >= MIN_WINDOW_SECONDS * self.sample_rate:
+                    put((path, window))
+            put((path, None))
+        except Exception as e:
+            log_event(f"Could not load {path} for speaker embedding: {e}")
+            put((path, e))
+
+    def embed_files(self, audio_file_paths, speech_segments=None):
+        """
+        Embed every window of many audio files.
+
+        Parameters:
+        - audio_file_paths: Paths of the audio files.
+        - speech_segments: Optional dictionary that, with voice activity detection, receives the
+          [start_seconds, end_seconds] speech segments of each embedded file, as
+          detect_speech_segments() returns them, so they need not be detected again.
+
+        Returns:
+        - A dictionary mapping each path to a float32 NumPy array of shape (windows, embedding_dimension),
+          one row per window in order. Files that fail to decode are logged and left out.
+        """
+        import numpy as np
+
+        audio_file_paths = list(audio_file_paths)
+        segments = {path: [] for path in audio_file_paths}
+        failed = set()
+        windows, stop = queue.Queue(maxsize=2 * self.batch_size), threading.Event()
+
+        def encode(batch):
+            for (path, _), embedding in zip(batch, self.encode_waveforms([window for _, window in batch])):
+                segments[path].append(embedding)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            detected = {path: [] for path in audio_file_paths}
+            for path in audio_file_paths:
+                pool.submit(self._decode, path, windows, stop, detected[path])
+            try:
+                remaining, batch = len(audio_file_paths), []
+                while remaining:
+                    path, window = windows.get()
+                    if window is None or isinstance(window, Exception):
+                        remaining -= 1
+                        if window is not None:
+                            failed.add(path)
+                        continue
+                    batch.append((path, window))
+                    if len(batch) >= self.batch_size:
+                        encode(batch)
+                        batch = []
+                if batch:
+                    encode(batch)
+            finally:
+                # Lets decoders blocked on a full queue exit if encoding failed.
+                stop.set()
+
+        results = {path: np.stack(embeddings) for path, embeddings in segments.items()
+                   if embeddings and path not in failed}
+        if speech_segments is not None and self.vad:
+            speech_segments.update((path, detected[path]) for path in results)
+        log_event(f"Extracted speaker embeddings for {len(results)} audio files")
+        return results
+
+registry.register("speaker_embedder", SpeakerEmbedder)
+
+def get_speaker_embedder():
+    """
+    Return the process-wide SpeakerEmbedder, loading the model on first use.
+    """
+    return registry.get("speaker_embedder")
 
 def extract_speaker_embeddings(audio_file_path):
-    signal = load_audio_file(audio_file_path)  # Load the audio signal
-    embeddings = model.encode_batch(signal)
-    # Process embeddings as needed, e.g., save them or compare with known speakers
+    """
+    Embed the speakers of a single audio file, one embedding per window.
+
+    Returns:
+    - A float32 NumPy array of shape (windows, embedding_dimension).
+    """
+    embeddings = get_speaker_embedder().embed_files([audio_file_path])
+    if audio_file_path not in embeddings:
+        raise RuntimeError(f"Speaker embedding failed for {audio_file_path}. See event log for details.")
+    return embeddings[audio_file_path]
+
+def extract_all_speaker_embeddings(audio_file_paths, cache=None, database=None):
+    """
+    Embed the speakers of many audio files in batches and persist the embeddings to the memo database.
+
+    Parameters:
+    - audio_file_paths: Paths of the audio files. The file name (without extension) is the memo ID.
+    - cache: Optional PipelineCache. Files with cached embeddings are not run through the model.
+    - database: Optional MemoDatabase; the default database is used if omitted.
+
+    Returns:
+    - A dictionary mapping each path to its embeddings as nested lists.
+    """
+    embeddings, pending = {}, []
+    for path in audio_file_paths:
+        cached = cache.get("embedding", path) if cache else None
+        if cached is not None:
+            embeddings[path] = cached
+        else:
+            pending.append(path)
+
+    if pending:
+        for path, embedding in get_speaker_embedder().embed_files(pending).items():
+            embeddings[path] = embedding.tolist()
+            if cache:
+                cache.put("embedding", path, embeddings[path])
+
+    database = database or MemoDatabase()
+    database.bulk_save({'memo_id': os.path.splitext(os.path.basename(path))[0], 'embeddings': embedding}
+                       for path, embedding in embeddings.items())
     return embeddings
 
-def extract_metadata(audio_file_path):
+def identify_speakers(embeddings, speaker_index=None):
+    """
+    Attribute each memo's speaker embeddings to speakers in the speaker index, adding new speakers as needed.
+
+    Parameters:
+    - embeddings: A dictionary mapping audio file paths to their speaker embeddings.
+    - speaker_index: Optional SpeakerIndex; the default index is used if omitted.
+
+    Returns:
+    - A dictionary mapping each path to the anonymized IDs of the speakers heard in it.
+    """
+    speaker_index = speaker_index or SpeakerIndex()
+    memo_ids = {os.path.splitext(os.path.basename(path))[0]: path for path in embeddings}
+    speakers = speaker_index.add_memos((memo_id, embeddings[path]) for memo_id, path in memo_ids.items())
+    return {memo_ids[memo_id]: speaker_ids for memo_id, speaker_ids in speakers.items()}
+
+def extract_metadata(audio_file_path, speakers=None, speech_segments=None):
     """
     Extract metadata from an audio file.
     
     Parameters:
     - audio_file_path: Path to the audio file.
+    - speakers: Optional anonymized speaker IDs from identify_speakers.
+    - speech_segments: Optional speech segments already detected, e.g. by SpeakerEmbedder.embed_files.
+      The file is decoded to detect them only if they are omitted.
     
     Returns:
     - A dictionary containing extracted metadata.
@@ -29,7 +245,13 @@ def extract_metadata(audio_file_path):
         # For now, we'll simulate with dummy data
         metadata['timestamp'] = os.path.getmtime(audio_file_path)
         metadata['location'] = "Unknown"  # Location extraction would require access to additional data or APIs
-        metadata['speaker'] = "Speaker 1"  # Placeholder for speaker identification
+        metadata['speakers'] = list(speakers or [])  # Already anonymized by the speaker index
+        if VAD_ENABLED:
+            # [start, end] seconds of each stretch of speech; only these were transcribed and embedded
+            if speech_segments is None:
+                speech_segments = detect_speech_segments(audio_file_path)
+            metadata['speech_segments'] = speech_segments
+            metadata['speech_seconds'] = round(sum(end - start for start, end in metadata['speech_segments']), 3)
         
         log_event(f"Metadata extracted for {audio_file_path}")
     except Exception as e:
@@ -50,31 +272,37 @@ def anonymize_metadata(metadata):
     """
     if 'location' in metadata:
         metadata['location'] = "Anonymized"
-    if 'speaker' in metadata:
-        metadata['speaker'] = "Anonymized Speaker"
+    # 'speakers' holds the salted IDs of the speaker index, which reveal nothing by themselves
     
     return metadata
 
-def save_metadata(metadata, file_name):
+def extract_all_metadata(audio_file_paths, speakers=None):
     """
-    Save the metadata to a file.
+    Extract and anonymize the metadata of several audio files.
+
+    Parameters:
+    - audio_file_paths: Paths of the audio files.
+    - speakers: Optional dictionary mapping audio file paths to their speaker IDs, as returned by identify_speakers.
+
+    Returns:
+    - A dictionary mapping each audio file path to its anonymized metadata.
+    """
+    speakers = speakers or {}
+    return {path: anonymize_metadata(extract_metadata(path, speakers.get(path))) for path in audio_file_paths}
+
+def save_metadata(metadata, file_name, database=None):
+    """
+    Save the metadata to the memo database.
     
     Parameters:
     - metadata: The metadata dictionary to be saved.
-    - file_name: The name of the file to save the metadata to.
+    - file_name: The memo ID the metadata belongs to.
+    - database: Optional MemoDatabase; the default database is used if omitted.
     """
-    # Ensure the storage directory exists
-    storage_dir = os.path.join(STORAGE_PATH, "metadata")
-    if not os.path.exists(storage_dir):
-        os.makedirs(storage_dir)
-    
-    # Define the full path for the metadata file
-    file_path = os.path.join(storage_dir, file_name + ".json")
-    
-    # Save the metadata
-    save_json_file(file_path, metadata)
+    database = database or MemoDatabase()
+    database.save_memo(file_name, metadata=metadata, timestamp=metadata.get('timestamp'))
     
-    log_event(f"Metadata saved to {file_path}")
+    log_event(f"Metadata saved for {file_name}")
 
 if __name__ == "__main__":
     # Example usage
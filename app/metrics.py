@@ -0,0 +1,279 @@
+import bisect
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.config import METRICS_NAMESPACE, METRICS_PATH, METRICS_PORT, METRICS_INTERVAL_SECONDS
+from app.utils import check_and_create_directory, log_event
+
+# Histogram bucket upper bounds, in seconds unless a metric is described with its own
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self.seconds = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        labels = dict(self._labels, outcome="error") if exc_type is not None else self._labels
+        self._metrics.observe(self._name, self.seconds, **labels)
+
+class Metrics:
+    """
+    In-process counters, gauges and histograms for the hot paths, exported in the Prometheus text format.
+
+    Recording a value is a dictionary update under one lock, cheap enough for every request, chunk
+    or cache lookup. Labels are keyword arguments, e.g. metrics.inc("cache_lookups_total",
+    stage="summary", result="hit"). Histograms keep counts per fixed bucket rather than the
+    values, so their memory does not grow with traffic; quantiles are estimated from the buckets.
+
+    render() produces the exposition text, which start_exporter() writes to a file periodically
+    (for a textfile collector) and/or serves over HTTP at /metrics.
+    """
+
+    def __init__(self, namespace=METRICS_NAMESPACE):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._descriptions = {}
+        self._buckets = {}
+        self._exporter = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, description, buckets=None):
+        """
+        Set the help text of a metric and, for a histogram, its bucket upper bounds.
+        """
+        with self._lock:
+            self._descriptions[name] = description
+            if buckets is not None:
+                self._buckets[name] = tuple(sorted(buckets))
+
+    def inc(self, name, value=1.0, **labels):
+        """
+        Increase a counter.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = float(value)
+
+    def add(self, name, delta, **labels):
+        """
+        Move a gauge up or down, e.g. a queue depth.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0.0) + delta
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                buckets = self._buckets.get(name, DEFAULT_BUCKETS)
+                histogram = self._histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+            histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+            histogram[2] += value
+
+    def timer(self, name, **labels):
+        """
+        Return a context manager recording its wall time in seconds in a histogram. Exceptions are
+        recorded with an extra outcome="error" label.
+        """
+        return _Timer(self, name, labels)
+
+    def quantile(self, name, q, **labels):
+        """
+        Estimate a quantile of a histogram by interpolating within its buckets.
+
+        Returns:
+        - The estimate, or None if nothing was recorded.
+        """
+        with self._lock:
+            histogram = self._histograms.get(self._key(name, labels))
+            if histogram is None:
+                return None
+            buckets, counts, _ = histogram[0], list(histogram[1]), histogram[2]
+        return self._estimate(buckets, counts, q)
+
+    @staticmethod
+    def _estimate(buckets, counts, q):
+        total = sum(counts)
+        if not total:
+            return None
+        rank, seen = q * total, 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                if index == len(buckets):
+                    return buckets[-1]
+                lower = buckets[index - 1] if index else 0.0
+                return lower + (buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return buckets[-1]
+
+    def snapshot(self):
+        """
+        Return every metric as plain data: counters and gauges by name and label string, and per
+        histogram its count, sum and estimated p50, p95 and p99.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (value[0], list(value[1]), value[2]) for key, value in self._histograms.items()}
+        return {
+            'counters': {self._series(name, labels): value for (name, labels), value in counters.items()},
+            'gauges': {self._series(name, labels): value for (name, labels), value in gauges.items()},
+            'histograms': {
+                self._series(name, labels): {
+                    'count': sum(counts), 'sum': total,
+                    **{f'p{round(q * 100)}': self._estimate(buckets, counts, q) for q in (0.5, 0.95, 0.99)},
+                } for (name, labels), (buckets, counts, total) in histograms.items()},
+        }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+        return "{" + ",".join(f'{re.sub(r"[^a-zA-Z0-9_]", "_", name)}="{value}"'
+                              for (name, _), value in zip(labels, escaped)) + "}"
+
+    def _series(self, name, labels):
+        return name + self._format_labels(labels)
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            series = [(name, labels, "counter", value) for (name, labels), value in self._counters.items()]
+            series += [(name, labels, "gauge", value) for (name, labels), value in self._gauges.items()]
+            series += [(name, labels, "histogram", (value[0], list(value[1]), value[2]))
+                       for (name, labels), value in self._histograms.items()]
+            descriptions = dict(self._descriptions)
+
+        lines, declared = [], set()
+        prefix = self.namespace + "_" if self.namespace else ""
+        for name, labels, kind, value in sorted(series, key=lambda item: (item[0], item[1])):
+            full_name = prefix + name
+            if name not in declared:
+                declared.add(name)
+                if name in descriptions:
+                    lines.append(f"# HELP {full_name} {descriptions[name]}")
+                lines.append(f"# TYPE {full_name} {kind}")
+            if kind != "histogram":
+                lines.append(f"{full_name}{self._format_labels(labels)} {value:g}")
+                continue
+            buckets, counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(buckets) + [float("inf")], counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{full_name}_bucket{self._format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{full_name}_sum{self._format_labels(labels)} {total:g}")
+            lines.append(f"{full_name}_count{self._format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=METRICS_PATH):
+        """
+        Write the metrics to a file atomically, for a Prometheus textfile collector.
+        """
+        check_and_create_directory(os.path.dirname(path) or ".")
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.render())
+        os.replace(temporary_path, path)
+
+    def serve(self, port=METRICS_PORT, host="127.0.0.1"):
+        """
+        Serve the metrics over HTTP at /metrics from a daemon thread.
+
+        Returns:
+        - The HTTP server; call shutdown() on it to stop serving.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        log_event(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def start_exporter(self, path=METRICS_PATH, interval=METRICS_INTERVAL_SECONDS, port=METRICS_PORT):
+        """
+        Export the metrics until the process exits: written to `path` every `interval` seconds if
+        a path is given, and served over HTTP if a port is given. Calling it again does nothing.
+        """
+        with self._lock:
+            if self._exporter is not None:
+                return
+            self._exporter = True
+        if port:
+            self.serve(port)
+        if path:
+            def export():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.write(path)
+                    except OSError as e:
+                        log_event(f"Writing metrics to {path} failed: {e}")
+
+            threading.Thread(target=export, name="metrics-export", daemon=True).start()
+
+metrics = Metrics()
+
+metrics.describe("pipeline_stage_seconds", "Time spent running a pipeline stage, per memo or per batch")
+metrics.describe("pipeline_queue_depth", "Memos submitted to a pipeline stage and not yet completed")
+metrics.describe("pipeline_memo_seconds", "Time from submitting a memo to the pipeline until it is processed")
+metrics.describe("pipeline_batch_size", "Memos per batch in the batched pipeline stages",
+                 buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+metrics.describe("transcription_audio_seconds_total", "Seconds of audio transcribed")
+metrics.describe("transcription_wall_seconds_total", "Wall-clock seconds spent transcribing")
+metrics.describe("completion_seconds", "Latency of completion API requests")
+metrics.describe("cache_lookups_total", "Cache lookups by cache, stage and result")
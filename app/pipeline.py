@@ -0,0 +1,432 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from app import database, search, vector_store  # noqa: F401 - register the stores used by default
+from app.cache import PipelineCache
+from app.config import (TRANSCRIPTION_WORKERS, WHISPER_MODEL, PIPELINE_EMBEDDING_BATCH_SIZE,
+                        PIPELINE_METADATA_WORKERS, PIPELINE_INDEX_BATCH_SIZE, VAD_ENABLED)
+from app.metrics import metrics
+from app.redaction import redact, redaction_fingerprint
+from app.registry import registry
+from app.storage import StorageManager
+from app.summarization import AsyncSummarizer
+from app.transcription import (_init_worker, _transcribe_batch, record_transcription_metrics, load_transcription,
+                               save_transcription)
+from app.utils import log_event
+from app.metadata_extraction import extract_metadata, anonymize_metadata, get_speaker_embedder
+
+# Stage -> the stages whose outputs it needs, listed in dependency order. Stages without a path between
+# them run concurrently, for the same memo and across memos.
+STAGES = {
+    'transcribe': (),
+    'embed': (),
+    'identify': ('embed',),
+    'metadata': ('identify',),
+    'summarize': ('transcribe',),
+    'index': ('transcribe', 'metadata', 'summarize'),
+}
+# The PipelineCache stage whose key versions each pipeline stage. Stages not listed only depend on the audio.
+CACHE_STAGES = {'transcribe': 'transcription', 'embed': 'embedding', 'summarize': 'summary'}
+# Stages whose outputs are redacted text or made from it
+REDACTED_STAGES = ('transcribe', 'summarize')
+
+class BatchExecutor:
+    """
+    Single-threaded executor that hands queued items to a function in batches.
+
+    Used for stages that are much cheaper per item in bulk: batched model calls, one speaker index
+    write, one search index segment. Whatever is queued when the worker becomes free, up to
+    max_batch items, forms the next batch, so batches grow with the backlog and a lone item is
+    never held back.
+    """
+
+    def __init__(self, function, max_batch, stage):
+        """
+        Parameters:
+        - function: Callable taking a list of items and returning a list of results in the same
+          order. A result that is an exception fails only that item.
+        - max_batch: Maximum number of items per call.
+        - stage: Name of the pipeline stage, used for the worker thread and in metrics.
+        """
+        self._function = function
+        self._max_batch = max_batch
+        self._stage = stage
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name=f"pipeline-{stage}", daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            while len(batch) < self._max_batch:
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self._queue.put(None)
+                    break
+                batch.append(entry)
+            metrics.observe("pipeline_batch_size", len(batch), stage=self._stage)
+            try:
+                with metrics.timer("pipeline_stage_seconds", stage=self._stage):
+                    results = self._function([item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def shutdown(self):
+        self._queue.put(None)
+        self._thread.join()
+
+class MemoState:
+    """
+    Progress of one memo through the pipeline.
+    """
+
+    def __init__(self, audio_file_path):
+        self.audio_file_path = audio_file_path
+        self.memo_id = os.path.splitext(os.path.basename(audio_file_path))[0]
+        self.stage_keys = {}
+        self.outputs = {}
+        self.done = set()
+        self.running = set()
+        self.error = None
+        self.submitted_at = time.perf_counter()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.error is not None or len(self.done) == len(STAGES)
+
+class MemoPipeline:
+    """
+    Runs each memo through a dependency graph of stages as soon as its inputs are ready.
+
+    Every stage has its own workers: transcription in Whisper worker processes, speaker embedding,
+    speaker identification and indexing in batching threads, metadata extraction in a thread pool,
+    and summarization on a shared event loop under the summarizer's rate limits. A memo therefore
+    moves through the graph independently of the others: one memo can be summarized while the next
+    is still being transcribed, and a new memo's latency is its own critical path rather than the
+    whole batch.
+
+    Each completed stage is checkpointed in the memo database, keyed by the audio and the stage's
+    parameters. A memo submitted again, after a crash or a restart, only runs the stages that did
+    not complete for its current audio; the others reload their persisted outputs. A failing stage
+    fails only its memo, which is retried from that stage on its next submission.
+    """
+
+    def __init__(self, cache=None, database=None, speaker_index=None, search_index=None, vector_store=None,
+                 storage_manager=None, summarizer=None, transcription_workers=TRANSCRIPTION_WORKERS,
+                 model_name=WHISPER_MODEL, engine_factory=None):
+        """
+        Parameters:
+        - cache: Optional PipelineCache for stage outputs; one is created if omitted.
+        - database, speaker_index, search_index, vector_store: Optional stores; the shared ones are used if omitted.
+        - storage_manager: Optional StorageManager the summaries are saved with.
+        - summarizer: Optional AsyncSummarizer.
+        - transcription_workers: Number of Whisper worker processes.
+        - model_name: Whisper model the workers load.
+        - engine_factory: Optional picklable callable creating each worker's transcription engine
+          instead of a WhisperEngine, e.g. a stand-in model in benchmarks.
+        """
+        from app.speaker_index import SpeakerIndex
+
+        self.cache = cache or PipelineCache()
+        self.database = database or registry.get("database")
+        self.speaker_index = speaker_index or SpeakerIndex()
+        self.search_index = search_index or registry.get("search_index")
+        self.vector_store = vector_store or registry.get("vector_store")
+        self.storage_manager = storage_manager or StorageManager()
+        self.summarizer = summarizer or AsyncSummarizer(cache=self.cache)
+
+        # Reentrant, as a future that is already done runs its callback while the lock is held
+        self._lock = threading.RLock()
+        self._idle = threading.Condition(self._lock)
+        self._memos = {}
+
+        # Workers are spawned rather than forked, as other stages run threads in this process.
+        self._whisper = ProcessPoolExecutor(max_workers=max(1, transcription_workers), initializer=_init_worker,
+                                            initargs=(model_name, engine_factory), mp_context=multiprocessing.get_context("spawn"))
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="pipeline-summarize", daemon=True)
+        self._loop_thread.start()
+        self._executors = {
+            'transcribe': ThreadPoolExecutor(max(1, transcription_workers), thread_name_prefix="pipeline-transcribe"),
+            'embed': BatchExecutor(self._embed, PIPELINE_EMBEDDING_BATCH_SIZE, "embed"),
+            'identify': BatchExecutor(self._identify, PIPELINE_EMBEDDING_BATCH_SIZE, "identify"),
+            'metadata': ThreadPoolExecutor(PIPELINE_METADATA_WORKERS, thread_name_prefix="pipeline-metadata"),
+            'summarize': ThreadPoolExecutor(max(1, self.summarizer.concurrency), thread_name_prefix="pipeline-summarize"),
+            'index': BatchExecutor(self._index, PIPELINE_INDEX_BATCH_SIZE, "index"),
+        }
+
+    # Scheduling
+
+    def submit(self, audio_file_path):
+        """
+        Start processing a memo. A memo already in progress is not submitted twice.
+
+        Returns:
+        - The MemoState tracking the memo.
+        """
+        memo = MemoState(audio_file_path)
+        with self._lock:
+            current = self._memos.get(memo.memo_id)
+            if current is not None and not current.finished:
+                return current
+            self._memos[memo.memo_id] = memo
+        try:
+            self._resume(memo)
+        except Exception as e:
+            self._fail(memo, None, e)
+            return memo
+        with self._lock:
+            self._schedule(memo)
+        return memo
+
+    def _resume(self, memo):
+        """
+        Load the outputs of the stages checkpointed for the memo's current audio and parameters.
+        """
+        completed = self.database.completed_stages(memo.memo_id)
+        for stage, dependencies in STAGES.items():
+            # A stage's key covers its inputs, so it reruns whenever a stage it depends on would
+            parts = [self.cache.key(CACHE_STAGES.get(stage, stage), memo.audio_file_path)]
+            fingerprint = redaction_fingerprint() if stage in REDACTED_STAGES else None
+            if fingerprint is not None:
+                # Stored and summarized transcripts are redacted: new settings redo them
+                parts.append(fingerprint)
+            material = "\0".join(parts + [memo.stage_keys[dependency] for dependency in dependencies])
+            memo.stage_keys[stage] = hashlib.sha256(material.encode()).hexdigest()
+            if completed.get(stage) != memo.stage_keys[stage] or not memo.done.issuperset(dependencies):
+                continue
+            output = self._load_output(memo, stage)
+            if output is not None:
+                memo.outputs[stage] = output
+                memo.done.add(stage)
+        if memo.done:
+            log_event(f"Resuming {memo.memo_id}: {', '.join(sorted(memo.done))} already done")
+
+    def _load_output(self, memo, stage):
+        if stage == 'transcribe':
+            return load_transcription(memo.memo_id, self.storage_manager)
+        if stage == 'embed':
+            embeddings = self.database.load_embeddings(memo.memo_id)
+            return embeddings if embeddings.size else None
+        if stage == 'identify':
+            return self.speaker_index.speakers(memo.memo_id)
+        if stage == 'metadata':
+            return self.database.load(memo.memo_id, "metadata")
+        if stage == 'summarize':
+            return self.database.load(memo.memo_id, "summary")
+        return True
+
+    def _schedule(self, memo):
+        """
+        Submit every stage of the memo whose dependencies are done. Called with the lock held.
+        """
+        if memo.finished:
+            self._finish(memo)
+            return
+        for stage, dependencies in STAGES.items():
+            if stage in memo.done or stage in memo.running or not memo.done.issuperset(dependencies):
+                continue
+            memo.running.add(stage)
+            metrics.add("pipeline_queue_depth", 1, stage=stage)
+            if isinstance(self._executors[stage], BatchExecutor):
+                future = self._executors[stage].submit(memo)
+            else:
+                future = self._executors[stage].submit(self._run_stage, stage, memo)
+            future.add_done_callback(lambda future, memo=memo, stage=stage: self._completed(memo, stage, future))
+
+    def _run_stage(self, stage, memo):
+        with metrics.timer("pipeline_stage_seconds", stage=stage):
+            return getattr(self, "_" + stage)(memo)
+
+    def _completed(self, memo, stage, future):
+        metrics.add("pipeline_queue_depth", -1, stage=stage)
+        try:
+            output = future.result()
+            self.database.mark_stage_done(memo.memo_id, stage, memo.stage_keys[stage])
+        except Exception as e:
+            self._fail(memo, stage, e)
+            return
+        with self._lock:
+            memo.running.discard(stage)
+            memo.outputs[stage] = output
+            memo.done.add(stage)
+            if memo.error is None:
+                self._schedule(memo)
+            self._idle.notify_all()
+
+    def _fail(self, memo, stage, error):
+        log_event(f"Pipeline stage {stage or 'resume'} failed for {memo.memo_id}: {error}", level="error",
+                  memo_id=memo.memo_id, stage=stage)
+        metrics.inc("pipeline_stage_failures_total", stage=stage or "resume")
+        with self._lock:
+            memo.running.discard(stage)
+            if memo.error is None:
+                memo.error = f"{stage or 'resume'}: {error}"
+                self._finish(memo)
+            self._idle.notify_all()
+
+    def _finish(self, memo):
+        """
+        Record that a memo left the pipeline. Called with the lock held.
+        """
+        memo.finished_at = time.perf_counter()
+        seconds = memo.finished_at - memo.submitted_at
+        metrics.inc("pipeline_memos_total", status="done" if memo.error is None else "failed")
+        if memo.error is None:
+            metrics.observe("pipeline_memo_seconds", seconds)
+            log_event(f"Processed {memo.memo_id} in {seconds:.1f}s", memo_id=memo.memo_id, seconds=round(seconds, 3))
+        self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until every submitted memo has finished or failed, including its stages already running.
+
+        Returns:
+        - A dictionary mapping each memo ID to a dictionary with 'status' ('done' or 'failed'),
+          'error' and 'seconds' (submission to completion).
+        """
+        with self._lock:
+            self._idle.wait_for(lambda: all(memo.finished and not memo.running for memo in self._memos.values()),
+                                timeout=timeout)
+            return {memo_id: self._result(memo) for memo_id, memo in self._memos.items()}
+
+    def collect_finished(self):
+        """
+        Forget the memos that have left the pipeline, so a long-running pipeline does not keep their outputs.
+
+        Returns:
+        - The results of those memos, as returned by join().
+        """
+        with self._lock:
+            finished = {memo_id: memo for memo_id, memo in self._memos.items() if memo.finished and not memo.running}
+            for memo_id in finished:
+                del self._memos[memo_id]
+        return {memo_id: self._result(memo) for memo_id, memo in finished.items()}
+
+    @staticmethod
+    def _result(memo):
+        return {'status': 'done' if memo.error is None else 'failed', 'error': memo.error,
+                'seconds': round(memo.finished_at - memo.submitted_at, 3) if memo.finished_at else None}
+
+    def run(self, audio_file_paths):
+        """
+        Process a batch of memos and wait for all of them.
+        """
+        for audio_file_path in audio_file_paths:
+            self.submit(audio_file_path)
+        return self.join()
+
+    def close(self):
+        """
+        Wait for running stages, stop every worker and save the cache index.
+        """
+        self.join()
+        for executor in self._executors.values():
+            executor.shutdown()
+        self._whisper.shutdown()
+        self.cache.flush()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Stages
+
+    def _transcribe(self, memo):
+        transcription = self.cache.get("transcription", memo.audio_file_path)
+        if transcription is None:
+            result = self._whisper.submit(_transcribe_batch, [memo.audio_file_path]).result()[0]
+            record_transcription_metrics(result)
+            if result["error"] is not None:
+                raise RuntimeError(result["error"])
+            transcription = result["transcription"]
+            self.cache.put("transcription", memo.audio_file_path, transcription)
+        # The cache keeps Whisper's output; what is stored, indexed and summarized is redacted
+        transcription = redact(transcription)
+        save_transcription(transcription, memo.memo_id, self.storage_manager)
+        return transcription
+
+    def _embed(self, memos):
+        embeddings, pending = {}, []
+        for memo in memos:
+            cached = self.cache.get("embedding", memo.audio_file_path)
+            if cached is not None:
+                embeddings[memo.memo_id] = cached
+            else:
+                pending.append(memo)
+        if pending:
+            speech_segments = {}
+            computed = get_speaker_embedder().embed_files([memo.audio_file_path for memo in pending], speech_segments)
+            for memo in pending:
+                if memo.audio_file_path in computed:
+                    embeddings[memo.memo_id] = computed[memo.audio_file_path].tolist()
+                    self.cache.put("embedding", memo.audio_file_path, embeddings[memo.memo_id])
+                if memo.audio_file_path in speech_segments:
+                    # Saves the metadata stage decoding the file again
+                    self.cache.put("speech_segments", memo.audio_file_path, speech_segments[memo.audio_file_path])
+        self.database.bulk_save({'memo_id': memo_id, 'embeddings': embedding}
+                                for memo_id, embedding in embeddings.items())
+        return [embeddings[memo.memo_id] if memo.memo_id in embeddings else
+                RuntimeError(f"No speaker embeddings for {memo.audio_file_path}") for memo in memos]
+
+    def _identify(self, memos):
+        speakers = self.speaker_index.add_memos((memo.memo_id, memo.outputs['embed']) for memo in memos)
+        return [speakers[memo.memo_id] for memo in memos]
+
+    def _metadata(self, memo):
+        speech_segments = self.cache.get("speech_segments", memo.audio_file_path) if VAD_ENABLED else None
+        metadata = extract_metadata(memo.audio_file_path, memo.outputs['identify'], speech_segments)
+        if VAD_ENABLED and speech_segments is None:
+            self.cache.put("speech_segments", memo.audio_file_path, metadata['speech_segments'])
+        metadata = anonymize_metadata(metadata)
+        self.database.save_memo(memo.memo_id, metadata=metadata, timestamp=metadata.get('timestamp'),
+                                speakers=metadata.get('speakers'))
+        return metadata
+
+    def _summarize(self, memo):
+        # Also covers transcripts stored before redaction was enabled; redacted text passes unchanged
+        transcription = redact(memo.outputs['transcribe'])
+        # Keyed by the transcript summarized, so new transcription or redaction settings redo the summary
+        summary = self.cache.get_content("summary", transcription)
+        if summary is None:
+            summary = asyncio.run_coroutine_threadsafe(self.summarizer.summarize(transcription), self._loop).result()
+            self.cache.put_content("summary", transcription, summary)
+        self.storage_manager.save_data(summary, memo.memo_id, "summary")
+        self.database.save_memo(memo.memo_id, summary=summary)
+        return summary
+
+    def _index(self, memos):
+        documents = [(memo.memo_id, memo.outputs['transcribe']) for memo in memos]
+        self.database.bulk_save({'memo_id': memo_id, 'transcription': text} for memo_id, text in documents)
+        self.search_index.add_documents(documents)
+        self.vector_store.add_memos(documents)
+        self.cache.flush()
+        return [True] * len(memos)
+
+registry.register("memo_pipeline", MemoPipeline)
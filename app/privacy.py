@@ -1,6 +1,6 @@
 import hashlib
-from cryptography.fernet import Fernet
-from config import ANONYMIZATION_SALT, ENCRYPTION_KEY
+from app.config import ANONYMIZATION_SALT
+from app.crypto import crypto
 
 def anonymize_data(data):
     """
@@ -17,7 +17,7 @@ def anonymize_data(data):
 
 def encrypt_data(data):
     """
-    Encrypt data using Fernet symmetric encryption.
+    Encrypt data using Fernet symmetric encryption with ENCRYPTION_KEY.
     
     Parameters:
     - data: The data to be encrypted (e.g., a string or bytes).
@@ -25,15 +25,12 @@ def encrypt_data(data):
     Returns:
     - Encrypted data as bytes.
     """
-    fernet = Fernet(ENCRYPTION_KEY)
-    if isinstance(data, str):
-        data = data.encode()  # Ensure data is in bytes
-    encrypted_data = fernet.encrypt(data)
-    return encrypted_data
+    return crypto.encrypt(data)
 
 def decrypt_data(encrypted_data):
     """
-    Decrypt data that was encrypted with Fernet symmetric encryption.
+    Decrypt data that was encrypted with Fernet symmetric encryption, with ENCRYPTION_KEY or, during
+    a key rotation, one of ENCRYPTION_PREVIOUS_KEYS.
     
     Parameters:
     - encrypted_data: The encrypted data as bytes.
@@ -41,9 +38,7 @@ def decrypt_data(encrypted_data):
     Returns:
     - Decrypted data as bytes.
     """
-    fernet = Fernet(ENCRYPTION_KEY)
-    decrypted_data = fernet.decrypt(encrypted_data)
-    return decrypted_data
+    return crypto.decrypt(encrypted_data)
 
 def remove_sensitive_metadata(metadata):
     """
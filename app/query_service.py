@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.config import QUERY_CONCURRENCY, QUERY_MAX_PENDING, QUERY_ACK_SECONDS, QUERY_DEADLINE_SECONDS
+from app.metrics import metrics
+from app.utils import log_event
+
+ACKNOWLEDGEMENT_REPLY = "Working on it, this may take a moment..."
+ERROR_REPLY = "Sorry, I couldn't process your request. Please try again later."
+TIMEOUT_REPLY = "Sorry, that took too long to answer. Please try again later."
+BUSY_REPLY = "I'm handling a lot of questions right now. Please try again in a minute."
+
+metrics.describe("query_reply_seconds", "Time from receiving a query to sending its answer")
+metrics.describe("query_wait_seconds", "Time a query waited for a worker")
+
+class _Query:
+    __slots__ = ("message", "chat_id", "received", "state", "acknowledgement")
+
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat.id
+        self.received = time.monotonic()
+        self.state = "queued"  # then "running", and finally "answered" or "expired"
+        self.acknowledgement = None  # Future of the "working on it" reply, once one is sent
+
+class QueryService:
+    """
+    Answers chat queries on a pool of workers behind the Telegram poller or webhook.
+
+    The poller only enqueues each query, so a slow completion never holds up other chats or the
+    next update. Queries from the same chat are answered one at a time, in the order they were
+    sent; different chats are served concurrently by up to `concurrency` workers, taking turns,
+    so one busy chat cannot monopolise them.
+
+    A query still unanswered after `ack_seconds` gets a "working on it" reply, which is edited
+    into the answer once it is ready; fast answers are sent directly. A query unanswered after
+    `deadline_seconds` is given up on with an apology, and its late answer is dropped. Beyond
+    `max_pending` queued queries, new ones are turned away immediately.
+    """
+
+    def __init__(self, bot, answer, concurrency=QUERY_CONCURRENCY, max_pending=QUERY_MAX_PENDING,
+                 ack_seconds=QUERY_ACK_SECONDS, deadline_seconds=QUERY_DEADLINE_SECONDS):
+        """
+        Parameters:
+        - bot: The telebot.TeleBot replies are sent with.
+        - answer: Callable taking the query text and returning the reply text.
+        - concurrency: Maximum number of queries answered at once.
+        - max_pending: Maximum number of queries waiting for a worker.
+        - ack_seconds: Delay before a "working on it" reply. None disables acknowledgements.
+        - deadline_seconds: Time after which a query is given up on. None disables deadlines.
+        """
+        self.bot = bot
+        self.answer = answer
+        self.max_pending = max_pending
+        self.ack_seconds = ack_seconds
+        self.deadline_seconds = deadline_seconds
+        self._workers = ThreadPoolExecutor(max(1, concurrency), thread_name_prefix="query")
+        # Acknowledgements and timeouts are sent from here so the timer thread never waits on Telegram
+        self._sender = ThreadPoolExecutor(2, thread_name_prefix="query-reply")
+        self._lock = threading.Condition()
+        self._chats = {}  # chat ID -> deque of queued queries; present while the chat has a worker turn
+        self._pending = 0
+        self._timers = []  # heap of (due, sequence, kind, query)
+        self._sequence = itertools.count()
+        self._closed = False
+        self._timer_thread = threading.Thread(target=self._run_timers, name="query-timers", daemon=True)
+        self._timer_thread.start()
+
+    def submit(self, message):
+        """
+        Queue a query message.
+
+        Returns:
+        - False if the query was turned away because too many are waiting or the service is closing,
+          otherwise True.
+        """
+        query = _Query(message)
+        with self._lock:
+            if self._closed:
+                log_event("Dropping a query received while the query service is closing", level="warning")
+                return False
+            if self._pending >= self.max_pending:
+                metrics.inc("queries_total", outcome="rejected")
+                self._sender.submit(self._reply, query, BUSY_REPLY)
+                return False
+            self._pending += 1
+            metrics.set("query_pending", self._pending)
+            for kind, delay in (("ack", self.ack_seconds), ("deadline", self.deadline_seconds)):
+                if delay is not None:
+                    heapq.heappush(self._timers, (query.received + delay, next(self._sequence), kind, query))
+            self._lock.notify_all()
+            if query.chat_id in self._chats:
+                self._chats[query.chat_id].append(query)
+            else:
+                self._chats[query.chat_id] = deque([query])
+                self._workers.submit(self._serve_chat, query.chat_id)
+        return True
+
+    def _serve_chat(self, chat_id):
+        """
+        Answer the next query of a chat, then give the worker up to the next chat in line.
+        """
+        with self._lock:
+            query = self._chats[chat_id].popleft()
+            self._pending -= 1
+            metrics.set("query_pending", self._pending)
+            if query.state == "queued":
+                query.state = "running"
+        try:
+            if query.state == "running":
+                metrics.observe("query_wait_seconds", time.monotonic() - query.received)
+                self._answer(query)
+        finally:
+            with self._lock:
+                if self._chats[chat_id]:
+                    self._workers.submit(self._serve_chat, chat_id)
+                else:
+                    del self._chats[chat_id]
+                    self._lock.notify_all()
+
+    def _answer(self, query):
+        try:
+            text, outcome = self.answer(query.message.text), "answered"
+        except Exception as e:
+            log_event(f"Error while handling query: {e}", level="error")
+            text, outcome = ERROR_REPLY, "error"
+        with self._lock:
+            if query.state == "expired":
+                log_event("Dropping an answer that arrived after its deadline", level="warning",
+                          seconds=round(time.monotonic() - query.received, 3))
+                return
+            query.state = "answered"
+        self._deliver(query, text)
+        metrics.inc("queries_total", outcome=outcome)
+        metrics.observe("query_reply_seconds", time.monotonic() - query.received)
+
+    def _run_timers(self):
+        with self._lock:
+            while not self._closed:
+                if not self._timers:
+                    self._lock.wait()
+                    continue
+                due, _, kind, query = self._timers[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._lock.wait(delay)
+                    continue
+                heapq.heappop(self._timers)
+                if query.state in ("answered", "expired"):
+                    continue
+                if kind == "ack" and query.acknowledgement is None:
+                    query.acknowledgement = self._sender.submit(self._reply, query, ACKNOWLEDGEMENT_REPLY)
+                elif kind == "deadline":
+                    query.state = "expired"
+                    metrics.inc("queries_total", outcome="expired")
+                    self._sender.submit(self._deliver, query, TIMEOUT_REPLY)
+
+    def _reply(self, query, text):
+        try:
+            return self.bot.reply_to(query.message, text)
+        except Exception as e:
+            log_event(f"Sending a reply failed: {e}", level="error")
+            return None
+
+    def _deliver(self, query, text):
+        """
+        Send the final reply to a query, as an edit of its acknowledgement if one was sent. An
+        acknowledgement still being sent is not waited for; the edit follows once it is.
+        """
+        if query.acknowledgement is None:
+            self._reply(query, text)
+        else:
+            query.acknowledgement.add_done_callback(lambda future: self._edit(query, future.result(), text))
+
+    def _edit(self, query, acknowledgement, text):
+        if acknowledgement is None:
+            self._reply(query, text)
+            return
+        try:
+            self.bot.edit_message_text(text, chat_id=query.chat_id, message_id=acknowledgement.message_id)
+        except Exception as e:
+            log_event(f"Editing the acknowledgement failed, replying instead: {e}", level="warning")
+            self._reply(query, text)
+
+    def close(self):
+        """
+        Finish the queued queries and stop the workers.
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: not self._chats)
+            self._closed = True
+            self._lock.notify_all()
+        self._workers.shutdown(wait=True)
+        self._timer_thread.join()
+        self._sender.shutdown(wait=True)
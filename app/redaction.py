@@ -0,0 +1,312 @@
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from app.config import ANONYMIZATION_SALT, REDACTION_ENABLED, REDACTION_TERMS_PATH, REDACTION_WORKERS
+from app.metrics import metrics
+from app.registry import registry
+from app.utils import anonymize_data
+
+# Bulk redaction hands each worker process batches of about this many characters, and runs inline below it
+BULK_BATCH_CHARACTERS = 1024 * 1024
+# Text held back at the end of each streamed chunk, in case a match continues into the next one. It
+# must be longer than any match; dictionary terms longer than a quarter of it extend it.
+STREAM_OVERLAP_CHARACTERS = 1024
+# Category of dictionary terms listed without one
+DEFAULT_TERM_CATEGORY = "NAME"
+# Whitespace inside a multi-word term or an address, bounded so matches stay shorter than the overlap
+_SPACE = r"\s{1,8}"
+
+# Category -> (gate, pattern). Matches start at the beginning of a word and are tried in this order,
+# then the dictionary terms; a pattern is only tried where its gate, a cheap lookahead, matches.
+PATTERNS = {
+    'EMAIL': (r"[\w.%+-]{1,64}@",
+              r"(?<![.+-])[a-z0-9._%+-]{1,64}@[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63}){0,4}\.[a-z]{2,24}(?![\w-])"),
+    'PHONE': (r"[\d(+]", r"(?<!\+)(?:\+\d{1,3}[ .-]?)?(?:\(\d{2,4}\)[ .-]?|\d{2,4}[ .-]?)\d{3,4}[ .-]?\d{3,4}(?!\w)"),
+    # A house number, capitalised street name words and a capitalised street type, so that "2 more
+    # days to drive" or "10 minutes down the road" are not taken for addresses
+    'ADDRESS': (r"\d", r"\d{1,6}(?-i:(?:" + _SPACE + r"[A-Z][a-z]+){1,4}" + _SPACE +
+                r"(?:Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct|Way|Place|Pl|"
+                r"Terrace|Parkway|Pkwy|Square|Sq|Highway|Hwy))\b\.?"),
+}
+
+metrics.describe("redaction_matches_total", "Personal information replaced with tokens, by category")
+metrics.describe("redaction_characters_total", "Characters of text scanned for personal information")
+
+def load_terms(path=REDACTION_TERMS_PATH):
+    """
+    Read a redaction dictionary: one term per line, optionally prefixed with a category ('ORG: Acme
+    Corp'). Blank lines and lines starting with '#' are skipped.
+
+    Returns:
+    - A dictionary mapping each category to its set of terms; empty if the file does not exist.
+    """
+    terms = {}
+    if not os.path.exists(path):
+        return terms
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            category, separator, term = line.partition(':')
+            if not separator or not re.fullmatch(r"[A-Za-z_]+", category.strip()):
+                category, term = DEFAULT_TERM_CATEGORY, line
+            terms.setdefault(category.strip().upper(), set()).add(term.strip())
+    return terms
+
+def _trie_pattern(terms):
+    """
+    Compile terms into one regular expression shaped like their prefix trie, so matching at a
+    position follows a single path through the characters instead of trying every term in turn.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for character in " ".join(term.casefold().split()):
+            node = node.setdefault(character, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [(_SPACE if character == " " else re.escape(character)) + build(child)
+                    for character, child in sorted(node.items()) if character]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return "(?:" + pattern + ")?"
+        return pattern
+
+    return build(trie)
+
+def compile_pattern(terms):
+    """
+    Compile the built-in patterns and the dictionary terms into a single regular expression with
+    one named group per category, so text is scanned once whatever the number of terms.
+
+    The regular expression engine tries every alternative at every position, so the alternatives
+    share one word-start check, which fails at once inside words, and each pattern sits behind its
+    gate: at a typical word, only the email gate and the first letters of the trie are looked at.
+    """
+    groups = [f"(?={gate})(?P<{category}>{pattern})" for category, (gate, pattern) in PATTERNS.items()]
+    for category, category_terms in sorted(terms.items()):
+        category_terms = [term for term in category_terms if term.strip()]
+        if category_terms:
+            name = re.sub(r"\W", "_", category.upper())
+            groups.append(f"(?P<{name}>{_trie_pattern(category_terms)}(?!\\w))")
+    return re.compile(r"(?<!\w)(?:" + "|".join(groups) + ")", re.IGNORECASE)
+
+def normalize(category, value):
+    """
+    Reduce a match to the form its token is derived from, so that different spellings of the same
+    entity ('(555) 010-2000' and '555.010.2000', 'Ann Lee' and 'ann lee') get the same token.
+    """
+    if category == 'PHONE':
+        return re.sub(r"\D", "", value)
+    return " ".join(value.casefold().split())
+
+@functools.lru_cache(maxsize=65536)
+def entity_token(category, value, salt=ANONYMIZATION_SALT):
+    """
+    Return the stable token replacing an entity, e.g. '[PHONE_3fa2c1d4e5f6]'.
+    """
+    return f"[{category}_{anonymize_data(f'{category}:{value}', salt)[:12]}]"
+
+class Redactor:
+    """
+    Replaces personal information in text with stable salted tokens, in a single pass.
+
+    Phone numbers, email addresses, street addresses and dictionary terms (names, organisations,
+    places) are compiled into one regular expression, with the terms of each category arranged as
+    a prefix trie. Each match becomes a token derived from the salted hash of the normalised
+    entity, so every mention of the same person or number gets the same token across memos: the
+    redacted texts stay searchable and linkable without revealing who or what they are about.
+
+    redact() handles a text at a time, redact_stream() a long transcript as chunks of it arrive, and
+    redact_many() a corpus, across `workers` processes.
+    """
+
+    def __init__(self, terms=None, salt=ANONYMIZATION_SALT, terms_path=REDACTION_TERMS_PATH, workers=REDACTION_WORKERS):
+        """
+        Parameters:
+        - terms: Optional dictionary of category -> terms, or a list of names. Read from terms_path if omitted.
+        - salt: Salt of the entity tokens.
+        - terms_path: Dictionary file read when terms is omitted.
+        - workers: Number of processes redact_many() uses.
+        """
+        if terms is None:
+            terms = load_terms(terms_path)
+        elif not isinstance(terms, dict):
+            terms = {DEFAULT_TERM_CATEGORY: set(terms)}
+        self.terms = {category: sorted(category_terms) for category, category_terms in terms.items()}
+        self.salt = salt
+        self.workers = max(1, workers)
+        self.pattern = compile_pattern(self.terms)
+        # Identifies what this redactor replaces and with which tokens, for the cache and stage keys of redacted text
+        material = json.dumps({'terms': self.terms, 'salt': salt, 'patterns': PATTERNS}, sort_keys=True)
+        self.fingerprint = hashlib.sha256(material.encode()).hexdigest()[:16]
+        longest = max((len(term) for category_terms in self.terms.values() for term in category_terms), default=0)
+        self.overlap = max(STREAM_OVERLAP_CHARACTERS, 4 * longest)
+        self._pool = None
+
+    def _token(self, match, counts):
+        category = match.lastgroup
+        counts[category] += 1
+        return entity_token(category, normalize(category, match.group()), self.salt)
+
+    @staticmethod
+    def _record(counts, characters):
+        metrics.inc("redaction_characters_total", characters)
+        for category, count in counts.items():
+            metrics.inc("redaction_matches_total", count, category=category)
+
+    def redact(self, text):
+        """
+        Return the text with every match replaced by its entity token.
+        """
+        counts = Counter()
+        redacted = self.pattern.sub(lambda match: self._token(match, counts), text)
+        self._record(counts, len(text))
+        return redacted
+
+    def redact_stream(self, chunks):
+        """
+        Redact a text arriving in chunks, e.g. transcript segments as they are produced.
+
+        The last `overlap` characters of each chunk are held back and scanned again with the next,
+        so a phone number or a name split across two chunks is still found. The output is cut at
+        whitespace, never inside a match.
+
+        Yields:
+        - Redacted pieces whose concatenation is redact() of the concatenated chunks.
+        """
+        carry = ""
+        for chunk in chunks:
+            buffer = carry + chunk
+            cut = len(buffer) - self.overlap
+            if cut <= 0:
+                carry = buffer
+                continue
+            # Cut before a whitespace character, so the held back text starts where a word could
+            cut = max(buffer.rfind(" ", 0, cut), buffer.rfind("\n", 0, cut), buffer.rfind("\t", 0, cut), 0) or cut
+            counts, pieces, position = Counter(), [], 0
+            for match in self.pattern.finditer(buffer):
+                if match.start() >= cut:
+                    break
+                if match.end() > cut:
+                    # Could still grow with the next chunk: hold it back whole
+                    cut = match.start()
+                    break
+                pieces.append(buffer[position:match.start()])
+                pieces.append(self._token(match, counts))
+                position = match.end()
+            pieces.append(buffer[position:cut])
+            self._record(counts, cut)
+            carry = buffer[cut:]
+            yield "".join(pieces)
+        if carry:
+            yield self.redact(carry)
+
+    def redact_many(self, texts):
+        """
+        Redact many texts, in batches across the worker processes when there is enough text to be
+        worth it.
+
+        Returns:
+        - The redacted texts, in order.
+        """
+        texts = list(texts)
+        total = sum(len(text) for text in texts)
+        if self.workers == 1 or total < BULK_BATCH_CHARACTERS or len(texts) < 2:
+            return [self.redact(text) for text in texts]
+        # Contiguous batches of roughly equal size, at least a few per worker to even out stragglers
+        batch_characters = max(BULK_BATCH_CHARACTERS // 4, total // (self.workers * 4))
+        batches, batch, size = [], [], 0
+        for text in texts:
+            batch.append(text)
+            size += len(text)
+            if size >= batch_characters:
+                batches.append(batch)
+                batch, size = [], 0
+        if batch:
+            batches.append(batch)
+        redacted = []
+        for results, counts, characters in self._executor().map(_redact_batch, batches):
+            redacted.extend(results)
+            # Workers count in their own process; the totals are recorded here
+            self._record(Counter(counts), characters)
+        return redacted
+
+    def _executor(self):
+        if self._pool is None:
+            # Spawned rather than forked, as the application runs threads
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                             initargs=(self.terms, self.salt),
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def close(self):
+        """
+        Stop the worker processes, if redact_many() started them.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+# Redactor owned by a bulk worker process; set by _init_worker.
+_worker_redactor = None
+
+def _init_worker(terms, salt):
+    global _worker_redactor
+    _worker_redactor = Redactor(terms, salt, workers=1)
+
+def _redact_batch(texts):
+    counts = Counter()
+    results = [_worker_redactor.pattern.sub(lambda match: _worker_redactor._token(match, counts), text)
+               for text in texts]
+    return results, dict(counts), sum(len(text) for text in texts)
+
+registry.register("redactor", Redactor)
+
+def get_redactor():
+    """
+    Return the process-wide Redactor, creating it on first use.
+    """
+    return registry.get("redactor")
+
+def redaction_fingerprint():
+    """
+    Return the fingerprint of the process-wide Redactor, or None if REDACTION_ENABLED is off. Results
+    derived from redacted text include it in their keys, so they are recomputed when the terms, the
+    salt or the patterns change, or when redaction is turned on.
+    """
+    return get_redactor().fingerprint if REDACTION_ENABLED else None
+
+def redact(text):
+    """
+    Redact personal information from a text with the process-wide Redactor, unless REDACTION_ENABLED is off.
+    """
+    if not REDACTION_ENABLED or not text:
+        return text
+    return get_redactor().redact(text)
+
+def redact_many(texts):
+    """
+    Redact many texts at once with the process-wide Redactor, across its worker processes, unless
+    REDACTION_ENABLED is off.
+    """
+    texts = list(texts)
+    if not REDACTION_ENABLED:
+        return texts
+    return get_redactor().redact_many(texts)
+
+if __name__ == "__main__":
+    import sys
+
+    redactor = get_redactor()
+    for piece in redactor.redact_stream(iter(lambda: sys.stdin.read(64 * 1024), "")):
+        sys.stdout.write(piece)
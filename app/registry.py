@@ -0,0 +1,105 @@
+import threading
+import time
+from app.utils import log_event
+
+class ModelRegistry:
+    """
+    Process-wide registry of heavyweight models and clients (Whisper, the ECAPA speaker model, the
+    Telegram bot, the memo database and indexes), created on first use instead of at import.
+
+    Modules register a factory under a name when they are imported, which costs nothing; the
+    factory runs the first time get() asks for the name. Each name has its own lock, so two
+    threads asking for the same model load it once, while different models can load in parallel.
+    warm() loads models ahead of time, optionally in the background, so a long-running process
+    can pay the loading cost at startup rather than on its first request.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        """
+        Register the factory that creates an entry. An already created entry is kept.
+
+        Parameters:
+        - name: Name the entry is looked up by.
+        - factory: Callable without arguments that creates the entry.
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        """
+        Return an entry, creating it with its factory on first use.
+        """
+        if name in self._instances:
+            return self._instances[name]
+        with self._lock:
+            if name not in self._factories:
+                raise KeyError(f"Nothing is registered as {name!r}")
+            lock = self._locks[name]
+        with lock:
+            if name not in self._instances:
+                start = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                log_event(f"Loaded {name} in {time.perf_counter() - start:.2f}s")
+            return self._instances[name]
+
+    def set(self, name, instance):
+        """
+        Use an existing object for an entry, e.g. a stand-in model in benchmarks.
+        """
+        with self._lock:
+            self._locks.setdefault(name, threading.Lock())
+            self._instances[name] = instance
+
+    def is_loaded(self, name):
+        return name in self._instances
+
+    def names(self):
+        with self._lock:
+            return sorted(set(self._factories) | set(self._instances))
+
+    def warm(self, names=None, background=False):
+        """
+        Create entries ahead of their first use.
+
+        Parameters:
+        - names: Names of the entries to create; all registered entries if omitted.
+        - background: Create them in daemon threads and return immediately. Failures are logged,
+          and the entry is retried on its next get().
+
+        Returns:
+        - The started threads if background is set, otherwise None.
+        """
+        names = self.names() if names is None else list(names)
+        if not background:
+            for name in names:
+                self.get(name)
+            return None
+
+        def load(name):
+            try:
+                self.get(name)
+            except Exception as e:
+                log_event(f"Warming {name} failed: {e}")
+
+        threads = [threading.Thread(target=load, args=(name,), name=f"warm-{name}", daemon=True) for name in names]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def unload(self, name):
+        """
+        Drop a created entry, closing it if it has a close() method. It is recreated on the next get().
+        """
+        with self._lock:
+            instance = self._instances.pop(name, None)
+        if instance is not None and hasattr(instance, "close"):
+            instance.close()
+
+registry = ModelRegistry()
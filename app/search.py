@@ -0,0 +1,415 @@
+import json
+import mmap
+import os
+import re
+import threading
+import numpy as np
+from app.config import ENCRYPTION_KEY, SEARCH_INDEX_PATH
+from app.crypto import crypto
+from app.registry import registry
+from app.utils import check_and_create_directory, log_event
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset("a an and are as at be but by for if in into is it no not of on or so such that the their "
+                      "then there these they this to was will with i you me my we our um uh".split())
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Segments are grouped in size tiers, a tier holding segments of MERGE_FACTOR times as many
+# documents as the tier below; once a tier holds MERGE_FACTOR segments, they are merged into one of
+# the next tier. Each document is then rewritten about once per tier, log(N) times in all.
+MERGE_FACTOR = 8
+
+MANIFEST_FILE_NAME = "manifest.bin"
+
+def tokenize(text):
+    """
+    Split text into lowercase terms, dropping stopwords.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def make_snippet(text, query, width=300):
+    """
+    Return the passage of text around the first occurrence of a query term.
+
+    Parameters:
+    - text: The document text.
+    - query: The query string.
+    - width: Approximate length of the snippet in characters.
+
+    Returns:
+    - A snippet of the text, or its beginning if no query term occurs in it.
+    """
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in set(tokenize(query))]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - width // 3) if positions else 0
+    snippet = text[start:start + width].strip()
+    return ("..." if start > 0 else "") + snippet + ("..." if start + width < len(text) else "")
+
+class SearchIndex:
+    """
+    Incrementally maintained BM25 inverted index over memo transcripts.
+
+    Documents are written in immutable segments. Each segment is a postings file of separately
+    encrypted posting lists, an encrypted lexicon mapping terms to their list's offset and an
+    encrypted list of its documents. At query time the postings file is memory-mapped and only the
+    lists of the query terms are decrypted. The manifest only names the segments and the
+    tombstones, so a commit writes the new documents and little else.
+
+    Re-indexing or removing a memo tombstones its previous document. Segments of similar size are
+    merged, MERGE_FACTOR at a time (see MERGE_FACTOR), and a merge drops the tombstoned documents of
+    the segments it merges, together with their tombstones.
+    """
+
+    def __init__(self, index_path=SEARCH_INDEX_PATH, encryption_key=ENCRYPTION_KEY):
+        """
+        Parameters:
+        - index_path: Directory holding the index files.
+        - encryption_key: Fernet key the index encryption key is derived from.
+        """
+        check_and_create_directory(index_path)
+        self.index_path = index_path
+        self._aead = crypto.aead(b"voice-memo-search-index-v1", encryption_key)
+        self._lock = threading.RLock()
+        self._pending = []
+        self._manifest_mtime = None
+        self._segments = {}
+        # Segment name -> its documents as {ordinal: [memo_id, length]}; segments never change
+        self._segment_documents = {}
+        self._load_manifest()
+
+    # Encrypted files
+
+    def _encrypt(self, data, associated_data):
+        nonce = os.urandom(12)
+        return nonce + self._aead.encrypt(nonce, data, associated_data)
+
+    def _decrypt(self, payload, associated_data):
+        return self._aead.decrypt(bytes(payload[:12]), bytes(payload[12:]), associated_data)
+
+    def _write_file(self, name, data):
+        path = os.path.join(self.index_path, name)
+        with open(path + ".tmp", 'wb') as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _read_encrypted_json(self, name):
+        with open(os.path.join(self.index_path, name), 'rb') as file:
+            return json.loads(self._decrypt(file.read(), name.encode()))
+
+    def _write_encrypted_json(self, name, value):
+        self._write_file(name, self._encrypt(json.dumps(value).encode(), name.encode()))
+
+    # Manifest and segments
+
+    def _load_manifest(self):
+        path = os.path.join(self.index_path, MANIFEST_FILE_NAME)
+        if os.path.exists(path):
+            manifest = self._read_encrypted_json(MANIFEST_FILE_NAME)
+            self._manifest_mtime = os.path.getmtime(path)
+        else:
+            manifest = {'segments': [], 'deleted': [], 'next_segment': 0, 'next_ordinal': 0}
+        self._segment_names = manifest['segments']
+        self._deleted = set(manifest['deleted'])
+        self._next_segment = manifest['next_segment']
+        for name in list(self._segments):
+            if name not in self._segment_names:
+                self._close_segment(name)
+        for name in list(self._segment_documents):
+            if name not in self._segment_names:
+                del self._segment_documents[name]
+
+        # ordinal -> [memo_id, length], for the documents of every segment
+        self._documents = {}
+        if 'documents' in manifest:
+            # Written before segments listed their own documents: all of them are kept here until the
+            # next commit merges the segments
+            self._legacy_documents = dict(enumerate(manifest['documents']))
+            self._documents.update(self._legacy_documents)
+            self._next_ordinal = len(manifest['documents'])
+        else:
+            self._legacy_documents = None
+            self._next_ordinal = manifest['next_ordinal']
+            for name in self._segment_names:
+                self._documents.update(self._load_segment_documents(name))
+        self._ordinals = {memo_id: ordinal for ordinal, (memo_id, _) in self._documents.items()
+                          if ordinal not in self._deleted}
+        self._update_lengths()
+
+    def _load_segment_documents(self, name):
+        if name not in self._segment_documents:
+            self._segment_documents[name] = {ordinal: [memo_id, length] for ordinal, memo_id, length
+                                             in self._read_encrypted_json(name + ".documents")}
+        return self._segment_documents[name]
+
+    def _update_lengths(self):
+        self._lengths = np.zeros(self._next_ordinal, dtype=np.float32)
+        for ordinal, (_, length) in self._documents.items():
+            self._lengths[ordinal] = length
+
+    def _save_manifest(self):
+        manifest = {
+            'segments': self._segment_names,
+            'deleted': sorted(self._deleted),
+            'next_segment': self._next_segment,
+            'next_ordinal': self._next_ordinal,
+        }
+        if self._legacy_documents is not None:
+            manifest['documents'] = [self._legacy_documents.get(ordinal, ["", 0]) for ordinal in range(self._next_ordinal)]
+        self._write_encrypted_json(MANIFEST_FILE_NAME, manifest)
+        self._manifest_mtime = os.path.getmtime(os.path.join(self.index_path, MANIFEST_FILE_NAME))
+
+    def refresh(self):
+        """
+        Reload the index if another process committed to it since it was opened.
+        """
+        path = os.path.join(self.index_path, MANIFEST_FILE_NAME)
+        with self._lock:
+            if os.path.exists(path) and os.path.getmtime(path) != self._manifest_mtime:
+                self._load_manifest()
+
+    def _segment(self, name):
+        if name not in self._segments:
+            lexicon = self._read_encrypted_json(name + ".lexicon")
+            with open(os.path.join(self.index_path, name + ".postings"), 'rb') as file:
+                postings = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+            self._segments[name] = (lexicon, postings)
+        return self._segments[name]
+
+    def _close_segment(self, name):
+        _, postings = self._segments.pop(name)
+        if isinstance(postings, mmap.mmap):
+            postings.close()
+
+    def _postings(self, name, term):
+        """
+        Decrypt one term's posting list in a segment.
+
+        Returns:
+        - A tuple (ordinals, term_frequencies) of NumPy arrays; both empty if the term is absent.
+        """
+        lexicon, postings = self._segment(name)
+        if term not in lexicon:
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint16)
+        offset, length, count = lexicon[term]
+        data = self._decrypt(postings[offset:offset + length], f"{name}\0{term}".encode())
+        return (np.frombuffer(data, dtype=np.uint32, count=count),
+                np.frombuffer(data, dtype=np.uint16, count=count, offset=4 * count))
+
+    def _write_segment(self, postings_by_term, documents):
+        """
+        Write a new segment from a mapping of term -> (ordinals, term_frequencies) arrays and its
+        documents, a mapping of ordinal -> [memo_id, length].
+        """
+        name = f"segment_{self._next_segment:06d}"
+        self._next_segment += 1
+        lexicon, offset = {}, 0
+        with open(os.path.join(self.index_path, name + ".postings.tmp"), 'wb') as file:
+            for term, (ordinals, frequencies) in postings_by_term.items():
+                data = self._encrypt(ordinals.astype(np.uint32).tobytes() + frequencies.astype(np.uint16).tobytes(),
+                                     f"{name}\0{term}".encode())
+                file.write(data)
+                lexicon[term] = (offset, len(data), len(ordinals))
+                offset += len(data)
+        os.replace(os.path.join(self.index_path, name + ".postings.tmp"),
+                   os.path.join(self.index_path, name + ".postings"))
+        self._write_encrypted_json(name + ".lexicon", lexicon)
+        self._write_encrypted_json(name + ".documents", [[ordinal, memo_id, length] for ordinal, (memo_id, length)
+                                                          in sorted(documents.items())])
+        self._segment_documents[name] = documents
+        return name
+
+    def _delete_segment_files(self, name):
+        if name in self._segments:
+            self._close_segment(name)
+        self._segment_documents.pop(name, None)
+        for suffix in (".postings", ".lexicon", ".documents"):
+            path = os.path.join(self.index_path, name + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Indexing
+
+    def add_document(self, memo_id, text):
+        """
+        Queue a memo's transcript for indexing. It becomes searchable after commit().
+        """
+        with self._lock:
+            self._pending.append((str(memo_id), text))
+
+    def add_documents(self, documents):
+        """
+        Index several (memo_id, text) pairs and commit them as one new segment.
+        """
+        with self._lock:
+            self._pending.extend((str(memo_id), text) for memo_id, text in documents)
+            self.commit()
+
+    def commit(self):
+        """
+        Write the queued documents as a new segment, then merge the segments of any full size tier.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            self.refresh()
+            if self._legacy_documents is not None:
+                self._merge_segments(self._segment_names)
+            postings, documents = {}, {}
+            for memo_id, text in self._pending:
+                if memo_id in self._ordinals:
+                    self._deleted.add(self._ordinals[memo_id])
+                ordinal = self._next_ordinal
+                self._next_ordinal += 1
+                terms = tokenize(text)
+                documents[ordinal] = [memo_id, len(terms)]
+                self._ordinals[memo_id] = ordinal
+                counts = {}
+                for term in terms:
+                    counts[term] = counts.get(term, 0) + 1
+                for term, count in counts.items():
+                    postings.setdefault(term, ([], []))
+                    postings[term][0].append(ordinal)
+                    postings[term][1].append(min(count, 65535))
+            self._segment_names.append(self._write_segment(
+                {term: (np.array(ordinals), np.array(frequencies)) for term, (ordinals, frequencies) in postings.items()},
+                documents))
+            self._documents.update(documents)
+            log_event(f"Indexed {len(self._pending)} transcripts for search")
+            self._pending = []
+            self._update_lengths()
+            self._merge_tiers()
+            self._save_manifest()
+
+    def remove_document(self, memo_id):
+        """
+        Remove a memo from the index.
+        """
+        with self._lock:
+            ordinal = self._ordinals.pop(str(memo_id), None)
+            if ordinal is not None:
+                self._deleted.add(ordinal)
+                self._save_manifest()
+
+    @staticmethod
+    def _tier(document_count):
+        tier = 0
+        while document_count >= MERGE_FACTOR ** (tier + 1):
+            tier += 1
+        return tier
+
+    def _merge_tiers(self):
+        """
+        Merge the segments of each size tier that has MERGE_FACTOR of them, from the smallest tier up,
+        as a merged segment can fill the next tier.
+        """
+        while True:
+            tiers = {}
+            for name in self._segment_names:
+                tiers.setdefault(self._tier(len(self._segment_documents[name])), []).append(name)
+            full = [names for tier, names in sorted(tiers.items()) if len(names) >= MERGE_FACTOR]
+            if not full:
+                return
+            self._merge_segments(full[0])
+
+    def _merge_segments(self, names):
+        """
+        Merge segments into one, dropping the postings of deleted documents and their tombstones.
+        """
+        old_names = list(names)
+        if self._legacy_documents is not None:
+            documents = self._legacy_documents
+        else:
+            documents = {}
+            for name in old_names:
+                documents.update(self._segment_documents[name])
+        dropped = {ordinal for ordinal in documents if ordinal in self._deleted}
+        live = {ordinal: document for ordinal, document in documents.items() if ordinal not in dropped}
+        terms = set()
+        for name in old_names:
+            terms.update(self._segment(name)[0])
+        deleted = np.array(sorted(dropped), dtype=np.uint32)
+        merged = {}
+        for term in terms:
+            parts = [self._postings(name, term) for name in old_names]
+            ordinals = np.concatenate([part[0] for part in parts])
+            frequencies = np.concatenate([part[1] for part in parts])
+            keep = ~np.isin(ordinals, deleted)
+            if keep.any():
+                merged[term] = (ordinals[keep], frequencies[keep])
+        self._segment_names = [name for name in self._segment_names if name not in old_names]
+        if live:
+            self._segment_names.append(self._write_segment(merged, live))
+        # The merged segment no longer holds the deleted documents, so their tombstones can go
+        self._deleted -= dropped
+        for ordinal in dropped:
+            self._documents.pop(ordinal, None)
+        self._legacy_documents = None
+        self._update_lengths()
+        # Old segment files are only removed after the manifest points at the merged segment.
+        self._save_manifest()
+        for name in old_names:
+            self._delete_segment_files(name)
+        log_event(f"Merged {len(old_names)} search index segments, dropping {len(dropped)} deleted documents")
+
+    def reencrypt(self):
+        """
+        Rewrite the whole index with the current key during a key rotation, by merging its segments.
+        """
+        with self._lock:
+            self.refresh()
+            if self._segment_names:
+                self._merge_segments(self._segment_names)
+            else:
+                self._save_manifest()
+
+    # Querying
+
+    def search(self, query, k=5):
+        """
+        Rank indexed memos against a query with BM25.
+
+        Parameters:
+        - query: The query text.
+        - k: Number of results to return.
+
+        Returns:
+        - A list of up to k dictionaries with 'memo_id' and 'score', best match first.
+        """
+        self.refresh()
+        terms = set(tokenize(query))
+        with self._lock:
+            live_count = len(self._documents) - len(self._deleted)
+            if not terms or live_count <= 0:
+                return []
+            average_length = max(float(self._lengths.sum()) / len(self._documents), 1.0)
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths / average_length)
+            deleted = np.array(sorted(self._deleted), dtype=np.uint32)
+            scores = np.zeros(self._next_ordinal, dtype=np.float32)
+            for term in terms:
+                parts = [self._postings(name, term) for name in self._segment_names]
+                ordinals = np.concatenate([part[0] for part in parts]).astype(np.intp)
+                if not len(ordinals):
+                    continue
+                frequencies = np.concatenate([part[1] for part in parts]).astype(np.float32)
+                live = ~np.isin(ordinals, deleted)
+                ordinals, frequencies = ordinals[live], frequencies[live]
+                document_frequency = len(ordinals)
+                idf = np.log(1 + (live_count - document_frequency + 0.5) / (document_frequency + 0.5))
+                scores[ordinals] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norms[ordinals])
+
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [{'memo_id': self._documents[ordinal][0], 'score': float(scores[ordinal])} for ordinal in candidates]
+
+    def close(self):
+        with self._lock:
+            for name in list(self._segments):
+                self._close_segment(name)
+
+registry.register("search_index", SearchIndex)
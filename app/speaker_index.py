@@ -0,0 +1,295 @@
+import json
+import os
+import struct
+import threading
+import numpy as np
+from app.config import ANONYMIZATION_SALT, ENCRYPTION_KEY, SPEAKER_INDEX_PATH, SPEAKER_SIMILARITY_THRESHOLD
+from app.crypto import crypto
+from app.utils import anonymize_data, check_and_create_directory, log_event
+
+MANIFEST_FILE_NAME = "manifest.bin"
+EMBEDDINGS_FILE_NAME = "embeddings.bin"
+
+# Each append to the embeddings file is one record: ciphertext length, then nonce and ciphertext.
+_BLOCK_HEADER = struct.Struct(">I")
+
+def speaker_id(cluster):
+    """
+    Return the anonymized, stable ID of a speaker cluster.
+    """
+    return "spk_" + anonymize_data(f"speaker-cluster-{cluster}", ANONYMIZATION_SALT)[:16]
+
+class SpeakerIndex:
+    """
+    Incrementally clustered index of per-segment speaker embeddings.
+
+    Embeddings are L2-normalised float32 rows kept in one in-memory NumPy matrix and persisted as
+    encrypted append-only blocks, since voiceprints are biometric data. Clustering is online: a new
+    segment joins the cluster whose centroid is most similar if the cosine similarity reaches the
+    threshold, and otherwise starts a new cluster. Centroids are running means, so adding a memo
+    only touches the clusters its segments join and earlier assignments never change. Cluster
+    ordinals therefore never move, and speaker IDs derived from them stay stable across runs.
+    """
+
+    def __init__(self, index_path=SPEAKER_INDEX_PATH, threshold=SPEAKER_SIMILARITY_THRESHOLD,
+                 encryption_key=ENCRYPTION_KEY):
+        """
+        Parameters:
+        - index_path: Directory holding the index files.
+        - threshold: Minimum cosine similarity between a segment and a centroid for the segment to join it.
+        - encryption_key: Fernet key the index encryption key is derived from.
+        """
+        check_and_create_directory(index_path)
+        self.index_path = index_path
+        self.threshold = threshold
+        self._aead = crypto.aead(b"voice-memo-speaker-index-v1", encryption_key)
+        self._lock = threading.RLock()
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.index_path, name)
+
+    def _load(self):
+        if os.path.exists(self._path(MANIFEST_FILE_NAME)):
+            with open(self._path(MANIFEST_FILE_NAME), 'rb') as file:
+                payload = file.read()
+            manifest = json.loads(self._aead.decrypt(payload[:12], payload[12:], MANIFEST_FILE_NAME.encode()))
+        else:
+            manifest = {'rows': [], 'labels': [], 'deleted': [], 'blocks': 0, 'clusters': 0}
+        self._rows = manifest['rows']  # row -> [memo_id, segment]
+        self._labels = np.array(manifest['labels'], dtype=np.int32)
+        self._deleted = np.zeros(len(self._rows), dtype=bool)
+        self._deleted[manifest['deleted']] = True
+        self._blocks = manifest['blocks']
+        self._cluster_count = manifest['clusters']
+        self._memo_rows = {}
+        for row, (memo_id, _) in enumerate(self._rows):
+            if not self._deleted[row]:
+                self._memo_rows.setdefault(memo_id, []).append(row)
+
+        self._matrix = self._read_embeddings()
+        self._sums = None
+        self._counts = np.zeros(self._cluster_count, dtype=np.int64)
+        if self._matrix is not None:
+            live = ~self._deleted
+            self._sums = np.zeros((self._cluster_count, self._matrix.shape[1]), dtype=np.float64)
+            np.add.at(self._sums, self._labels[live], self._matrix[live])
+            self._counts = np.bincount(self._labels[live], minlength=self._cluster_count)
+
+    def _read_embeddings(self):
+        """
+        Decrypt the embedding blocks listed in the manifest into one matrix. Blocks past that count
+        come from an append whose manifest update never landed and are truncated on the next append.
+        """
+        self._embeddings_size = 0
+        if not self._blocks:
+            return None
+        blocks = []
+        with open(self._path(EMBEDDINGS_FILE_NAME), 'rb') as file:
+            for block in range(self._blocks):
+                (length,) = _BLOCK_HEADER.unpack(file.read(_BLOCK_HEADER.size))
+                payload = file.read(length)
+                data = self._aead.decrypt(payload[:12], payload[12:], f"{EMBEDDINGS_FILE_NAME}\0{block}".encode())
+                dimension = struct.unpack(">I", data[:4])[0]
+                blocks.append(np.frombuffer(data[4:], dtype=np.float32).reshape(-1, dimension))
+            self._embeddings_size = file.tell()
+        return np.concatenate(blocks)
+
+    def _append_block(self, vectors):
+        data = struct.pack(">I", vectors.shape[1]) + vectors.astype(np.float32).tobytes()
+        nonce = os.urandom(12)
+        payload = nonce + self._aead.encrypt(nonce, data, f"{EMBEDDINGS_FILE_NAME}\0{self._blocks}".encode())
+        with open(self._path(EMBEDDINGS_FILE_NAME), 'ab') as file:
+            file.truncate(self._embeddings_size)
+            file.write(_BLOCK_HEADER.pack(len(payload)) + payload)
+        self._embeddings_size += _BLOCK_HEADER.size + len(payload)
+        self._blocks += 1
+
+    def _save_manifest(self):
+        manifest = json.dumps({'rows': self._rows, 'labels': self._labels.tolist(),
+                               'deleted': np.flatnonzero(self._deleted).tolist(),
+                               'blocks': self._blocks, 'clusters': self._cluster_count}).encode()
+        nonce = os.urandom(12)
+        with open(self._path(MANIFEST_FILE_NAME + ".tmp"), 'wb') as file:
+            file.write(nonce + self._aead.encrypt(nonce, manifest, MANIFEST_FILE_NAME.encode()))
+        os.replace(self._path(MANIFEST_FILE_NAME + ".tmp"), self._path(MANIFEST_FILE_NAME))
+
+    def reencrypt(self):
+        """
+        Rewrite the embedding blocks and the manifest with the current key during a key rotation.
+        Blocks keep their numbering, so the manifest stays valid whichever file is replaced first.
+        """
+        with self._lock:
+            if self._blocks:
+                with open(self._path(EMBEDDINGS_FILE_NAME), 'rb') as source, \
+                        open(self._path(EMBEDDINGS_FILE_NAME + ".tmp"), 'wb') as target:
+                    for block in range(self._blocks):
+                        (length,) = _BLOCK_HEADER.unpack(source.read(_BLOCK_HEADER.size))
+                        payload = source.read(length)
+                        associated_data = f"{EMBEDDINGS_FILE_NAME}\0{block}".encode()
+                        data = self._aead.decrypt(payload[:12], payload[12:], associated_data)
+                        nonce = os.urandom(12)
+                        payload = nonce + self._aead.encrypt(nonce, data, associated_data)
+                        target.write(_BLOCK_HEADER.pack(len(payload)) + payload)
+                    self._embeddings_size = target.tell()
+                os.replace(self._path(EMBEDDINGS_FILE_NAME + ".tmp"), self._path(EMBEDDINGS_FILE_NAME))
+            self._save_manifest()
+
+    def __len__(self):
+        return int((~self._deleted).sum())
+
+    @property
+    def cluster_count(self):
+        return int((self._counts > 0).sum())
+
+    def _centroids(self):
+        counts = np.maximum(self._counts, 1)[:, None]
+        centroids = self._sums / counts
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        return (centroids / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def _delete_rows(self, memo_id):
+        rows = self._memo_rows.pop(str(memo_id), [])
+        if rows:
+            rows = np.array(rows)
+            self._deleted[rows] = True
+            np.subtract.at(self._sums, self._labels[rows], self._matrix[rows])
+            np.subtract.at(self._counts, self._labels[rows], 1)
+
+    def _assign(self, vectors):
+        """
+        Assign normalised segment embeddings to clusters, creating clusters as needed.
+
+        Segments are compared against all centroids in one matrix product; only those that match no
+        existing cluster are walked one by one so that segments of a new speaker within the same
+        memo end up in one new cluster.
+        """
+        labels = np.full(len(vectors), -1, dtype=np.int32)
+        if self._cluster_count:
+            similarities = vectors @ self._centroids().T
+            similarities[:, self._counts == 0] = -np.inf
+            best = np.argmax(similarities, axis=1)
+            matched = similarities[np.arange(len(vectors)), best] >= self.threshold
+            labels[matched] = best[matched]
+            np.add.at(self._sums, best[matched], vectors[matched])
+            np.add.at(self._counts, best[matched], 1)
+
+        for row in np.flatnonzero(labels < 0):
+            vector = vectors[row]
+            if self._cluster_count:
+                similarities = self._centroids() @ vector
+                similarities[self._counts == 0] = -np.inf
+                cluster = int(np.argmax(similarities))
+                if similarities[cluster] >= self.threshold:
+                    labels[row] = cluster
+                    self._sums[cluster] += vector
+                    self._counts[cluster] += 1
+                    continue
+            labels[row] = self._cluster_count
+            self._cluster_count += 1
+            self._sums = np.vstack([self._sums, vector[None, :].astype(np.float64)])
+            self._counts = np.append(self._counts, 1)
+        return labels
+
+    def add_memo(self, memo_id, embeddings):
+        """
+        Add a memo's segment embeddings, replacing any stored for it before.
+
+        Parameters:
+        - memo_id: Identifier of the memo.
+        - embeddings: An array of shape (segments, dimension).
+
+        Returns:
+        - The sorted speaker IDs of the clusters the memo's segments were assigned to.
+        """
+        return self.add_memos([(memo_id, embeddings)])[str(memo_id)]
+
+    def add_memos(self, memos):
+        """
+        Add several (memo_id, embeddings) pairs and persist the index once.
+
+        Returns:
+        - A dictionary mapping each memo ID to its sorted speaker IDs.
+        """
+        speakers = {}
+        with self._lock:
+            for memo_id, embeddings in memos:
+                memo_id = str(memo_id)
+                vectors = np.asarray(embeddings, dtype=np.float32)
+                if not vectors.size:
+                    speakers[memo_id] = []
+                    continue
+                vectors = vectors.reshape(-1, vectors.shape[-1])
+                vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+                if self._matrix is None:
+                    self._matrix = np.empty((0, vectors.shape[1]), dtype=np.float32)
+                    self._sums = np.zeros((0, vectors.shape[1]), dtype=np.float64)
+                elif vectors.shape[1] != self._matrix.shape[1]:
+                    raise ValueError(f"Speaker index stores {self._matrix.shape[1]}-dimensional embeddings, "
+                                     f"not {vectors.shape[1]}")
+
+                self._delete_rows(memo_id)
+                labels = self._assign(vectors)
+                start = len(self._rows)
+                self._append_block(vectors)
+                self._matrix = np.concatenate([self._matrix, vectors])
+                self._rows.extend([memo_id, segment] for segment in range(len(vectors)))
+                self._labels = np.concatenate([self._labels, labels])
+                self._deleted = np.concatenate([self._deleted, np.zeros(len(vectors), dtype=bool)])
+                self._memo_rows[memo_id] = list(range(start, start + len(vectors)))
+                speakers[memo_id] = sorted({speaker_id(label) for label in labels})
+            self._save_manifest()
+        log_event(f"Added {len(speakers)} memos to the speaker index ({self.cluster_count} speakers)")
+        return speakers
+
+    def remove_memo(self, memo_id):
+        """
+        Remove a memo's segments from the index. Cluster IDs are kept even if a cluster becomes empty.
+        """
+        with self._lock:
+            self._delete_rows(memo_id)
+            self._save_manifest()
+
+    def speakers(self, memo_id):
+        """
+        Return the sorted speaker IDs of a memo's segments.
+        """
+        with self._lock:
+            rows = self._memo_rows.get(str(memo_id), [])
+            return sorted({speaker_id(label) for label in self._labels[rows]})
+
+    def memos_with_speaker(self, speaker, threshold=None):
+        """
+        Find the memos in which a speaker occurs.
+
+        Parameters:
+        - speaker: A speaker ID, or an embedding of the speaker's voice (shape (dimension,) or (1, dimension)).
+        - threshold: Minimum cosine similarity between the embedding and a segment. Defaults to the
+          clustering threshold. Ignored when a speaker ID is given.
+
+        Returns:
+        - A list of dictionaries with 'memo_id' and 'score' (the best segment similarity, or the share of
+          the memo's segments assigned to the speaker for a speaker ID), best match first.
+        """
+        with self._lock:
+            if self._matrix is None or not len(self):
+                return []
+            if isinstance(speaker, str):
+                clusters = [cluster for cluster in range(self._cluster_count) if speaker_id(cluster) == speaker]
+                if not clusters:
+                    return []
+                scores = (self._labels == clusters[0]).astype(np.float32)
+                aggregate, threshold = np.mean, 1.0
+            else:
+                query = np.asarray(speaker, dtype=np.float32).reshape(-1)
+                query = query / max(float(np.linalg.norm(query)), 1e-12)
+                scores = self._matrix @ query
+                aggregate = np.max
+                threshold = self.threshold if threshold is None else threshold
+
+            rows = np.flatnonzero(~self._deleted & (scores >= threshold))
+            matches = {}
+            for memo_id in {self._rows[row][0] for row in rows}:
+                matches[memo_id] = float(aggregate(scores[self._memo_rows[memo_id]]))
+        return [{'memo_id': memo_id, 'score': score}
+                for memo_id, score in sorted(matches.items(), key=lambda item: -item[1])]
@@ -1,44 +1,203 @@
+import io
 import os
 import json
-from cryptography.fernet import Fernet
+import struct
+import tempfile
+from contextlib import contextmanager
+from cryptography.exceptions import InvalidTag
 from app.config import STORAGE_PATH, ENCRYPTION_KEY
+from app.crypto import aes_gcm, crypto
 from app.utils import check_and_create_directory, log_event
 
+# Streaming format: a header (magic, chunk size, random nonce prefix) followed by records of
+# (final flag, ciphertext length, AES-GCM ciphertext). Each chunk's nonce is the prefix plus the
+# chunk counter and the final flag, and the header is authenticated with every chunk, so
+# reordered, truncated or spliced streams fail to decrypt.
+STREAM_MAGIC = b"VMS1"
+STREAM_CHUNK_SIZE = 64 * 1024
+_STREAM_HEADER = struct.Struct(">4sI7s")
+_STREAM_RECORD = struct.Struct(">?I")
+STREAM_KEY_INFO = b"voice-memo-storage-stream-v1"
+
+def _stream_nonce(prefix, counter, final):
+    return prefix + struct.pack(">I?", counter, final)
+
+class EncryptedWriter:
+    """
+    File-like object that encrypts everything written to it in fixed-size authenticated chunks.
+    Only one chunk of plaintext is held in memory at a time.
+    """
+
+    def __init__(self, file, key, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Parameters:
+        - file: Binary file the stream is written to.
+        - key: AES-256 key, or an AES-GCM cipher such as a KeyRing.
+        - chunk_size: Plaintext bytes per authenticated chunk.
+        """
+        self._file = file
+        self._aead = aes_gcm(key) if isinstance(key, bytes) else key
+        self._chunk_size = chunk_size
+        self._prefix = os.urandom(7)
+        self._header = _STREAM_HEADER.pack(STREAM_MAGIC, chunk_size, self._prefix)
+        self._buffer = bytearray()
+        self._counter = 0
+        self.closed = False
+        self._file.write(self._header)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        # Keep the last chunk buffered so it can be written with the final flag on close.
+        while len(self._buffer) > self._chunk_size:
+            self._write_record(bytes(self._buffer[:self._chunk_size]), False)
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def _write_record(self, chunk, final):
+        ciphertext = self._aead.encrypt(_stream_nonce(self._prefix, self._counter, final), chunk, self._header)
+        self._file.write(_STREAM_RECORD.pack(final, len(ciphertext)))
+        self._file.write(ciphertext)
+        self._counter += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self.closed:
+            self._write_record(bytes(self._buffer), True)
+            self._buffer.clear()
+            self._file.close()
+            self.closed = True
+
+    def abort(self):
+        """
+        Close the underlying file without writing the final chunk, leaving an unreadable stream.
+        """
+        self._buffer.clear()
+        self._file.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class EncryptedReader(io.RawIOBase):
+    """
+    Readable binary file-like object that decrypts a stream written by EncryptedWriter chunk by chunk.
+    """
+
+    def __init__(self, file, key):
+        """
+        Parameters:
+        - file: Binary file positioned at the start of the stream.
+        - key: AES-256 key, or an AES-GCM cipher. With a KeyRing, the key that decrypts the first
+          chunk is used for the rest of the stream and is available as `cipher` once read.
+        """
+        super().__init__()
+        self._file = file
+        self._aead = aes_gcm(key) if isinstance(key, bytes) else key
+        self.cipher = None
+        self._header = file.read(_STREAM_HEADER.size)
+        if len(self._header) < _STREAM_HEADER.size:
+            raise ValueError("Encrypted stream header is truncated")
+        magic, _, self._prefix = _STREAM_HEADER.unpack(self._header)
+        if magic != STREAM_MAGIC:
+            raise ValueError("Not an encrypted storage stream")
+        self._chunks = self._decrypt_chunks()
+        self._pending = memoryview(b"")
+
+    def _decrypt_chunks(self):
+        counter = 0
+        while True:
+            record = self._file.read(_STREAM_RECORD.size)
+            if len(record) < _STREAM_RECORD.size:
+                raise ValueError("Encrypted stream is truncated")
+            final, length = _STREAM_RECORD.unpack(record)
+            ciphertext = self._file.read(length)
+            if len(ciphertext) < length:
+                raise ValueError("Encrypted stream is truncated")
+            nonce = _stream_nonce(self._prefix, counter, final)
+            if self.cipher is None:
+                yield self._decrypt_first(nonce, ciphertext)
+            else:
+                try:
+                    yield self.cipher.decrypt(nonce, ciphertext, self._header)
+                except InvalidTag:
+                    raise ValueError("Encrypted stream failed authentication") from None
+            if final:
+                if self._file.read(1):
+                    raise ValueError("Unexpected data after the end of the encrypted stream")
+                return
+            counter += 1
+
+    def _decrypt_first(self, nonce, ciphertext):
+        # Find the key the stream was written with, so later chunks are only tried against that one
+        for cipher in getattr(self._aead, "ciphers", (self._aead,)):
+            try:
+                plaintext = cipher.decrypt(nonce, ciphertext, self._header)
+            except InvalidTag:
+                continue
+            self.cipher = cipher
+            return plaintext
+        raise ValueError("Encrypted stream failed authentication")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
 class StorageManager:
+    # Data types written encrypted at rest
+    ENCRYPTED_DATA_TYPES = {'transcription', 'metadata', 'cache', 'voice_memos'}
+
     def __init__(self):
         self.storage_path = STORAGE_PATH
         self.encryption_key = ENCRYPTION_KEY
-        self.fernet = Fernet(self.encryption_key)
+        # Cached by the crypto service, and able to read records written before a key rotation
+        self.fernet = crypto.fernet()
+        self.stream_cipher = crypto.aead(STREAM_KEY_INFO)
 
     def save_data(self, data, file_name, data_type):
         """
         Save data (transcription, summary, or metadata) to a file, encrypted if sensitive.
 
         Parameters:
-        - data: The data to be saved.
+        - data: The data to be saved (a string, bytes, or a dictionary for metadata).
         - file_name: The name of the file to save the data to.
         - data_type: The type of data being saved ('transcription', 'summary', 'metadata').
         """
-        # Ensure the storage directory for the data type exists
-        storage_dir = os.path.join(self.storage_path, data_type)
-        check_and_create_directory(storage_dir)
-
-        # Define the full path for the file
-        file_path = os.path.join(storage_dir, file_name + (".json" if data_type == "metadata" else ".txt"))
-
-        # Convert data to string if it's not already
+        # Convert data to bytes if it's not already
         if isinstance(data, dict):
             data = json.dumps(data)
+        if isinstance(data, str):
+            data = data.encode()
 
-        # Encrypt data if it's sensitive
-        if data_type in ['transcription', 'metadata']:
-            data = self.fernet.encrypt(data.encode()).decode()
-
-        # Save the data
-        with open(file_path, 'w') as file:
+        with self.open_write(file_name, data_type) as file:
             file.write(data)
 
-        log_event(f"{data_type.capitalize()} saved to {file_path}")
+        log_event(f"{data_type.capitalize()} saved to {self._file_path(file_name, data_type)}")
 
     def load_data(self, file_name, data_type):
         """
@@ -51,16 +210,8 @@ class StorageManager:
         Returns:
         - The loaded data.
         """
-        # Define the full path for the file
-        file_path = os.path.join(self.storage_path, data_type, file_name + (".json" if data_type == "metadata" else ".txt"))
-
-        # Load the data
-        with open(file_path, 'r') as file:
-            data = file.read()
-
-        # Decrypt data if it was encrypted
-        if data_type in ['transcription', 'metadata']:
-            data = self.fernet.decrypt(data.encode()).decode()
+        with self.open_read(file_name, data_type) as file:
+            data = file.read().decode()
 
         # Convert data back from string if necessary
         if data_type == "metadata":
@@ -68,6 +219,158 @@ class StorageManager:
 
         return data
 
+    @contextmanager
+    def open_write(self, file_name, data_type):
+        """
+        Open a record for streaming writes. Sensitive data types are encrypted chunk by chunk.
+
+        The data is written to a temporary file of its own that replaces the record only once the
+        block exits without an error, so readers never see a partially written record and
+        concurrent writers of the same record do not write into each other's file.
+
+        Usage:
+            with storage_manager.open_write("memo", "transcription") as file:
+                file.write(b"...")
+        """
+        file_path = self._file_path(file_name, data_type)
+        check_and_create_directory(os.path.dirname(file_path))
+        # Named *.tmp so that list_data, which filters on the record extensions, never lists it
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(file_path) + ".",
+                                         dir=os.path.dirname(file_path))
+        file = os.fdopen(fd, 'wb')
+        writer = EncryptedWriter(file, self.stream_cipher) if data_type in self.ENCRYPTED_DATA_TYPES else file
+        try:
+            yield writer
+        except BaseException:
+            if isinstance(writer, EncryptedWriter):
+                writer.abort()
+            else:
+                writer.close()
+            os.remove(temp_path)
+            raise
+        writer.close()
+        os.replace(temp_path, file_path)
+
+    def open_read(self, file_name, data_type):
+        """
+        Open a record for streaming reads.
+
+        Returns:
+        - A readable binary file-like object yielding the decrypted content. Records written in the
+          older whole-file Fernet format are still readable, but are decrypted in memory.
+        """
+        file_path = self._file_path(file_name, data_type)
+        file = open(file_path, 'rb')
+        if data_type not in self.ENCRYPTED_DATA_TYPES:
+            return file
+        if file.read(len(STREAM_MAGIC)) == STREAM_MAGIC:
+            file.seek(0)
+            return EncryptedReader(file, self.stream_cipher)
+        file.seek(0)
+        with file:
+            return io.BytesIO(self.fernet.decrypt(file.read()))
+
+    def iter_data(self, file_name, data_type, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Iterate over a record's decrypted content in chunks of at most chunk_size bytes.
+        """
+        with self.open_read(file_name, data_type) as file:
+            yield from iter(lambda: file.read(chunk_size), b'')
+
+    def save_stream(self, chunks, file_name, data_type):
+        """
+        Save an iterable of byte chunks as a record without holding it all in memory.
+        """
+        with self.open_write(file_name, data_type) as file:
+            for chunk in chunks:
+                file.write(chunk)
+        log_event(f"{data_type.capitalize()} saved to {self._file_path(file_name, data_type)}")
+
+    def is_legacy_format(self, file_name, data_type):
+        """
+        Check whether an encrypted record is still in the whole-file Fernet format.
+        """
+        if data_type not in self.ENCRYPTED_DATA_TYPES:
+            return False
+        with open(self._file_path(file_name, data_type), 'rb') as file:
+            return file.read(len(STREAM_MAGIC)) != STREAM_MAGIC
+
+    def migrate_legacy_data(self, data_type):
+        """
+        Rewrite every record of a data type still stored in the Fernet format in the streaming format.
+
+        Returns:
+        - The number of records migrated.
+        """
+        migrated = 0
+        for file_name in self.list_data(data_type):
+            if self.is_legacy_format(file_name, data_type):
+                self.save_stream(self.iter_data(file_name, data_type), file_name, data_type)
+                migrated += 1
+        log_event(f"Migrated {migrated} {data_type} records to the streaming format")
+        return migrated
+
+    def reencrypt(self, file_name, data_type):
+        """
+        Rewrite an encrypted record with the current key if it was written with a previous key (or in
+        the Fernet format), streaming it so memory use does not grow with its size. A record saved
+        again while it is being rewritten keeps the newer content.
+
+        Returns:
+        - True if the record was rewritten, False if it was already encrypted with the current key.
+        """
+        if data_type not in self.ENCRYPTED_DATA_TYPES:
+            return False
+        file_path = self._file_path(file_name, data_type)
+        before = os.stat(file_path)
+        with self.open_read(file_name, data_type) as source:
+            first = source.read(STREAM_CHUNK_SIZE)
+            if getattr(source, "cipher", None) is self.stream_cipher.current:
+                return False
+            temp_path = file_path + ".rotate.tmp"
+            try:
+                with EncryptedWriter(open(temp_path, 'wb'), self.stream_cipher) as target:
+                    while first:
+                        target.write(first)
+                        first = source.read(STREAM_CHUNK_SIZE)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        after = os.stat(file_path)
+        if (after.st_ino, after.st_mtime_ns, after.st_size) != (before.st_ino, before.st_mtime_ns, before.st_size):
+            os.remove(temp_path)
+            return False
+        os.replace(temp_path, file_path)
+        return True
+
+    def list_data(self, data_type):
+        """
+        List the names of the records stored for a data type.
+        """
+        storage_dir = os.path.join(self.storage_path, data_type)
+        if not os.path.isdir(storage_dir):
+            return []
+        extension = ".json" if data_type == "metadata" else ".txt"
+        return sorted(name[:-len(extension)] for name in os.listdir(storage_dir) if name.endswith(extension))
+
+    def exists(self, file_name, data_type):
+        """
+        Check whether a stored record exists.
+        """
+        return os.path.exists(self._file_path(file_name, data_type))
+
+    def delete_data(self, file_name, data_type):
+        """
+        Delete a stored record if it exists.
+        """
+        file_path = self._file_path(file_name, data_type)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            log_event(f"{data_type.capitalize()} deleted from {file_path}")
+
+    def _file_path(self, file_name, data_type):
+        return os.path.join(self.storage_path, data_type, file_name + (".json" if data_type == "metadata" else ".txt"))
+
 if __name__ == "__main__":
     # Example usage
     storage_manager = StorageManager()
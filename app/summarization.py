@@ -1,7 +1,48 @@
-import openai
-from app.config import GPT_4_API_KEY, GPT_4_MODEL
+import asyncio
+import hashlib
+import os
+import random
+import re
+import time
+from app.config import (GPT_4_API_KEY, GPT_4_MODEL, SUMMARY_PROMPT_TEMPLATE, SUMMARY_PARAMETERS,
+                        ANSWER_PROMPT_TEMPLATE, ANSWER_PARAMETERS, OPENAI_API_BASE,
+                        SUMMARY_CONCURRENCY, OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE,
+                        SUMMARY_MAX_RETRIES, SUMMARY_CHUNK_TOKENS, CHUNK_SUMMARY_PROMPT_TEMPLATE,
+                        MERGE_SUMMARY_PROMPT_TEMPLATE, CHUNK_SUMMARY_PARAMETERS)
+from app.metrics import metrics
+from app.redaction import redact_many
+from app.registry import registry
+from app.storage import StorageManager
 from app.utils import load_json_file, save_json_file, log_event
-from typing import List
+from typing import Dict, List, Optional, Tuple
+
+# The openai package is imported where it is used rather than at module import: it pulls in aiohttp
+# and accounts for most of the bot's startup time.
+
+def retryable_errors():
+    """
+    Errors worth retrying: rate limiting, timeouts and transient server or connection failures.
+    """
+    import openai
+    return tuple(getattr(openai.error, name) for name in
+                 ('RateLimitError', 'Timeout', 'APIError', 'ServiceUnavailableError', 'APIConnectionError')
+                 if hasattr(openai.error, name))
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+# Fraction of the chunk budget a chunk reaches before a content-defined boundary may close it
+CHUNK_MIN_FRACTION = 0.25
+
+def _create_response_cache():
+    from app.cache import ResponseCache
+    return ResponseCache()
+
+registry.register("response_cache", _create_response_cache)
+
+def get_response_cache():
+    """
+    Return the process-wide ResponseCache in front of summaries and query answers, creating it on first use.
+    """
+    return registry.get("response_cache")
 
 def summarize_transcription(transcription: str) -> str:
     """
@@ -13,37 +54,382 @@ def summarize_transcription(transcription: str) -> str:
     Returns:
     - A string containing the summary of the transcription.
     """
+    prompt = SUMMARY_PROMPT_TEMPLATE.format(transcription=transcription)
+    cached = get_response_cache().get(prompt, GPT_4_MODEL, SUMMARY_PARAMETERS)
+    if cached is not None:
+        return cached
     try:
-        openai.api_key = GPT_4_API_KEY
-        response = openai.Completion.create(
-            model=GPT_4_MODEL,
-            prompt=f"Summarize the following voice memo:\n{transcription}",
-            temperature=0.5,
-            max_tokens=1000,
-            top_p=1.0,
-            frequency_penalty=0.0,
-            presence_penalty=0.0
-        )
+        import openai
+        with metrics.timer("completion_seconds", kind="summary"):
+            response = openai.Completion.create(
+                model=GPT_4_MODEL,
+                prompt=prompt,
+                api_key=GPT_4_API_KEY,
+                api_base=OPENAI_API_BASE,
+                **SUMMARY_PARAMETERS
+            )
         summary = response.choices[0].text.strip()
+        get_response_cache().put(prompt, GPT_4_MODEL, SUMMARY_PARAMETERS, summary)
         return summary
     except Exception as e:
         log_event(f"Error during summarization: {e}")
         raise RuntimeError(f"Summarization failed. See event log for details.")
 
-def batch_summarize_transcriptions(transcriptions: List[str]) -> List[str]:
+def answer_query(query: str, passages: List[str]) -> str:
+    """
+    Answer a question about the user's voice memos using GPT-4 and the retrieved passages.
+
+    Parameters:
+    - query: The user's question.
+    - passages: Relevant excerpts from the voice memo transcripts.
+
+    Returns:
+    - A string containing the answer.
+    """
+    context = "\n\n".join(f"[{number}] {passage}" for number, passage in enumerate(passages, 1))
+    # Keyed on the question within the retrieved context, so a rephrased question that retrieves
+    # the same passages can reuse the answer.
+    cache_context = ANSWER_PROMPT_TEMPLATE + context
+    cached = get_response_cache().get(query, GPT_4_MODEL, ANSWER_PARAMETERS, context=cache_context,
+                                      near_duplicates=True)
+    if cached is not None:
+        return cached
+    try:
+        import openai
+        with metrics.timer("completion_seconds", kind="answer"):
+            response = openai.Completion.create(
+                model=GPT_4_MODEL,
+                prompt=ANSWER_PROMPT_TEMPLATE.format(context=context, question=query),
+                api_key=GPT_4_API_KEY,
+                api_base=OPENAI_API_BASE,
+                **ANSWER_PARAMETERS
+            )
+        answer = response.choices[0].text.strip()
+        get_response_cache().put(query, GPT_4_MODEL, ANSWER_PARAMETERS, answer, context=cache_context)
+        return answer
+    except Exception as e:
+        log_event(f"Error while answering query: {e}")
+        raise RuntimeError(f"Query answering failed. See event log for details.")
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count for rate limiting (about four characters per token for English text).
+    """
+    return len(text) // 4 + 1
+
+def _is_chunk_boundary(piece: str, tokens: int, max_tokens: int) -> bool:
     """
-    Summarize a batch of transcriptions.
+    Whether a chunk may end after this sentence, decided by the sentence alone: true for a share of
+    sentences proportional to their length, so chunks average about half the budget past the minimum.
+    """
+    draw = int.from_bytes(hashlib.sha256(piece.encode()).digest()[:4], "big") / 2 ** 32
+    return draw < tokens / max(1, max_tokens // 2)
+
+def split_transcript(transcription: str, max_tokens: int = SUMMARY_CHUNK_TOKENS) -> List[str]:
+    """
+    Split a transcript into chunks of at most max_tokens (estimated), breaking between sentences.
+    A sentence longer than the budget is broken between words.
+
+    Chunk boundaries are content-defined: a chunk ends after a sentence whose hash marks it as a
+    boundary, once it holds CHUNK_MIN_FRACTION of the budget, or before the sentence that would
+    overflow the budget. An edit therefore only changes the chunks around it, and the chunks after
+    it, whose chunk_summary cache entries are keyed by their text, are found again.
+
+    Parameters:
+    - transcription: The transcript text.
+    - max_tokens: Token budget per chunk.
+
+    Returns:
+    - A list of chunk strings.
+    """
+    pieces = []
+    for sentence in SENTENCE_BOUNDARY.split(transcription.strip()):
+        if estimate_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+            continue
+        words, piece = sentence.split(), []
+        for word in words:
+            if piece and estimate_tokens(" ".join(piece + [word])) > max_tokens:
+                pieces.append(" ".join(piece))
+                piece = []
+            piece.append(word)
+        if piece:
+            pieces.append(" ".join(piece))
+
+    chunks, current, current_tokens = [], [], 0
+    min_tokens = max_tokens * CHUNK_MIN_FRACTION
+    for piece in pieces:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+        if current_tokens >= min_tokens and _is_chunk_boundary(piece, tokens, max_tokens):
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+class TokenBucket:
+    """
+    Asynchronous token bucket refilled continuously at a per-minute rate.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1) -> None:
+        """
+        Wait until the bucket holds `amount` tokens and take them. Requests larger than the
+        bucket's capacity are clamped to it so they can still proceed.
+        """
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class AsyncSummarizer:
+    """
+    Concurrent summarizer that keeps within the account's request and token rate limits.
+
+    Up to `concurrency` requests are in flight at once. Each request first takes one request token and
+    its estimated prompt-plus-completion tokens from two token buckets. Retryable failures are retried
+    with exponential backoff and full jitter, and one failing item never fails the rest of a batch.
+
+    Transcripts longer than `chunk_tokens` are summarized map-reduce style: the chunks are summarized
+    concurrently, then the partial summaries are merged in groups, level by level, until one summary
+    remains. With a cache, every chunk and merge result is stored under the hash of its input, so
+    re-summarizing an edited transcript only pays for the parts that changed.
+    """
+
+    def __init__(self, concurrency: int = SUMMARY_CONCURRENCY, requests_per_minute: int = OPENAI_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = OPENAI_TOKENS_PER_MINUTE, max_retries: int = SUMMARY_MAX_RETRIES,
+                 api_base: Optional[str] = OPENAI_API_BASE, backoff_base: float = 1.0, backoff_cap: float = 60.0,
+                 chunk_tokens: int = SUMMARY_CHUNK_TOKENS, cache=None):
+        """
+        Parameters:
+        - concurrency: Maximum number of requests in flight.
+        - requests_per_minute: Request rate limit.
+        - tokens_per_minute: Token rate limit (prompt plus max_tokens).
+        - max_retries: Retries per item after the first attempt.
+        - api_base: Optional completion API endpoint override.
+        - backoff_base: Backoff ceiling in seconds for the first retry; it doubles on each retry.
+        - backoff_cap: Maximum backoff ceiling in seconds.
+        - chunk_tokens: Transcripts longer than this are summarized hierarchically, in chunks of this size.
+        - cache: Optional PipelineCache for chunk and merge summaries.
+        """
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.api_base = api_base
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.chunk_tokens = chunk_tokens
+        self.cache = cache
+        # asyncio primitives are bound to the running loop, so they are created per run.
+        self._semaphore = None
+        self._request_bucket = None
+        self._token_bucket = None
+
+    def _ensure_limits(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._request_bucket = TokenBucket(self.requests_per_minute)
+            self._token_bucket = TokenBucket(self.tokens_per_minute)
+
+    async def complete(self, prompt: str, **parameters) -> str:
+        """
+        Run one completion under the concurrency and rate limits, retrying transient failures.
+
+        Parameters:
+        - prompt: The prompt text.
+        - parameters: Completion parameters such as max_tokens and temperature.
+
+        Returns:
+        - The completion text.
+        """
+        import openai
+        self._ensure_limits()
+        cost = estimate_tokens(prompt) + parameters.get('max_tokens', 0)
+        retryable = retryable_errors()
+        for attempt in range(self.max_retries + 1):
+            async with self._semaphore:
+                with metrics.timer("completion_rate_limit_wait_seconds"):
+                    await self._request_bucket.acquire()
+                    await self._token_bucket.acquire(cost)
+                try:
+                    with metrics.timer("completion_seconds", kind="summary"):
+                        response = await openai.Completion.acreate(model=GPT_4_MODEL, prompt=prompt,
+                                                                   api_key=GPT_4_API_KEY, api_base=self.api_base,
+                                                                   **parameters)
+                    metrics.inc("completion_tokens_total", cost)
+                    return response.choices[0].text.strip()
+                except retryable as e:
+                    if attempt == self.max_retries:
+                        raise
+                    metrics.inc("completion_retries_total")
+                    log_event(f"Completion attempt {attempt + 1} failed, retrying: {e}", level="warning")
+            await asyncio.sleep(random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)))
+
+    async def summarize(self, transcription: str) -> str:
+        """
+        Summarize one transcription, hierarchically if it is longer than chunk_tokens.
+        """
+        if estimate_tokens(transcription) <= self.chunk_tokens:
+            return await self.complete(SUMMARY_PROMPT_TEMPLATE.format(transcription=transcription),
+                                       **SUMMARY_PARAMETERS)
+        return await self.summarize_hierarchically(transcription)
+
+    async def _cached_complete(self, stage: str, prompt: str, **parameters) -> str:
+        if self.cache is not None:
+            cached = self.cache.get_content(stage, prompt)
+            if cached is not None:
+                return cached
+        result = await self.complete(prompt, **parameters)
+        if self.cache is not None:
+            self.cache.put_content(stage, prompt, result)
+        return result
+
+    async def summarize_hierarchically(self, transcription: str) -> str:
+        """
+        Map-reduce summarization: summarize token-budgeted chunks concurrently, then merge the
+        partial summaries level by level. Latency grows with the depth of the merge tree rather
+        than with the length of the transcript.
+        """
+        chunks = split_transcript(transcription, self.chunk_tokens)
+        summaries = await asyncio.gather(*(
+            self._cached_complete("chunk_summary", CHUNK_SUMMARY_PROMPT_TEMPLATE.format(transcription=chunk),
+                                  **CHUNK_SUMMARY_PARAMETERS) for chunk in chunks))
+        while True:
+            groups = self._merge_groups(summaries)
+            final = len(groups) == 1
+            parameters = SUMMARY_PARAMETERS if final else CHUNK_SUMMARY_PARAMETERS
+            summaries = await asyncio.gather(*(
+                self._cached_complete("merge_summary",
+                                      MERGE_SUMMARY_PROMPT_TEMPLATE.format(summaries="\n\n".join(group)),
+                                      **parameters) for group in groups))
+            if final:
+                return summaries[0]
+
+    def _merge_groups(self, summaries: List[str]) -> List[List[str]]:
+        """
+        Group consecutive summaries so each group's prompt fits in chunk_tokens. Every group holds
+        at least two summaries (when there are two left) so each level shrinks the list.
+        """
+        groups, current, current_tokens = [], [], 0
+        for summary in summaries:
+            tokens = estimate_tokens(summary)
+            if len(current) >= 2 and current_tokens + tokens > self.chunk_tokens:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += tokens
+        if len(current) == 1 and groups:
+            groups[-1].append(current[0])
+        elif current:
+            groups.append(current)
+        return groups
+
+    async def summarize_many(self, transcriptions: List[str]) -> Tuple[List[Optional[str]], Dict[int, str]]:
+        """
+        Summarize many transcriptions concurrently.
+
+        Returns:
+        - A tuple (summaries, errors): summaries has one entry per transcription, None where it
+          failed, and errors maps the index of each failed transcription to its error message.
+        """
+        results = await asyncio.gather(*(self.summarize(transcription) for transcription in transcriptions),
+                                       return_exceptions=True)
+        summaries, errors = [], {}
+        for index, result in enumerate(results):
+            if isinstance(result, Exception):
+                errors[index] = str(result) or type(result).__name__
+                summaries.append(None)
+            else:
+                summaries.append(result)
+        return summaries, errors
+
+    def run(self, transcriptions: List[str]) -> Tuple[List[Optional[str]], Dict[int, str]]:
+        """
+        Synchronous entry point for summarize_many.
+        """
+        self._semaphore = None
+        return asyncio.run(self.summarize_many(transcriptions))
+
+def batch_summarize_transcriptions(transcriptions: List[str]) -> List[Optional[str]]:
+    """
+    Summarize a batch of transcriptions concurrently.
 
     Parameters:
     - transcriptions: A list of transcription texts to be summarized.
 
     Returns:
-    - A list of strings containing the summaries of the transcriptions.
+    - A list with the summary of each transcription, or None for those that failed (see the event log).
+    """
+    summaries, errors = AsyncSummarizer().run(transcriptions)
+    for index, error in errors.items():
+        log_event(f"Error during summarization of item {index}: {error}")
+    return summaries
+
+def summarize_all_transcriptions(audio_file_paths, cache=None, storage_manager=None, summarizer=None):
+    """
+    Summarize the saved transcription of each voice memo and store the summaries.
+
+    Parameters:
+    - audio_file_paths: Paths of the audio files whose transcriptions should be summarized.
+    - cache: Optional PipelineCache. Memos with a cached summary are not sent to GPT-4.
+    - storage_manager: Optional StorageManager used to save the summaries.
+    - summarizer: Optional AsyncSummarizer used for the memos that are not cached.
+
+    Returns:
+    - A dictionary mapping each audio file path to its summary. Memos whose summarization
+      failed are left out.
     """
-    summaries = []
-    for transcription in transcriptions:
-        summary = summarize_transcription(transcription)
-        summaries.append(summary)
+    from app.transcription import load_transcription
+
+    storage_manager = storage_manager or StorageManager()
+    audio_file_paths = list(audio_file_paths)
+    loaded = [load_transcription(os.path.splitext(os.path.basename(audio_file_path))[0], storage_manager) or ""
+              for audio_file_path in audio_file_paths]
+    # Transcripts stored before redaction was enabled are redacted before they are sent to GPT-4,
+    # in bulk across the redaction workers; redacted text passes unchanged
+    summaries, pending, transcriptions = {}, [], []
+    for audio_file_path, transcription in zip(audio_file_paths, redact_many(loaded)):
+        # Keyed by the transcript, so a memo transcribed again with other settings is summarized again
+        cached = cache.get_content("summary", transcription) if cache else None
+        if cached is not None:
+            summaries[audio_file_path] = cached
+        else:
+            pending.append(audio_file_path)
+            transcriptions.append(transcription)
+
+    if pending:
+        results, errors = (summarizer or AsyncSummarizer(cache=cache)).run(transcriptions)
+        for index, error in errors.items():
+            log_event(f"Summarization failed for {pending[index]}: {error}")
+        for audio_file_path, transcription, summary in zip(pending, transcriptions, results):
+            if summary is None:
+                continue
+            if cache:
+                cache.put_content("summary", transcription, summary)
+            summaries[audio_file_path] = summary
+
+    for audio_file_path, summary in summaries.items():
+        file_name = os.path.splitext(os.path.basename(audio_file_path))[0]
+        storage_manager.save_data(summary, file_name, "summary")
     return summaries
 
 if __name__ == "__main__":
@@ -1,7 +1,157 @@
+import multiprocessing
 import subprocess
+import sys
 import os
-from app.utils import check_and_create_directory, load_json_file, save_json_file, log_event
-from app.config import WHISPER_MODEL, STORAGE_PATH
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from app.utils import (load_json_file, save_json_file, log_event, get_audio_duration,
+                       iter_audio_windows)
+from app.config import (WHISPER_MODEL, STORAGE_PATH, AUDIO_STORAGE_PATH, TRANSCRIPTION_WORKERS,
+                        TRANSCRIPTION_QUEUE_SIZE, TRANSCRIPTION_BATCH_SECONDS, TRANSCRIPTION_WINDOW_SECONDS,
+                        TRANSCRIPTION_WINDOW_OVERLAP_SECONDS, VAD_ENABLED)
+from app.metrics import metrics
+from app.registry import registry
+from app.storage import StorageManager
+from app.vad import iter_speech_segments
+
+AUDIO_EXTENSIONS = ('.m4a', '.mp3', '.wav', '.aac', '.flac', '.ogg', '.oga')
+
+# Whisper models take 16 kHz mono input
+WHISPER_SAMPLE_RATE = 16000
+# Carried over from one window to the next as the decoding prompt, for continuity across windows
+PROMPT_CONTEXT_CHARACTERS = 200
+
+class WhisperEngine:
+    """
+    Long-lived transcription engine that keeps a single Whisper model loaded in memory.
+
+    The installation check and the model load happen once, at construction, so
+    transcribing many files only pays the per-file inference cost. Recordings are decoded and
+    transcribed piece by piece, so memory does not grow with their length and the first
+    segments are available before the whole file has been decoded. Silence is skipped by voice
+    activity detection, so the model only runs on speech.
+    """
+
+    def __init__(self, model_name=WHISPER_MODEL, device=None, window_seconds=TRANSCRIPTION_WINDOW_SECONDS,
+                 overlap_seconds=TRANSCRIPTION_WINDOW_OVERLAP_SECONDS, vad=VAD_ENABLED):
+        """
+        Parameters:
+        - model_name: Name of the Whisper model to load (e.g. 'whisper-large-v3').
+        - device: Optional torch device to run the model on ('cpu', 'cuda'). Whisper picks one if omitted.
+        - window_seconds: Length of the audio windows transcribed at a time.
+        - overlap_seconds: Audio shared by consecutive windows when vad is off.
+        - vad: Transcribe only the speech found by voice activity detection, in segments of at most window_seconds.
+        """
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.vad = vad
+        # Seconds of audio run through the model so far (only speech, with voice activity detection)
+        self.audio_seconds = 0.0
+        check_whisper_installation()
+        import whisper
+
+        self.model_name = model_name
+        # The whisper package names its checkpoints without the 'whisper-' prefix used in config.
+        checkpoint = model_name[len("whisper-"):] if model_name.startswith("whisper-") else model_name
+        try:
+            self.model = whisper.load_model(checkpoint, device=device)
+        except Exception as e:
+            log_event(f"Error loading Whisper model {model_name}: {e}")
+            raise RuntimeError(f"Could not load Whisper model {model_name}. See event log for details.")
+        log_event(f"Whisper model {model_name} loaded")
+
+    def transcribe(self, audio_file_path, **options):
+        """
+        Transcribe an audio file with the loaded model.
+
+        Parameters:
+        - audio_file_path: Path to the audio file to be transcribed.
+        - options: Extra decoding options passed through to Whisper (e.g. language='en').
+
+        Returns:
+        - A string containing the transcription of the audio file.
+        """
+        return " ".join(segment["text"] for segment in self.transcribe_stream(audio_file_path, **options)).strip()
+
+    def _chunks(self, audio_file_path):
+        """
+        Yield the audio to transcribe as (offset_seconds, audio, keep_from, keep_until) tuples, where
+        only Whisper segments whose midpoint lies in [keep_from, keep_until) are kept.
+
+        With voice activity detection, these are the speech segments, which do not overlap. Without
+        it, they are overlapping windows, and a segment in an overlap is kept from the window whose
+        edge it is further from, so every stretch of speech is reported once.
+        """
+        if self.vad:
+            for start, _, audio in iter_speech_segments(audio_file_path, WHISPER_SAMPLE_RATE,
+                                                        max_segment_seconds=self.window_seconds):
+                yield start, audio, float("-inf"), float("inf")
+            return
+
+        margin = self.overlap_seconds / 2
+        windows = iter_audio_windows(audio_file_path, WHISPER_SAMPLE_RATE, self.window_seconds, self.overlap_seconds)
+        window = next(windows, None)
+        while window is not None:
+            offset, audio = window
+            upcoming = next(windows, None)
+            yield (offset, audio, margin if offset > 0 else float("-inf"),
+                   len(audio) / WHISPER_SAMPLE_RATE - margin if upcoming is not None else float("inf"))
+            window = upcoming
+
+    def transcribe_stream(self, audio_file_path, **options):
+        """
+        Transcribe an audio file piece by piece, yielding segments as soon as their piece is done.
+
+        Parameters:
+        - audio_file_path: Path to the audio file to be transcribed.
+        - options: Extra decoding options passed through to Whisper (e.g. language='en').
+
+        Yields:
+        - Dictionaries with 'start' and 'end' (seconds from the start of the recording) and 'text'.
+        """
+        previous_text = ""
+        try:
+            for offset, audio, keep_from, keep_until in self._chunks(audio_file_path):
+                chunk_options = dict(options)
+                if previous_text and "initial_prompt" not in options:
+                    chunk_options["initial_prompt"] = previous_text[-PROMPT_CONTEXT_CHARACTERS:]
+                start = time.perf_counter()
+                result = self.model.transcribe(audio, **chunk_options)
+                self.audio_seconds += len(audio) / WHISPER_SAMPLE_RATE
+                metrics.inc("transcription_audio_seconds_total", len(audio) / WHISPER_SAMPLE_RATE)
+                metrics.inc("transcription_wall_seconds_total", time.perf_counter() - start)
+                for segment in result["segments"]:
+                    middle = (segment["start"] + segment["end"]) / 2
+                    if keep_from <= middle < keep_until and segment["text"].strip():
+                        previous_text += segment["text"]
+                        yield {"start": offset + segment["start"], "end": offset + segment["end"],
+                               "text": segment["text"].strip()}
+        except Exception as e:
+            log_event(f"Error during transcription: {e}")
+            raise RuntimeError(f"Transcription failed for {audio_file_path}. See event log for details.")
+
+        log_event(f"Transcription completed for {audio_file_path}")
+
+    def transcribe_many(self, audio_file_paths, **options):
+        """
+        Transcribe several audio files through the same loaded model.
+
+        Parameters:
+        - audio_file_paths: An iterable of audio file paths.
+        - options: Extra decoding options passed through to Whisper.
+
+        Returns:
+        - A list of transcriptions, in the same order as the input paths.
+        """
+        return [self.transcribe(path, **options) for path in audio_file_paths]
+
+registry.register("whisper", WhisperEngine)
+
+def get_transcription_engine():
+    """
+    Return the process-wide WhisperEngine, creating it on first use.
+    """
+    return registry.get("whisper")
 
 def transcribe_audio(audio_file_path):
     """
@@ -13,59 +163,228 @@ def transcribe_audio(audio_file_path):
     Returns:
     - A string containing the transcription of the audio file.
     """
-    try:
-        # Ensure the Whisper model is available and installed
-        check_whisper_installation()
-        
-        # Define the output path for the transcription
-        transcript_file_path = os.path.splitext(audio_file_path)[0] + ".txt"
-        
-        # Execute the Whisper model to transcribe the audio
-        command = f"whisper {audio_file_path} --model {WHISPER_MODEL} --output {transcript_file_path}"
-        process = subprocess.run(command, shell=True, check=True, text=True, capture_output=True)
-        
-        # Read and return the transcription
-        with open(transcript_file_path, 'r') as file:
-            transcription = file.read()
-        
-        log_event(f"Transcription completed for {audio_file_path}")
-        return transcription
-    except subprocess.CalledProcessError as e:
-        log_event(f"Error during transcription: {e}")
-        raise RuntimeError(f"Transcription failed for {audio_file_path}. See event log for details.")
+    return get_transcription_engine().transcribe(audio_file_path)
+
+# Engine owned by a scheduler worker process; set by _init_worker.
+_worker_engine = None
+
+def _init_worker(model_name, engine_factory=None):
+    global _worker_engine
+    _worker_engine = engine_factory() if engine_factory is not None else WhisperEngine(model_name)
+
+def _transcribe_batch(audio_file_paths):
+    """
+    Transcribe a batch of files inside a worker process. A failing file does not stop the batch.
+
+    Each result also reports the audio seconds transcribed and the wall time taken, since metrics
+    recorded in a worker process are not exported.
+    """
+    results = []
+    for audio_file_path in audio_file_paths:
+        start, audio_seconds = time.perf_counter(), _worker_engine.audio_seconds
+        try:
+            transcription, error = _worker_engine.transcribe(audio_file_path), None
+        except Exception as e:
+            transcription, error = None, str(e)
+        results.append({"audio_file_path": audio_file_path, "transcription": transcription, "error": error,
+                        "audio_seconds": _worker_engine.audio_seconds - audio_seconds,
+                        "seconds": time.perf_counter() - start})
+    return results
+
+def record_transcription_metrics(result):
+    """
+    Record the throughput reported in a _transcribe_batch result in this process's metrics.
+    """
+    metrics.inc("transcription_audio_seconds_total", result.get("audio_seconds", 0.0))
+    metrics.inc("transcription_wall_seconds_total", result.get("seconds", 0.0))
+    metrics.observe("transcription_file_seconds", result.get("seconds", 0.0),
+                    outcome="ok" if result["error"] is None else "error")
+
+class TranscriptionScheduler:
+    """
+    Runs transcription across a pool of worker processes, each holding its own WhisperEngine.
+
+    Work is submitted through a bounded window of in-flight batches so a stream of thousands of
+    paths never piles up in memory. Results are reported per file; failures are returned
+    alongside successes instead of aborting the run.
+    """
+
+    def __init__(self, workers=TRANSCRIPTION_WORKERS, queue_size=TRANSCRIPTION_QUEUE_SIZE,
+                 batch_seconds=TRANSCRIPTION_BATCH_SECONDS, model_name=WHISPER_MODEL, engine_factory=None):
+        """
+        Parameters:
+        - workers: Number of worker processes.
+        - queue_size: Maximum number of batches queued or running at once.
+        - batch_seconds: Short clips are grouped into batches up to this total duration. 0 disables batching.
+        - model_name: Whisper model each worker loads.
+        - engine_factory: Optional picklable callable creating each worker's engine instead of a
+          WhisperEngine, e.g. a stand-in model in benchmarks.
+        """
+        self.workers = max(1, workers)
+        self.queue_size = max(self.workers, queue_size)
+        self.batch_seconds = batch_seconds
+        self.model_name = model_name
+        self.engine_factory = engine_factory
+
+    def _batches(self, audio_file_paths):
+        """
+        Group consecutive short clips into batches. Clips of unknown or long duration run alone.
+        """
+        if not self.batch_seconds:
+            for audio_file_path in audio_file_paths:
+                yield [audio_file_path]
+            return
+
+        batch, batch_duration = [], 0.0
+        for audio_file_path in audio_file_paths:
+            duration = get_audio_duration(audio_file_path)
+            if duration is None or duration >= self.batch_seconds:
+                yield [audio_file_path]
+                continue
+            if batch and batch_duration + duration > self.batch_seconds:
+                yield batch
+                batch, batch_duration = [], 0.0
+            batch.append(audio_file_path)
+            batch_duration += duration
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _collect(done, submitted):
+        for future in done:
+            batch = submitted.pop(future)
+            try:
+                yield from future.result()
+            except Exception as e:
+                # The worker itself died (e.g. the model failed to load); report every file in the batch.
+                log_event(f"Transcription worker failed: {e}")
+                for audio_file_path in batch:
+                    yield {"audio_file_path": audio_file_path, "transcription": None, "error": str(e)}
+
+    def run(self, audio_file_paths):
+        """
+        Transcribe a list or stream of audio files.
+
+        Parameters:
+        - audio_file_paths: An iterable of audio file paths. It is consumed lazily.
+
+        Returns:
+        - A generator of result dictionaries with 'audio_file_path', 'transcription' and 'error'
+          keys, yielded in completion order.
+        """
+        submitted = {}
+        # Workers are spawned rather than forked: the parent may be loading other models in
+        # background threads, and forking while they hold import or torch locks can deadlock.
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(self.model_name, self.engine_factory),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            for batch in self._batches(audio_file_paths):
+                if len(submitted) >= self.queue_size:
+                    done, _ = wait(submitted, return_when=FIRST_COMPLETED)
+                    yield from self._collect(done, submitted)
+                submitted[pool.submit(_transcribe_batch, batch)] = batch
+            while submitted:
+                done, _ = wait(submitted, return_when=FIRST_COMPLETED)
+                yield from self._collect(done, submitted)
+
+def list_audio_files(audio_dir=AUDIO_STORAGE_PATH):
+    """
+    List the audio files stored in a directory, sorted by name.
+    """
+    if not os.path.isdir(audio_dir):
+        return []
+    return sorted(os.path.join(audio_dir, name) for name in os.listdir(audio_dir)
+                  if name.lower().endswith(AUDIO_EXTENSIONS))
+
+def transcribe_all_voice_memos(audio_dir=AUDIO_STORAGE_PATH, scheduler=None, cache=None):
+    """
+    Transcribe every imported voice memo and save the transcriptions.
+
+    Parameters:
+    - audio_dir: Directory containing the imported audio files.
+    - scheduler: Optional TranscriptionScheduler; one is built from config if omitted.
+    - cache: Optional PipelineCache. Memos with a cached transcription are not sent to Whisper.
+
+    Returns:
+    - A list of the audio file paths that were transcribed successfully.
+    """
+    transcribed, pending, failed = [], [], 0
+    for audio_file_path in list_audio_files(audio_dir):
+        cached = cache.get("transcription", audio_file_path) if cache else None
+        if cached is None:
+            pending.append(audio_file_path)
+            continue
+        file_name = os.path.splitext(os.path.basename(audio_file_path))[0]
+        save_transcription(cached, file_name)
+        transcribed.append(audio_file_path)
+
+    if pending:
+        scheduler = scheduler or TranscriptionScheduler()
+        for result in scheduler.run(pending):
+            audio_file_path = result["audio_file_path"]
+            record_transcription_metrics(result)
+            if result["error"] is not None:
+                failed += 1
+                log_event(f"Skipping {audio_file_path}: {result['error']}")
+                continue
+            file_name = os.path.splitext(os.path.basename(audio_file_path))[0]
+            save_transcription(result["transcription"], file_name)
+            if cache:
+                cache.put("transcription", audio_file_path, result["transcription"])
+            transcribed.append(audio_file_path)
+    log_event(f"Transcribed {len(transcribed)} voice memos ({len(transcribed) - len(pending) + failed} from cache), "
+              f"{failed} failed")
+    return transcribed
 
 def check_whisper_installation():
     """
     Check if the Whisper model is installed. If not, attempt to install it.
     """
     try:
-        subprocess.run(["whisper", "--help"], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
+        import whisper  # noqa: F401
+    except ImportError:
         log_event("Whisper model not found. Attempting to install.")
-        subprocess.run(["pip", "install", "whisper"], check=True)
+        subprocess.run([sys.executable, "-m", "pip", "install", "openai-whisper"], check=True)
         log_event("Whisper model installed successfully.")
 
-def save_transcription(transcription, file_name):
+def _legacy_transcription_path(file_name):
+    # Transcriptions used to be written here in plaintext
+    return os.path.join(STORAGE_PATH, "transcriptions", file_name + ".txt")
+
+def save_transcription(transcription, file_name, storage_manager=None):
     """
-    Save the transcription to a file.
+    Save the transcription, encrypted, as a 'transcription' record.
     
     Parameters:
     - transcription: The transcription text to be saved.
-    - file_name: The name of the file to save the transcription to.
+    - file_name: The name of the record to save the transcription to.
+    - storage_manager: Optional StorageManager; a new one is created if omitted.
     """
-    # Ensure the storage directory exists
-    storage_dir = os.path.join(STORAGE_PATH, "transcriptions")
-    check_and_create_directory(storage_dir)
-    
-    # Define the full path for the transcription file
-    file_path = os.path.join(storage_dir, file_name + ".txt")
-    
-    # Save the transcription
-    with open(file_path, 'w') as file:
-        file.write(transcription)
-    
-    log_event(f"Transcription saved to {file_path}")
-    return file_path  # Return the path where the transcription is saved
+    storage_manager = storage_manager or StorageManager()
+    storage_manager.save_data(transcription, file_name, "transcription")
+    # Do not leave a plaintext copy from an earlier version behind
+    if os.path.exists(_legacy_transcription_path(file_name)):
+        os.remove(_legacy_transcription_path(file_name))
+    log_event(f"Transcription saved for {file_name}")
+
+def load_transcription(file_name, storage_manager=None):
+    """
+    Load a transcription saved by save_transcription. A plaintext transcription left by an earlier
+    version is encrypted on the way.
+
+    Returns:
+    - The transcription text, or None if there is none.
+    """
+    storage_manager = storage_manager or StorageManager()
+    if storage_manager.exists(file_name, "transcription"):
+        return storage_manager.load_data(file_name, "transcription")
+    legacy_path = _legacy_transcription_path(file_name)
+    if not os.path.exists(legacy_path):
+        return None
+    with open(legacy_path, 'r') as file:
+        transcription = file.read()
+    save_transcription(transcription, file_name, storage_manager)
+    return transcription
 
 if __name__ == "__main__":
     # Example usage
@@ -1,43 +1,145 @@
-import telebot
-from app.config import TELEGRAM_BOT_TOKEN, SMS_API_KEY
-from app.storage import StorageManager
-from app.utils import decrypt_data, load_encryption_key
-from app.summarization import summarize_text
-from app.transcription import transcribe_audio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.config import (TELEGRAM_BOT_TOKEN, SMS_API_KEY, SEARCH_TOP_K, TELEGRAM_LONG_POLL_SECONDS, TELEGRAM_WEBHOOK_URL,
+                        TELEGRAM_WEBHOOK_LISTEN, TELEGRAM_WEBHOOK_PORT, TELEGRAM_WEBHOOK_SECRET, VOICE_NOTES_ENABLED)
+from app.metrics import metrics
+from app.query_service import QueryService
+from app.redaction import redact
+from app.registry import registry
+from app.search import make_snippet
+from app.vector_store import load_chunk_texts
+from app.summarization import answer_query, get_response_cache
+from app.utils import log_event
+from app.voice_notes import VoiceNoteService
 
-# Initialize the Telegram bot
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN)
+# Loaded in the background when the service starts, so the first query does not wait for them
+QUERY_DEPENDENCIES = ("database", "search_index", "vector_store", "response_cache")
+NO_RESULTS_REPLY = "I couldn't find any voice memos related to that."
 
-# Initialize the Storage Manager
-storage_manager = StorageManager()
+def create_bot(token=TELEGRAM_BOT_TOKEN):
+    """
+    Create the Telegram bot and register the message handlers on it.
+
+    Handlers run on the thread receiving updates; queries and voice notes are only queued there and
+    handled by the QueryService and the VoiceNoteService, so the bot needs no thread pool of its own.
+    """
+    import telebot
+
+    bot = telebot.TeleBot(token, threaded=False)
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(send_cache_stats, commands=['cachestats'])
+    if VOICE_NOTES_ENABLED:
+        bot.register_message_handler(handle_voice_note, content_types=['voice'])
+    bot.register_message_handler(handle_query, func=lambda message: True)
+    return bot
 
-# Load the encryption key for decrypting data
-encryption_key = load_encryption_key()
+registry.register("telegram_bot", create_bot)
+registry.register("query_service", lambda: QueryService(get_bot(), answer_message))
+registry.register("voice_note_service", lambda: VoiceNoteService(get_bot()))
+
+def get_bot():
+    """
+    Return the process-wide Telegram bot, creating it on first use.
+    """
+    return registry.get("telegram_bot")
 
-@bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
-    bot.reply_to(message, "Welcome to your Voice Memo AI Assistant. You can ask me about your voice memos or request summaries of them.")
+    get_bot().reply_to(message, "Welcome to your Voice Memo AI Assistant. You can ask me about your voice memos or request summaries of them.")
+
+def send_cache_stats(message):
+    stats = get_response_cache().stats()
+    get_bot().reply_to(message, f"Answer cache: {stats['hits']} hits, {stats['near_hits']} near-duplicate hits, "
+                                f"{stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries.")
+
+def answer_message(query):
+    """
+    Answer a question about the user's voice memos, searching through transcriptions and summaries
+    for relevant information.
+
+    Returns:
+    - The reply text.
+    """
+    with metrics.timer("query_seconds"):
+        # Stored transcripts are redacted, so names and numbers in the query are looked up by their tokens
+        query = redact(query)
+        database = registry.get("database")
+        # Retrieve the passages most similar to the query, then add keyword matches they missed
+        passages = load_chunk_texts(registry.get("vector_store").search(query, k=SEARCH_TOP_K, mode="ivf"), database)
+        for result in registry.get("search_index").search(query, k=SEARCH_TOP_K):
+            transcription = database.load(result['memo_id'], "transcription")
+            snippet = make_snippet(transcription, query) if transcription else None
+            if snippet and len(passages) < 2 * SEARCH_TOP_K and not any(snippet.strip(".") in p for p in passages):
+                passages.append(snippet)
+        if not passages:
+            return NO_RESULTS_REPLY
+
+        # Answer the question from the retrieved passages
+        return answer_query(query, passages)
 
-@bot.message_handler(func=lambda message: True)
 def handle_query(message):
     """
-    Handle user queries, searching through transcriptions and summaries for relevant information.
+    Queue a user query; the query service replies once it is answered.
     """
-    query = message.text
-    # For simplicity, this example assumes the user is asking for a summary of their latest memo.
-    # In a real application, you would implement more sophisticated query handling.
+    registry.get("query_service").submit(message)
+
+def handle_voice_note(message):
+    """
+    Queue a voice note; its reply shows the transcript as it is transcribed.
+    """
+    registry.get("voice_note_service").submit(message)
+
+def serve_webhook(bot, url=TELEGRAM_WEBHOOK_URL, listen=TELEGRAM_WEBHOOK_LISTEN, port=TELEGRAM_WEBHOOK_PORT,
+                  secret=TELEGRAM_WEBHOOK_SECRET):
+    """
+    Register a webhook with Telegram and serve the updates it pushes. Blocks until interrupted.
+
+    Telegram only delivers to HTTPS URLs, so `url` is expected to be a TLS-terminating proxy
+    forwarding to listen:port. Updates carrying the wrong secret token are rejected.
+    """
+    import telebot
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                self.send_error(403)
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            # Acknowledge first: handlers only queue work, and Telegram retries slow deliveries
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            try:
+                bot.process_new_updates([telebot.types.Update.de_json(body.decode())])
+            except Exception as e:
+                log_event(f"Handling a webhook update failed: {e}", level="error")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((listen, port), WebhookHandler)
+    server.daemon_threads = True
+    bot.remove_webhook()
+    bot.set_webhook(url=url, secret_token=secret)
+    log_event(f"Receiving Telegram updates through the webhook on {listen}:{port}")
     try:
-        # Load the latest transcription (assuming a naming convention or retrieving the latest file)
-        transcription = storage_manager.load_data("latest_transcription", "transcription")
-        transcription = decrypt_data(transcription, encryption_key)
-        
-        # Summarize the transcription
-        summary = summarize_text(transcription)
-        
-        # Send the summary back to the user
-        bot.reply_to(message, f"Summary of your latest voice memo: {summary}")
-    except Exception as e:
-        bot.reply_to(message, "Sorry, I couldn't process your request. Please try again later.")
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+def start_interaction_service():
+    """
+    Start serving Telegram queries, through a webhook if TELEGRAM_WEBHOOK_URL is set and by long
+    polling otherwise. Blocks until the bot is stopped.
+    """
+    # With voice notes on, the Whisper model loads too, so the first voice note is not held up by it
+    registry.warm(QUERY_DEPENDENCIES + (("whisper",) if VOICE_NOTES_ENABLED else ()), background=True)
+    metrics.start_exporter()
+    bot = get_bot()
+    registry.get("query_service")
+    if TELEGRAM_WEBHOOK_URL:
+        serve_webhook(bot)
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling(timeout=TELEGRAM_LONG_POLL_SECONDS + 5, long_polling_timeout=TELEGRAM_LONG_POLL_SECONDS)
 
 if __name__ == "__main__":
-    bot.polling()
+    start_interaction_service()
@@ -1,13 +1,153 @@
 import os
 import json
 import hashlib
+import atexit
+import functools
+import queue
+import threading
+import time
 from cryptography.fernet import Fernet
-import torchaudio
+from app.crypto import fernet_for
+
+# torchaudio pulls in torch, which takes seconds to import; it is only imported by the functions that
+# decode audio, so processes that never touch audio do not pay for it.
 
 def load_audio_file(file_path):
+    import torchaudio
     waveform, sample_rate = torchaudio.load(file_path)
     return waveform, sample_rate
 
+def load_audio_resampled(file_path, sample_rate):
+    """
+    Load an audio file as a mono waveform at the given sample rate.
+
+    Parameters:
+    - file_path: Path to the audio file.
+    - sample_rate: Target sample rate in Hz.
+
+    Returns:
+    - A 1-D float tensor.
+    """
+    import torchaudio
+    waveform, original_rate = load_audio_file(file_path)
+    waveform = waveform.mean(dim=0)
+    if original_rate != sample_rate:
+        waveform = torchaudio.functional.resample(waveform, original_rate, sample_rate)
+    return waveform
+
+def _decode_chunks(file_path, sample_rate, chunk_seconds):
+    """
+    Decode an audio file chunk by chunk as mono float32 NumPy arrays at the given sample rate.
+    """
+    try:
+        from torchaudio.io import StreamReader
+        reader = StreamReader(file_path)
+        reader.add_basic_audio_stream(frames_per_chunk=max(1, int(chunk_seconds * sample_rate)),
+                                      sample_rate=sample_rate)
+    except ImportError:
+        if not file_path.lower().endswith(".wav"):
+            raise
+        reader = None
+    except (RuntimeError, OSError) as e:
+        # torchaudio without its FFmpeg streaming backend: fall back to decoding the whole file.
+        log_event(f"Streaming decode unavailable for {file_path}, decoding it whole: {e}")
+        yield load_audio_resampled(file_path, sample_rate).numpy()
+        return
+    if reader is None:
+        # Without torchaudio, PCM WAV files are still decoded, with the standard library
+        yield from _decode_wav_chunks(file_path, sample_rate, chunk_seconds)
+        return
+    for (chunk,) in reader.stream():
+        if chunk is not None and len(chunk):
+            yield chunk.mean(dim=1).numpy()
+
+def _decode_wav_chunks(file_path, sample_rate, chunk_seconds):
+    """
+    Decode a PCM WAV file chunk by chunk as mono float32 NumPy arrays, resampling linearly if needed.
+    """
+    import wave
+    import numpy as np
+
+    dtypes = {1: np.uint8, 2: np.int16, 4: np.int32}
+    with wave.open(file_path, 'rb') as file:
+        channels, width, rate = file.getnchannels(), file.getsampwidth(), file.getframerate()
+        if width not in dtypes:
+            raise ValueError(f"Unsupported WAV sample width of {width} bytes in {file_path}")
+        scale = float(2 ** (8 * width - 1))
+        position = 0.0
+        while True:
+            frames = file.readframes(max(1, int(chunk_seconds * rate)))
+            if not frames:
+                return
+            samples = np.frombuffer(frames, dtype=dtypes[width]).astype(np.float32)
+            if width == 1:
+                samples -= 128
+            chunk = samples.reshape(-1, channels).mean(axis=1) / scale
+            if rate != sample_rate:
+                # Sample times continue across chunks, so the output has no seams
+                times = np.arange(np.ceil(position * sample_rate / rate), (position + len(chunk)) * sample_rate / rate)
+                chunk = np.interp(times * rate / sample_rate, position + np.arange(len(chunk)), chunk).astype(np.float32)
+                position += len(samples) // channels
+            yield chunk
+
+def iter_audio_windows(file_path, sample_rate, window_seconds, overlap_seconds=0.0, chunk_seconds=1.0):
+    """
+    Decode an audio file incrementally and yield fixed-size, overlapping mono windows.
+
+    Only about one window of audio is held in memory at a time, however long the recording, and the
+    first window is yielded as soon as it has been decoded.
+
+    Parameters:
+    - file_path: Path to the audio file.
+    - sample_rate: Sample rate of the windows in Hz; the audio is resampled while decoding.
+    - window_seconds: Length of each window.
+    - overlap_seconds: Audio shared by consecutive windows.
+    - chunk_seconds: Amount of audio decoded at a time.
+
+    Yields:
+    - Tuples (start_seconds, window) with window a 1-D float32 NumPy array. Every window but the last
+      is window_seconds long; the last holds whatever audio remains.
+    """
+    import numpy as np
+
+    window = max(1, int(window_seconds * sample_rate))
+    hop = window - int(overlap_seconds * sample_rate)
+    if hop <= 0:
+        raise ValueError("overlap_seconds must be shorter than window_seconds")
+    buffer = np.empty(0, dtype=np.float32)
+    start, emitted = 0, False
+    for chunk in _decode_chunks(file_path, sample_rate, chunk_seconds):
+        buffer = np.concatenate([buffer, chunk.astype(np.float32, copy=False)])
+        while len(buffer) >= window:
+            yield start / sample_rate, buffer[:window].copy()
+            emitted = True
+            buffer = buffer[hop:]
+            start += hop
+    # After a full window the buffer still holds its overlap; only yield a tail if it adds new audio.
+    if len(buffer) > (window - hop if emitted else 0):
+        yield start / sample_rate, buffer
+
+def get_audio_duration(file_path):
+    """
+    Return the duration of an audio file in seconds, or None if it cannot be determined
+    without decoding the file.
+    """
+    try:
+        import torchaudio
+        info = torchaudio.info(file_path)
+        return info.num_frames / info.sample_rate
+    except ImportError:
+        if file_path.lower().endswith(".wav"):
+            import wave
+            try:
+                with wave.open(file_path, 'rb') as file:
+                    return file.getnframes() / file.getframerate()
+            except (OSError, wave.Error):
+                return None
+        return None
+    except Exception:
+        return None
+
 def load_config():
     """
     Load the configuration settings from the config.py file.
@@ -31,14 +171,17 @@ def save_encryption_key(key, filename="encryption_key.key"):
     with open(filename, "wb") as key_file:
         key_file.write(key)
 
+@functools.lru_cache(maxsize=16)
+def _read_encryption_key(filename, mtime_ns):
+    with open(filename, "rb") as key_file:
+        return key_file.read()
+
 def load_encryption_key(filename="encryption_key.key"):
     """
-    Load the encryption key from a file.
+    Load the encryption key from a file. The file is only read again once it has changed.
     """
     try:
-        with open(filename, "rb") as key_file:
-            key = key_file.read()
-        return key
+        return _read_encryption_key(filename, os.stat(filename).st_mtime_ns)
     except FileNotFoundError as e:
         raise FileNotFoundError(f"Encryption key file {filename} not found.") from e
 
@@ -46,17 +189,13 @@ def encrypt_data(data, key):
     """
     Encrypt data using the provided key.
     """
-    fernet = Fernet(key)
-    encrypted_data = fernet.encrypt(data.encode())
-    return encrypted_data
+    return fernet_for(key).encrypt(data.encode())
 
 def decrypt_data(encrypted_data, key):
     """
     Decrypt data using the provided key.
     """
-    fernet = Fernet(key)
-    decrypted_data = fernet.decrypt(encrypted_data).decode()
-    return decrypted_data
+    return fernet_for(key).decrypt(encrypted_data).decode()
 
 def anonymize_data(data, salt):
     """
@@ -72,12 +211,70 @@ def anonymize_data(data, salt):
     anonymized_data = hashlib.sha256((data + salt).encode()).hexdigest()
     return anonymized_data
 
-def log_event(event_message, log_file="event_log.txt"):
+class _EventWriter:
+    """
+    Background thread appending queued events to a log file as JSON lines.
+
+    Events are written in batches, one write for whatever has queued up since the last one, so a
+    burst of events costs a single system call.
+    """
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="event-log", daemon=True)
+        self._thread.start()
+        # Write out whatever is still queued when the process exits
+        atexit.register(self.close)
+
+    def _write(self):
+        # Unbuffered, so each batch is a single append; writers in other processes (or other copies
+        # of this module) appending to the same file cannot split each other's lines
+        with open(self.log_file, "ab", buffering=0) as file:
+            while True:
+                events = [self.queue.get()]
+                while len(events) < 1000:
+                    try:
+                        events.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                lines = []
+                for event in events:
+                    if event is None:
+                        file.write("".join(lines).encode())
+                        return
+                    created, level, thread, message, fields = event
+                    entry = {"time": round(created, 3), "level": level, "thread": thread, "message": message}
+                    entry.update(fields)
+                    lines.append(json.dumps(entry, default=str) + "\n")
+                file.write("".join(lines).encode())
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+_event_writers = {}
+_event_writers_lock = threading.Lock()
+
+def log_event(event_message, log_file="event_log.txt", level="info", **fields):
     """
-    Log an event message to a specified log file.
+    Log an event to a log file as a JSON line.
+
+    The caller only queues the event; a background thread formats and writes it, so logging
+    from hot paths does not wait on file I/O.
+
+    Parameters:
+    - event_message: The message.
+    - log_file: The file the event is appended to.
+    - level: 'debug', 'info', 'warning' or 'error'.
+    - fields: Structured values stored alongside the message, e.g. memo_id or seconds.
     """
-    with open(log_file, "a") as file:
-        file.write(f"{event_message}\n")
+    writer = _event_writers.get(log_file)
+    if writer is None:
+        with _event_writers_lock:
+            writer = _event_writers.get(log_file) or _event_writers.setdefault(log_file, _EventWriter(log_file))
+    writer.queue.put((time.time(), level, threading.current_thread().name, str(event_message), fields))
 
 def check_and_create_directory(directory_path):
     """
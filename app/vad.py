@@ -0,0 +1,162 @@
+import numpy as np
+from app.config import (VAD_THRESHOLD_DB, VAD_MIN_SPEECH_SECONDS, VAD_MIN_SILENCE_SECONDS, VAD_PADDING_SECONDS,
+                        VAD_MAX_SEGMENT_SECONDS)
+from app.utils import iter_audio_windows
+
+# Frame energies are tracked in a histogram of 1 dB bins over this range (dBFS)
+HISTOGRAM_RANGE_DB = (-120, 0)
+# The noise floor and the speech level are these percentiles of the frame energies seen so far
+NOISE_PERCENTILE = 10
+SPEECH_PERCENTILE = 99
+# Frames quieter than this are never speech, however quiet the recording is overall
+ABSOLUTE_FLOOR_DB = -60.0
+# Audio decoded and scored at a time when reading from a file
+BLOCK_SECONDS = 10.0
+# A segment reaching the maximum length is cut at the quietest frame within this much audio before the limit
+SPLIT_SEARCH_SECONDS = 2.0
+
+class SpeechDetector:
+    """
+    Energy-based voice activity detector.
+
+    Audio is cut into short frames whose energy (in dBFS) is computed for a whole block at once.
+    A frame is speech if it is louder than the noise floor, estimated as a low percentile of all
+    frame energies seen so far, by threshold_db. In a recording with hardly any pauses that
+    percentile is itself speech, so the threshold is also capped at half of threshold_db below the
+    loudest frames; when unsure, audio is kept rather than dropped. Runs of speech separated by
+    less than min_silence_seconds are joined, speech shorter than min_speech_seconds (clicks, taps)
+    is dropped, and each segment is padded so word onsets and endings are not clipped.
+
+    Blocks are processed as they arrive and segments are yielded as soon as the silence after
+    them is long enough, so a file can be scanned while it is being decoded. Segments longer than
+    max_segment_seconds are split at their quietest point near the limit.
+    """
+
+    def __init__(self, sample_rate, threshold_db=VAD_THRESHOLD_DB, min_speech_seconds=VAD_MIN_SPEECH_SECONDS,
+                 min_silence_seconds=VAD_MIN_SILENCE_SECONDS, padding_seconds=VAD_PADDING_SECONDS,
+                 max_segment_seconds=VAD_MAX_SEGMENT_SECONDS, frame_seconds=0.03):
+        """
+        Parameters:
+        - sample_rate: Sample rate of the audio in Hz.
+        - threshold_db: How far above the noise floor a frame must be to count as speech.
+        - min_speech_seconds: Shorter bursts of sound are discarded.
+        - min_silence_seconds: Shorter pauses do not end a segment.
+        - padding_seconds: Audio kept before and after each segment.
+        - max_segment_seconds: Longer segments are split.
+        - frame_seconds: Length of the frames energy is measured over.
+        """
+        self.sample_rate = sample_rate
+        self.threshold_db = threshold_db
+        self.frame = max(1, int(frame_seconds * sample_rate))
+        self.min_speech = int(min_speech_seconds * sample_rate)
+        self.min_silence = int(min_silence_seconds * sample_rate)
+        self.padding = int(padding_seconds * sample_rate)
+        self.max_segment = int(max_segment_seconds * sample_rate)
+        self.split_search = int(SPLIT_SEARCH_SECONDS * sample_rate) // self.frame
+        self._histogram = np.zeros(HISTOGRAM_RANGE_DB[1] - HISTOGRAM_RANGE_DB[0], dtype=np.int64)
+
+    def frame_energies(self, audio):
+        """
+        Return the energy in dBFS of each whole frame of a 1-D waveform.
+        """
+        frames = audio[:len(audio) // self.frame * self.frame].reshape(-1, self.frame).astype(np.float64)
+        return 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-12)
+
+    def threshold(self):
+        """
+        Return the current speech threshold in dBFS, from the energies seen so far.
+        """
+        cumulative = np.cumsum(self._histogram)
+        if not cumulative[-1]:
+            return ABSOLUTE_FLOOR_DB
+        noise_floor, speech_level = HISTOGRAM_RANGE_DB[0] + np.searchsorted(
+            cumulative, cumulative[-1] * np.array([NOISE_PERCENTILE, SPEECH_PERCENTILE]) / 100)
+        return max(min(noise_floor + self.threshold_db, speech_level - self.threshold_db / 2), ABSOLUTE_FLOOR_DB)
+
+    def segments(self, blocks):
+        """
+        Find the speech in a stream of audio.
+
+        Parameters:
+        - blocks: An iterable of consecutive 1-D float32 waveforms at the detector's sample rate.
+
+        Yields:
+        - Tuples (start_seconds, end_seconds, audio) for each speech segment, in order.
+        """
+        buffer = np.empty(0, dtype=np.float32)
+        buffer_start = 0  # sample index of buffer[0] in the stream
+        position = 0  # sample index of the first frame not yet scored
+        speech_start = speech_end = None
+
+        def emit(start, end):
+            start, end = max(start, buffer_start), min(end, buffer_start + len(buffer))
+            return start / self.sample_rate, end / self.sample_rate, buffer[start - buffer_start:end - buffer_start].copy()
+
+        for block in blocks:
+            buffer = np.concatenate([buffer, np.asarray(block, dtype=np.float32)])
+            energies = self.frame_energies(buffer[position - buffer_start:])
+            if not len(energies):
+                continue
+            bins = np.clip(energies.astype(np.int64) - HISTOGRAM_RANGE_DB[0], 0, len(self._histogram) - 1)
+            self._histogram += np.bincount(bins, minlength=len(self._histogram))
+            speech = energies >= self.threshold()
+
+            # Walk runs of equal frames rather than single frames
+            boundaries = np.flatnonzero(np.diff(speech.astype(np.int8))) + 1
+            run_starts = np.concatenate([[0], boundaries])
+            run_ends = np.concatenate([boundaries, [len(speech)]])
+            for first, last in zip(run_starts, run_ends):
+                start, end = position + first * self.frame, position + last * self.frame
+                if speech[first]:
+                    if speech_start is None:
+                        speech_start = start
+                    speech_end = end
+                    while speech_end - speech_start > self.max_segment:
+                        # Cut at the quietest frame shortly before the limit, within this block
+                        limit = (speech_start + self.max_segment - position) // self.frame
+                        low = max(0, limit - self.split_search, (speech_start - position) // self.frame + 1)
+                        cut = position + (low + int(np.argmin(energies[low:limit])) if low < limit else limit) * self.frame
+                        yield emit(speech_start - self.padding, cut)
+                        speech_start = cut
+                elif speech_start is not None and end - speech_end >= self.min_silence:
+                    if speech_end - speech_start >= self.min_speech:
+                        yield emit(speech_start - self.padding, speech_end + self.padding)
+                    speech_start = speech_end = None
+            position += len(energies) * self.frame
+
+            # Keep only the audio an open or upcoming segment can still need
+            keep_from = max(buffer_start, (speech_start if speech_start is not None else position) - self.padding)
+            buffer = buffer[keep_from - buffer_start:]
+            buffer_start = keep_from
+
+        if speech_start is not None and speech_end - speech_start >= self.min_speech:
+            yield emit(speech_start - self.padding, speech_end + self.padding)
+
+    def detect(self, audio):
+        """
+        Return the (start_seconds, end_seconds) speech segments of a whole waveform.
+        """
+        return [(start, end) for start, end, _ in self.segments([audio])]
+
+def iter_speech_segments(file_path, sample_rate, **options):
+    """
+    Decode an audio file incrementally and yield its speech segments.
+
+    Parameters:
+    - file_path: Path to the audio file.
+    - sample_rate: Sample rate of the yielded audio in Hz.
+    - options: SpeechDetector parameters, e.g. max_segment_seconds.
+
+    Yields:
+    - Tuples (start_seconds, end_seconds, audio) with audio a 1-D float32 NumPy array.
+    """
+    detector = SpeechDetector(sample_rate, **options)
+    blocks = (window for _, window in iter_audio_windows(file_path, sample_rate, BLOCK_SECONDS))
+    yield from detector.segments(blocks)
+
+def detect_speech_segments(file_path, sample_rate=16000, **options):
+    """
+    Return the [start_seconds, end_seconds] speech segments of an audio file, rounded to milliseconds.
+    """
+    return [[round(start, 3), round(end, 3)]
+            for start, end, _ in iter_speech_segments(file_path, sample_rate, **options)]
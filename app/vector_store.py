@@ -0,0 +1,435 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import numpy as np
+from app.config import ENCRYPTION_KEY, VECTOR_STORE_PATH, EMBEDDING_MODEL
+from app.crypto import crypto
+from app.registry import registry
+from app.utils import check_and_create_directory, log_event
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+MANIFEST_FILE_NAME = "manifest.bin"
+VECTORS_FILE_NAME = "vectors.f32"
+CENTROIDS_FILE_NAME = "ivf_centroids.f32"
+ASSIGNMENTS_FILE_NAME = "ivf_assignments.i32"
+
+# Rows scored per matrix multiplication in brute-force search
+SEARCH_BLOCK_ROWS = 65536
+# The IVF index is built automatically once the store reaches this many rows, and rebuilt
+# whenever it has grown IVF_REBUILD_GROWTH times past the size it was trained on.
+IVF_MIN_ROWS = 20000
+IVF_REBUILD_GROWTH = 4
+
+def chunk_text(text, chunk_words=200, overlap_words=40):
+    """
+    Split a transcript into overlapping chunks of words.
+
+    Parameters:
+    - text: The transcript.
+    - chunk_words: Number of words per chunk.
+    - overlap_words: Number of words shared by consecutive chunks.
+
+    Returns:
+    - A list of chunk strings. The split is deterministic, so a chunk can be recovered from its index.
+    """
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, chunk_words - overlap_words)
+    return [" ".join(words[start:start + chunk_words])
+            for start in range(0, max(1, len(words) - overlap_words), step)]
+
+class HashingEmbedder:
+    """
+    Dependency-free local embedding: hashed word unigrams and bigrams, L2-normalised.
+    Captures lexical overlap only, but needs no model download.
+
+    With a key, features are hashed with keyed BLAKE2b. The vectors are stored unencrypted, and
+    unkeyed feature hashes would let anyone holding them test which words a memo contains by
+    hashing a dictionary; without the key the buckets reveal nothing about the words.
+    """
+
+    def __init__(self, dimension=384, key=None):
+        self.dimension = dimension
+        self.key = key or b""
+        self.name = f"hashing-{dimension}" + ("-keyed" if key else "")
+
+    def keyed(self, key):
+        """
+        Return the same embedder hashing features with a key.
+        """
+        return HashingEmbedder(self.dimension, key)
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode(), digest_size=8, key=self.key).digest()
+        value = int.from_bytes(digest, "little")
+        return value % self.dimension, 1.0 if value >> 63 else -1.0
+
+    def __call__(self, texts):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = WORD_PATTERN.findall(text.lower())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                bucket, sign = self._bucket(feature)
+                vectors[row, bucket] += sign
+        return vectors
+
+class SentenceTransformerEmbedder:
+    """
+    Local sentence-transformers model, for semantic rather than lexical similarity.
+    """
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def __call__(self, texts):
+        return np.asarray(self.model.encode(list(texts), batch_size=32), dtype=np.float32)
+
+def get_embedder(model_name=EMBEDDING_MODEL):
+    """
+    Return the configured embedding function. 'hashing' selects the dependency-free embedder;
+    anything else is loaded as a sentence-transformers model.
+    """
+    if model_name == "hashing":
+        return HashingEmbedder()
+    return SentenceTransformerEmbedder(model_name)
+
+registry.register("text_embedder", get_embedder)
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _kmeans(vectors, clusters, iterations=10, seed=0):
+    """
+    Spherical k-means on L2-normalised vectors. Returns the normalised centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(clusters):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+def _top_k(scores, k):
+    """
+    Indices of the k largest scores, best first.
+    """
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates])]
+
+class VectorStore:
+    """
+    Append-only store of transcript chunk embeddings with top-k cosine search.
+
+    Vectors are L2-normalised float32 rows appended to a flat file that is memory-mapped for
+    search. The row table (memo ID, chunk index) is kept in an encrypted manifest; chunk text is
+    not stored here and is recovered from the memo database with chunk_text().
+
+    The vector file itself is plaintext. With an embedder that supports keys (the hashing
+    embedder), a new store generates a random feature hashing key and keeps it in the manifest,
+    so the vectors cannot be tested for words without the encryption key; the key survives key
+    rotations, as the manifest is re-encrypted. Stores created before keys were introduced keep
+    unkeyed vectors until they are rebuilt.
+
+    Two search modes are available: 'brute' scores every row in blocks; 'ivf' scores only the rows
+    in the clusters nearest the query, after build_ivf() has clustered the corpus.
+    """
+
+    def __init__(self, store_path=VECTOR_STORE_PATH, embedder=None, encryption_key=ENCRYPTION_KEY):
+        """
+        Parameters:
+        - store_path: Directory holding the vector files.
+        - embedder: Embedding function mapping a list of texts to a float32 array. Defaults to the shared
+          get_embedder() instance.
+        - encryption_key: Fernet key the manifest encryption key is derived from.
+        """
+        check_and_create_directory(store_path)
+        self.store_path = store_path
+        self._base_embedder = embedder or registry.get("text_embedder")
+        self.embedder = self._base_embedder
+        self.dimension = self.embedder.dimension
+        self._aead = crypto.aead(b"voice-memo-vector-store-v1", encryption_key)
+        self._lock = threading.RLock()
+        self._vectors = None
+        self._lists = None
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.store_path, name)
+
+    def _load(self):
+        if os.path.exists(self._path(MANIFEST_FILE_NAME)):
+            with open(self._path(MANIFEST_FILE_NAME), 'rb') as file:
+                payload = file.read()
+            manifest = json.loads(self._aead.decrypt(payload[:12], payload[12:], MANIFEST_FILE_NAME.encode()))
+        else:
+            manifest = {'rows': [], 'deleted': [], 'ivf_trained_rows': 0}
+            if hasattr(self._base_embedder, "keyed"):
+                manifest['feature_key'] = base64.b64encode(os.urandom(32)).decode()
+        self._feature_key = manifest.get('feature_key')
+        if self._feature_key:
+            self.embedder = self._base_embedder.keyed(base64.b64decode(self._feature_key))
+        elif hasattr(self._base_embedder, "keyed"):
+            log_event(f"Vector store at {self.store_path} holds unkeyed feature hashes; rebuild it to key them",
+                      level="warning")
+        manifest.setdefault('embedder', self.embedder.name)
+        if manifest['embedder'] != self.embedder.name:
+            raise RuntimeError(f"Vector store at {self.store_path} was built with {manifest['embedder']}, "
+                               f"not {self.embedder.name}. Rebuild it to switch embedders.")
+        self._rows = manifest['rows']
+        self._ivf_trained_rows = manifest.get('ivf_trained_rows', 0)
+        self._deleted = np.zeros(len(self._rows), dtype=bool)
+        self._deleted[manifest['deleted']] = True
+        self._memo_rows = {}
+        for row, (memo_id, _) in enumerate(self._rows):
+            if not self._deleted[row]:
+                self._memo_rows.setdefault(memo_id, []).append(row)
+
+        self._centroids = None
+        self._assignments = None
+        if os.path.exists(self._path(CENTROIDS_FILE_NAME)):
+            self._centroids = np.fromfile(self._path(CENTROIDS_FILE_NAME), dtype=np.float32).reshape(-1, self.dimension)
+            self._assignments = np.fromfile(self._path(ASSIGNMENTS_FILE_NAME), dtype=np.int32)[:len(self._rows)]
+        self._vectors = None
+        self._lists = None
+
+    def _save_manifest(self):
+        manifest = {'embedder': self.embedder.name, 'rows': self._rows,
+                    'deleted': np.flatnonzero(self._deleted).tolist(),
+                    'ivf_trained_rows': self._ivf_trained_rows}
+        if self._feature_key:
+            manifest['feature_key'] = self._feature_key
+        manifest = json.dumps(manifest).encode()
+        nonce = os.urandom(12)
+        with open(self._path(MANIFEST_FILE_NAME + ".tmp"), 'wb') as file:
+            file.write(nonce + self._aead.encrypt(nonce, manifest, MANIFEST_FILE_NAME.encode()))
+        os.replace(self._path(MANIFEST_FILE_NAME + ".tmp"), self._path(MANIFEST_FILE_NAME))
+
+    def reencrypt(self):
+        """
+        Rewrite the manifest, the only encrypted file, with the current key during a key rotation.
+        """
+        with self._lock:
+            self._save_manifest()
+
+    def _matrix(self):
+        """
+        Memory-mapped view of the stored vectors, reopened after appends.
+        """
+        if self._vectors is None:
+            if not self._rows:
+                self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+            else:
+                self._vectors = np.memmap(self._path(VECTORS_FILE_NAME), dtype=np.float32, mode='r',
+                                          shape=(len(self._rows), self.dimension))
+        return self._vectors
+
+    def __len__(self):
+        return int((~self._deleted).sum())
+
+    def add_memo(self, memo_id, text):
+        """
+        Chunk, embed and append a memo's transcript, replacing any vectors stored for it before.
+        """
+        self.add_memos([(memo_id, text)])
+
+    def add_memos(self, memos):
+        """
+        Chunk, embed and append several (memo_id, text) pairs in one batch.
+        """
+        rows, texts = [], []
+        for memo_id, text in memos:
+            for index, chunk in enumerate(chunk_text(text)):
+                rows.append([str(memo_id), index])
+                texts.append(chunk)
+        with self._lock:
+            for memo_id in {row[0] for row in rows}:
+                self._delete_rows(memo_id)
+            if rows:
+                self._append(rows, normalize_rows(np.asarray(self.embedder(texts), dtype=np.float32)))
+            self._save_manifest()
+            if len(self._rows) >= IVF_MIN_ROWS and len(self._rows) > IVF_REBUILD_GROWTH * self._ivf_trained_rows:
+                self.build_ivf()
+        log_event(f"Added {len(rows)} transcript chunks to the vector store")
+
+    def add_vectors(self, rows, vectors):
+        """
+        Append precomputed embeddings.
+
+        Parameters:
+        - rows: A list of [memo_id, chunk_index] pairs, one per vector.
+        - vectors: A float32 array of shape (len(rows), dimension).
+        """
+        with self._lock:
+            self._append([[str(memo_id), int(index)] for memo_id, index in rows],
+                         normalize_rows(np.asarray(vectors, dtype=np.float32)))
+            self._save_manifest()
+
+    def _append(self, rows, vectors):
+        # Truncate first: rows written by an append whose manifest update never landed are discarded.
+        with open(self._path(VECTORS_FILE_NAME), 'ab') as file:
+            file.truncate(len(self._rows) * self.dimension * 4)
+            file.write(vectors.astype(np.float32).tobytes())
+        start = len(self._rows)
+        self._rows.extend(rows)
+        self._deleted = np.concatenate([self._deleted, np.zeros(len(rows), dtype=bool)])
+        for offset, (memo_id, _) in enumerate(rows):
+            self._memo_rows.setdefault(memo_id, []).append(start + offset)
+        if self._centroids is not None:
+            # New rows join the nearest existing cluster; the clustering itself is not redone.
+            assignments = np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+            with open(self._path(ASSIGNMENTS_FILE_NAME), 'ab') as file:
+                file.truncate(len(self._assignments) * 4)
+                file.write(assignments.tobytes())
+            self._assignments = np.concatenate([self._assignments, assignments])
+        self._vectors = None
+        self._lists = None
+
+    def _delete_rows(self, memo_id):
+        for row in self._memo_rows.pop(str(memo_id), []):
+            self._deleted[row] = True
+
+    def remove_memo(self, memo_id):
+        """
+        Remove a memo's vectors from search results.
+        """
+        with self._lock:
+            self._delete_rows(memo_id)
+            self._save_manifest()
+
+    def build_ivf(self, clusters=None, sample_size=50000):
+        """
+        Cluster the stored vectors for approximate ('ivf') search.
+
+        Parameters:
+        - clusters: Number of clusters; defaults to about the square root of the number of rows.
+        - sample_size: Maximum number of rows the clustering is trained on.
+        """
+        with self._lock:
+            vectors = self._matrix()
+            if not len(vectors):
+                return
+            clusters = min(clusters or max(1, int(np.sqrt(len(vectors)))), len(vectors))
+            rng = np.random.default_rng(0)
+            sample = vectors[np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))]
+            self._centroids = _kmeans(np.asarray(sample), clusters)
+            self._assignments = np.concatenate([
+                np.argmax(vectors[start:start + SEARCH_BLOCK_ROWS] @ self._centroids.T, axis=1)
+                for start in range(0, len(vectors), SEARCH_BLOCK_ROWS)]).astype(np.int32)
+            self._centroids.astype(np.float32).tofile(self._path(CENTROIDS_FILE_NAME))
+            self._assignments.tofile(self._path(ASSIGNMENTS_FILE_NAME))
+            self._ivf_trained_rows = len(vectors)
+            self._save_manifest()
+            self._lists = None
+        log_event(f"Built IVF index with {clusters} clusters over {len(vectors)} vectors")
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self._assignments, kind='stable')
+            bounds = np.searchsorted(self._assignments[order], np.arange(len(self._centroids) + 1))
+            self._lists = (order, bounds)
+        return self._lists
+
+    def search(self, query, k=5, mode="brute", nprobe=8):
+        """
+        Find the transcript chunks most similar to a query.
+
+        Parameters:
+        - query: The query text.
+        - k: Number of results.
+        - mode: 'brute' for exact search, 'ivf' for approximate search (falls back to 'brute' if
+          build_ivf() has not been run).
+        - nprobe: Number of clusters scanned in 'ivf' mode.
+
+        Returns:
+        - A list of dictionaries with 'memo_id', 'chunk_index' and 'score', best match first. Chunks
+          with no positive similarity to the query are left out.
+        """
+        hits = self.search_vectors(self.embedder([query]), k=k, mode=mode, nprobe=nprobe)[0]
+        return [hit for hit in hits if hit['score'] > 0]
+
+    def search_vectors(self, queries, k=5, mode="brute", nprobe=8):
+        """
+        Batched top-k cosine search for a matrix of query vectors.
+
+        Returns:
+        - One result list per query row, in the format returned by search().
+        """
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        with self._lock:
+            vectors = self._matrix()
+            if not len(vectors):
+                return [[] for _ in queries]
+            if mode == "ivf" and self._centroids is not None:
+                hits = [self._search_ivf(vectors, query, k, nprobe) for query in queries]
+            else:
+                hits = self._search_brute(vectors, queries, k)
+            return [[{'memo_id': self._rows[row][0], 'chunk_index': self._rows[row][1], 'score': float(score)}
+                     for row, score in query_hits] for query_hits in hits]
+
+    def _search_brute(self, vectors, queries, k):
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+            scores = np.asarray(vectors[start:start + SEARCH_BLOCK_ROWS]) @ queries.T
+            scores[self._deleted[start:start + SEARCH_BLOCK_ROWS]] = -np.inf
+            rows = np.broadcast_to(np.arange(start, start + len(scores)), (len(queries), len(scores)))
+            best_rows = np.concatenate([best_rows, rows], axis=1)
+            best_scores = np.concatenate([best_scores, scores.T], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return [[(row, score) for row, score in zip(rows, scores) if np.isfinite(score)]
+                for rows, scores in zip(best_rows, best_scores)]
+
+    def _search_ivf(self, vectors, query, k, nprobe):
+        order, bounds = self._inverted_lists()
+        probes = _top_k(self._centroids @ query, min(nprobe, len(self._centroids)))
+        candidates = np.sort(np.concatenate([order[bounds[probe]:bounds[probe + 1]] for probe in probes]))
+        candidates = candidates[~self._deleted[candidates]]
+        if not len(candidates):
+            return []
+        scores = np.asarray(vectors[candidates]) @ query
+        return [(candidates[index], scores[index]) for index in _top_k(scores, k)]
+
+registry.register("vector_store", VectorStore)
+
+def load_chunk_texts(results, database):
+    """
+    Recover the text of search results from the memo database.
+
+    Parameters:
+    - results: Results returned by VectorStore.search.
+    - database: MemoDatabase holding the transcripts.
+
+    Returns:
+    - A list of chunk texts, in the order of the results.
+    """
+    texts, chunks_by_memo = [], {}
+    for result in results:
+        if result['memo_id'] not in chunks_by_memo:
+            chunks_by_memo[result['memo_id']] = chunk_text(database.load(result['memo_id'], "transcription") or "")
+        chunks = chunks_by_memo[result['memo_id']]
+        if result['chunk_index'] < len(chunks):
+            texts.append(chunks[result['chunk_index']])
+    return texts
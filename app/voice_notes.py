@@ -0,0 +1,151 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.config import AUDIO_STORAGE_PATH, VOICE_NOTE_EDIT_SECONDS, VOICE_NOTE_MAX_SECONDS
+from app.metrics import metrics
+from app.registry import registry
+from app.utils import check_and_create_directory, log_event
+
+TRANSCRIBING_REPLY = "Transcribing your voice note..."
+NO_SPEECH_REPLY = "I couldn't hear any speech in that voice note."
+TOO_LONG_REPLY = "That voice note is too long for me to transcribe here. Please keep it under {minutes:g} minutes."
+ERROR_REPLY = "Sorry, I couldn't transcribe that voice note. Please try again later."
+SAVED_NOTE = "\n\nSaved to your voice memos."
+# Telegram rejects longer messages
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+metrics.describe("voice_note_first_words_seconds", "Time from receiving a voice note to showing its first words")
+metrics.describe("voice_note_seconds", "Time from receiving a voice note to its full transcript")
+
+def _fit(text, partial=False):
+    """
+    Fit a transcript into one Telegram message, keeping its end while it is still growing and its
+    beginning once it is complete.
+    """
+    suffix = " ..." if partial else ""
+    limit = TELEGRAM_MESSAGE_LIMIT - len(suffix) - len(SAVED_NOTE)
+    if len(text) > limit:
+        text = "..." + text[-(limit - 3):] if partial else text[:limit - 3] + "..."
+    return text + suffix
+
+class VoiceNoteService:
+    """
+    Transcribes voice notes sent to the bot while the user watches, then files them as memos.
+
+    Each voice note is downloaded into the audio directory and transcribed a speech segment at a
+    time by the process-wide Whisper engine, which stays loaded between notes. The bot's reply is
+    edited with the transcript so far as segments finish, at most every `edit_seconds` to stay
+    within Telegram's edit limits, so the first words show up within seconds of sending. The
+    finished transcript is put in the pipeline cache and the note submitted to the memo pipeline,
+    which reuses it and runs speaker identification, metadata extraction, summarization and
+    indexing as for an imported memo.
+
+    Voice notes are transcribed one at a time, on a worker of their own, since they share one model;
+    the poller only queues them.
+    """
+
+    def __init__(self, bot, pipeline=None, audio_dir=AUDIO_STORAGE_PATH, edit_seconds=VOICE_NOTE_EDIT_SECONDS,
+                 max_seconds=VOICE_NOTE_MAX_SECONDS):
+        """
+        Parameters:
+        - bot: The telebot.TeleBot voice notes are downloaded and replied to with.
+        - pipeline: Optional MemoPipeline finished notes are submitted to; the shared one is used if omitted.
+        - audio_dir: Directory voice notes are saved into.
+        - edit_seconds: Minimum time between two edits of a reply.
+        - max_seconds: Longest voice note accepted.
+        """
+        self.bot = bot
+        self._pipeline = pipeline
+        self.audio_dir = audio_dir
+        self.edit_seconds = edit_seconds
+        self.max_seconds = max_seconds
+        self._worker = ThreadPoolExecutor(1, thread_name_prefix="voice-note")
+
+    @property
+    def pipeline(self):
+        if self._pipeline is None:
+            self._pipeline = registry.get("memo_pipeline")
+        return self._pipeline
+
+    def submit(self, message):
+        """
+        Queue a voice note message for transcription.
+        """
+        if self.max_seconds and (message.voice.duration or 0) > self.max_seconds:
+            metrics.inc("voice_notes_total", outcome="rejected")
+            self._worker.submit(self._reply, message, TOO_LONG_REPLY.format(minutes=self.max_seconds / 60))
+            return False
+        self._worker.submit(self._transcribe, message, time.monotonic())
+        return True
+
+    def _download(self, message):
+        file_info = self.bot.get_file(message.voice.file_id)
+        check_and_create_directory(self.audio_dir)
+        # Telegram voice notes are Ogg Opus
+        path = os.path.join(self.audio_dir, f"telegram-{message.chat.id}-{message.message_id}.oga")
+        with open(path + ".tmp", 'wb') as file:
+            file.write(self.bot.download_file(file_info.file_path))
+        os.replace(path + ".tmp", path)
+        return path
+
+    def _transcribe(self, message, received):
+        reply = self._reply(message, TRANSCRIBING_REPLY)
+        try:
+            path = self._download(message)
+            engine = registry.get("whisper")
+            texts, shown, last_edit = [], None, 0.0
+            for segment in engine.transcribe_stream(path):
+                if not texts:
+                    metrics.observe("voice_note_first_words_seconds", time.monotonic() - received)
+                texts.append(segment["text"])
+                if reply is not None and time.monotonic() - last_edit >= self.edit_seconds:
+                    shown = self._edit(message, reply, _fit(" ".join(texts), partial=True), shown)
+                    last_edit = time.monotonic()
+            transcription = " ".join(texts)
+        except Exception as e:
+            log_event(f"Error while transcribing a voice note: {e}", level="error")
+            metrics.inc("voice_notes_total", outcome="error")
+            self._edit(message, reply, ERROR_REPLY)
+            return
+        metrics.observe("voice_note_seconds", time.monotonic() - received)
+        if not transcription:
+            metrics.inc("voice_notes_total", outcome="empty")
+            self._edit(message, reply, NO_SPEECH_REPLY, shown)
+            return
+
+        # The pipeline finds the transcript in its cache rather than transcribing the note again
+        self.pipeline.cache.put("transcription", path, transcription)
+        self.pipeline.submit(path)
+        metrics.inc("voice_notes_total", outcome="transcribed")
+        self._edit(message, reply, _fit(transcription) + SAVED_NOTE, shown)
+        log_event(f"Transcribed voice note {os.path.basename(path)} and submitted it to the pipeline",
+                  seconds=round(time.monotonic() - received, 3))
+
+    def _reply(self, message, text):
+        try:
+            return self.bot.reply_to(message, text)
+        except Exception as e:
+            log_event(f"Sending a reply failed: {e}", level="error")
+            return None
+
+    def _edit(self, message, reply, text, shown=None):
+        """
+        Replace the text of a reply, or send a new one if the reply could not be sent. Returns the text shown.
+        """
+        if text == shown:
+            # Telegram rejects edits that change nothing
+            return shown
+        if reply is None:
+            return text if self._reply(message, text) is not None else shown
+        try:
+            self.bot.edit_message_text(text, chat_id=message.chat.id, message_id=reply.message_id)
+            return text
+        except Exception as e:
+            log_event(f"Editing a voice note reply failed: {e}", level="warning")
+            return shown
+
+    def close(self):
+        """
+        Finish the queued voice notes and stop the worker.
+        """
+        self._worker.shutdown(wait=True)
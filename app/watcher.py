@@ -0,0 +1,182 @@
+import os
+import shutil
+import threading
+import time
+from app.config import (AUDIO_STORAGE_PATH, WATCH_INTERVAL_SECONDS, WATCH_DIRECTORY, WATCH_SETTLE_SECONDS,
+                        WATCH_SCAN_SECONDS)
+from app.data_import import import_voice_memos
+from app.transcription import AUDIO_EXTENSIONS
+from app.utils import check_and_create_directory, log_event
+
+class MemoWatcher:
+    """
+    Long-running ingest loop that feeds new and changed memos into a MemoPipeline as they appear.
+
+    iCloud is polled every `interval` seconds with an incremental import, and each memo enters the
+    pipeline as soon as its download completes. Optionally, a local drop directory is scanned every
+    `scan_seconds`; a file is taken once its size and modification time have not changed for
+    `settle_seconds`, so a file still being copied, or rewritten several times in a burst, is
+    processed once, after the last change. Taken files are moved into the audio directory, where
+    later runs find them like imported memos.
+
+    poll_now() asks for an iCloud poll ahead of schedule; requests made while one is pending or
+    running are coalesced into a single poll. The pipeline runs the memos in its own workers, so
+    the loop never waits on processing, and a query service in the same process sees each memo as
+    soon as its index stage has run.
+    """
+
+    def __init__(self, pipeline, interval=WATCH_INTERVAL_SECONDS, watch_directory=WATCH_DIRECTORY,
+                 settle_seconds=WATCH_SETTLE_SECONDS, scan_seconds=WATCH_SCAN_SECONDS, audio_dir=AUDIO_STORAGE_PATH,
+                 import_memos=import_voice_memos):
+        """
+        Parameters:
+        - pipeline: The MemoPipeline new memos are submitted to.
+        - interval: Seconds between iCloud polls. 0 or less disables polling iCloud.
+        - watch_directory: Optional directory audio files are dropped into.
+        - settle_seconds: How long a dropped file must stay unchanged before it is taken.
+        - scan_seconds: Seconds between scans of the drop directory.
+        - audio_dir: Directory dropped files are moved into.
+        - import_memos: Import function called with on_downloaded on each poll.
+        """
+        self.pipeline = pipeline
+        self.interval = interval
+        self.watch_directory = watch_directory
+        self.settle_seconds = settle_seconds
+        self.scan_seconds = scan_seconds
+        self.audio_dir = audio_dir
+        self.import_memos = import_memos
+        self._wake = threading.Event()
+        self._poll_requested = True  # poll once right away
+        self._stopping = False
+        self._thread = None
+        # Dropped file path -> ((size, mtime), time the file was first seen in that state)
+        self._pending_files = {}
+
+    def start(self):
+        """
+        Start watching in a daemon thread.
+        """
+        if self._thread is not None:
+            return
+        if self.watch_directory:
+            check_and_create_directory(self.watch_directory)
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="memo-watcher", daemon=True)
+        self._thread.start()
+        log_event(f"Watching for new voice memos (iCloud every {self.interval:g}s"
+                  + (f", drop directory {self.watch_directory})" if self.watch_directory else ")"))
+
+    def stop(self, timeout=None):
+        """
+        Stop watching. A poll in progress finishes first; memos already submitted keep running in the pipeline.
+        """
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def poll_now(self):
+        """
+        Poll iCloud as soon as possible instead of at the next interval.
+        """
+        self._poll_requested = True
+        self._wake.set()
+
+    def _run(self):
+        next_poll = time.monotonic()
+        while not self._stopping:
+            now = time.monotonic()
+            if self.interval > 0 and (self._poll_requested or now >= next_poll):
+                self._poll_requested = False
+                self._poll()
+                next_poll = time.monotonic() + self.interval
+            if self.watch_directory:
+                self.scan()
+            self._report()
+
+            waits = [next_poll - time.monotonic()] if self.interval > 0 else []
+            if self.watch_directory:
+                waits.append(self.scan_seconds)
+            self._wake.wait(max(0.0, min(waits)) if waits else None)
+            self._wake.clear()
+
+    def _poll(self):
+        try:
+            self.import_memos(on_downloaded=self.pipeline.submit)
+        except Exception as e:
+            log_event(f"Polling for voice memos failed: {e}")
+
+    def scan(self):
+        """
+        Scan the drop directory once and submit the files that have settled.
+
+        Returns:
+        - The paths, in the audio directory, of the files submitted.
+        """
+        now = time.monotonic()
+        try:
+            names = os.listdir(self.watch_directory)
+        except OSError as e:
+            log_event(f"Cannot scan {self.watch_directory}: {e}")
+            return []
+
+        submitted, present = [], set()
+        for name in names:
+            if name.startswith(".") or not name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            path = os.path.join(self.watch_directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            present.add(path)
+            state = (stat.st_size, stat.st_mtime_ns)
+            seen = self._pending_files.get(path)
+            if seen is None or seen[0] != state:
+                self._pending_files[path] = (state, now)
+            elif now - seen[1] >= self.settle_seconds:
+                del self._pending_files[path]
+                try:
+                    submitted.append(self._take(path))
+                except OSError as e:
+                    log_event(f"Cannot take dropped file {path}: {e}")
+        # Forget files removed before they settled
+        for path in set(self._pending_files) - present:
+            del self._pending_files[path]
+        return submitted
+
+    def _reserve_destination(self, name):
+        """
+        Create an empty file in the audio directory for a dropped memo, named after it, or after it
+        with '-1', '-2'... appended if a memo of that name is already there, so none is overwritten.
+        """
+        stem, extension = os.path.splitext(name)
+        for attempt in range(10000):
+            destination = os.path.join(self.audio_dir, f"{stem}-{attempt}{extension}" if attempt else name)
+            try:
+                os.close(os.open(destination, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return destination
+            except FileExistsError:
+                continue
+        raise RuntimeError(f"No free name in {self.audio_dir} for dropped voice memo {name}")
+
+    def _take(self, path):
+        check_and_create_directory(self.audio_dir)
+        destination = self._reserve_destination(os.path.basename(path))
+        try:
+            shutil.move(path, destination)
+        except BaseException:
+            # Otherwise the empty placeholder would later be taken for a memo
+            os.unlink(destination)
+            raise
+        log_event(f"Picked up dropped voice memo {os.path.basename(path)} as {os.path.basename(destination)}")
+        self.pipeline.submit(destination)
+        return destination
+
+    def _report(self):
+        results = self.pipeline.collect_finished()
+        failed = [memo_id for memo_id, result in results.items() if result['status'] == 'failed']
+        if results:
+            log_event(f"Watch mode: {len(results) - len(failed)} voice memos processed, {len(failed)} failed"
+                      + (f" ({', '.join(sorted(failed))})" if failed else ""))
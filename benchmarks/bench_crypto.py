@@ -0,0 +1,136 @@
+"""
+Measure encryption throughput (MB/s) of the crypto service.
+
+Cases:
+- per-call: privacy.encrypt_data as it was, building a Fernet for every call, against the cached
+  cipher of the crypto service, on small (--small-kb) items.
+- bulk: encrypt_many/decrypt_many (Fernet tokens) and seal_many/open_many (AES-GCM records) over
+  --size-mb of --item-kb items, per thread count. Parallel speedup needs as many free cores.
+- rotation: re-encrypting --records StorageManager records from an old key to a new one with
+  KeyRotation, in a scratch directory (run in a child interpreter, since keys are read at import).
+
+Usage:
+    python -m benchmarks.bench_crypto --size-mb 64 --workers 1 2 4 8 --records 500
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from cryptography.fernet import Fernet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def throughput(function, payload_bytes, repeat=3):
+    """
+    Best of `repeat` runs, in MB/s of plaintext.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return round(payload_bytes / best / 1e6, 1)
+
+def bench_per_call(key, small_kb, count):
+    from app.crypto import CryptoService
+
+    items = [os.urandom(small_kb * 1024) for _ in range(count)]
+    service = CryptoService(key, [], workers=1)
+    total = small_kb * 1024 * count
+    return {
+        "case": "per-call",
+        "item_kb": small_kb,
+        "new_fernet_per_call_mb_s": throughput(lambda: [Fernet(key).encrypt(item) for item in items], total),
+        "cached_mb_s": throughput(lambda: [service.encrypt(item) for item in items], total),
+    }
+
+def bench_bulk(key, size_mb, item_kb, workers):
+    from app.crypto import CryptoService
+
+    items = [os.urandom(item_kb * 1024) for _ in range(max(1, size_mb * 1024 // item_kb))]
+    total = sum(len(item) for item in items)
+    service = CryptoService(key, [], workers=workers)
+    tokens = service.encrypt_many(items)
+    records = service.seal_many(items, b"benchmark")
+    result = {
+        "case": "bulk",
+        "workers": workers,
+        "item_kb": item_kb,
+        "fernet_encrypt_mb_s": throughput(lambda: service.encrypt_many(items), total),
+        "fernet_decrypt_mb_s": throughput(lambda: service.decrypt_many(tokens), total),
+        "aes_gcm_encrypt_mb_s": throughput(lambda: service.seal_many(items, b"benchmark"), total),
+        "aes_gcm_decrypt_mb_s": throughput(lambda: service.open_many(records, b"benchmark"), total),
+    }
+    service.close()
+    return result
+
+def write_records(records, record_kb):
+    from app.storage import StorageManager
+
+    storage_manager = StorageManager()
+    for index in range(records):
+        storage_manager.save_data(os.urandom(record_kb * 1024), f"memo{index}", "transcription")
+
+def rotate():
+    from app.key_rotation import KeyRotation
+
+    start = time.perf_counter()
+    result = KeyRotation().run()
+    return dict(result, seconds=time.perf_counter() - start)
+
+def bench_rotation(records, record_kb, workers):
+    old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+    scratch = tempfile.mkdtemp(prefix="bench_crypto_")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, "app")]),
+               CRYPTO_WORKERS=str(workers))
+    try:
+        # STORAGE_PATH is relative, so the child interpreters keep their data in the scratch directory
+        subprocess.run([sys.executable, "-m", "benchmarks.bench_crypto", "--case", "write", "--records", str(records),
+                        "--record-kb", str(record_kb)], env=dict(env, ENCRYPTION_KEY=old_key), cwd=scratch, check=True)
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_crypto", "--case", "rotate"],
+                                env=dict(env, ENCRYPTION_KEY=new_key, ENCRYPTION_PREVIOUS_KEYS=old_key), cwd=scratch,
+                                check=True, capture_output=True, text=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {
+        "case": "rotation",
+        "workers": workers,
+        "records": records,
+        "rewritten": result["rewritten"],
+        "seconds": round(result["seconds"], 3),
+        "mb_s": round(records * record_kb * 1024 / result["seconds"] / 1e6, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64, help="Data per bulk measurement")
+    parser.add_argument("--item-kb", type=int, default=256, help="Size of each bulk item")
+    parser.add_argument("--small-kb", type=int, default=1, help="Size of each item in the per-call case")
+    parser.add_argument("--small-count", type=int, default=20000)
+    parser.add_argument("--records", type=int, default=500, help="Records re-encrypted in the rotation case")
+    parser.add_argument("--record-kb", type=int, default=256)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--case", choices=["write", "rotate"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case == "write":
+        write_records(args.records, args.record_kb)
+        return
+    if args.case == "rotate":
+        print(json.dumps(rotate()))
+        return
+
+    key = Fernet.generate_key()
+    print(json.dumps(bench_per_call(key, args.small_kb, args.small_count)))
+    for workers in args.workers:
+        print(json.dumps(bench_bulk(key, args.size_mb, args.item_kb, workers)))
+    for workers in args.workers:
+        print(json.dumps(bench_rotation(args.records, args.record_kb, workers)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Measure how long importing each application entry point takes, and check that none of them
+imports a heavyweight model library (torch, Whisper, SpeechBrain, the Telegram client) at import.
+
+Each entry point is imported in a fresh interpreter with `python -X importtime`; the reported time
+is the median over the repeats of the cumulative import time of the entry point module. The
+heaviest top-level packages it pulls in are listed so a regression points at its cause.
+
+Exits with status 1 if an entry point imports a forbidden package or exceeds --budget-ms, so it
+can run as a startup regression check.
+
+Usage:
+    python -m benchmarks.bench_import_time --repeats 5 --budget-ms 500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ["app.storage", "app.database", "app.search", "app.user_interaction", "app.summarization",
+                "app.transcription", "app.metadata_extraction", "app.data_import", "app.main"]
+FORBIDDEN = ["torch", "torchaudio", "whisper", "speechbrain", "telebot", "sentence_transformers"]
+
+def import_times(module, env):
+    """
+    Import a module in a new interpreter.
+
+    Returns:
+    - A dictionary mapping every imported module name to its (self, cumulative) import time in microseconds.
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, cwd=ROOT,
+                            capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{output.stderr[-2000:]}")
+    times = {}
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+def run(module, repeats, forbidden, env):
+    runs = [import_times(module, env) for _ in range(repeats)]
+    last = runs[-1]
+    packages = {}
+    for name, (_, cumulative) in last.items():
+        if "." not in name and not name.startswith("_") and name != module.split(".")[-1]:
+            packages[name] = cumulative
+    heaviest = sorted(packages.items(), key=lambda item: -item[1])[:5]
+    return {
+        "entry_point": module,
+        "import_ms": round(statistics.median(times[module][1] for times in runs) / 1000, 1),
+        "modules": len(last),
+        "heaviest": {name: round(cumulative / 1000, 1) for name, cumulative in heaviest},
+        "forbidden": sorted(name for name in forbidden if name in last),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry-points", nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, help="Fail if an entry point takes longer than this to import")
+    parser.add_argument("--forbid", nargs="*", default=FORBIDDEN,
+                        help="Packages that must not be imported when an entry point is imported")
+    args = parser.parse_args()
+
+    # Some modules import their siblings by bare name, so the app directory is on the path as well.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, os.path.join(ROOT, "app"), env.get("PYTHONPATH")]))
+    if "ENCRYPTION_KEY" not in env:
+        from cryptography.fernet import Fernet
+        env["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+
+    failed = False
+    for module in args.entry_points:
+        try:
+            result = run(module, args.repeats, args.forbid, env)
+        except RuntimeError as e:
+            print(json.dumps({"entry_point": module, "error": str(e)}))
+            failed = True
+            continue
+        print(json.dumps(result))
+        if result["forbidden"] or (args.budget_ms is not None and result["import_ms"] > args.budget_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
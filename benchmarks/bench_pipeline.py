@@ -0,0 +1,296 @@
+"""
+End-to-end benchmark of the memo pipeline and the Telegram bot against local stand-ins.
+
+A synthetic corpus of memos (speech-like noise alternating with silence, see bench_vad) is served
+by a fake iCloud API. The application runs in a child interpreter, in a scratch directory, with
+ICLOUD_API_URL and OPENAI_API_BASE pointed at the stubs and fake Whisper and ECAPA models that
+take a fixed fraction of real time. It imports and processes the corpus with process_backlog,
+then answers --queries questions sent through a fake Telegram Bot API.
+
+The report, written as JSON to --output, has per-stage throughput and latency percentiles (from
+the application's own metrics), reply latencies as seen by Telegram, and the peak memory of the
+application and of its transcription workers. Pass an earlier report as --baseline to print the
+change of every stage against it.
+
+Usage:
+    python -m benchmarks.bench_pipeline --memos 40 --duration 120 --silence-ratio 0.3 --output pipeline.json
+    python -m benchmarks.bench_pipeline --output pipeline.json --baseline pipeline-main.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+from benchmarks.bench_query_service import latencies, percentile
+from benchmarks.bench_vad import SAMPLE_RATE, synthesize
+from benchmarks.stubs import FakeCompletionServer, FakeICloudServer, FakeTelegramServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ("transcribe", "embed", "identify", "metadata", "summarize", "index")
+BOT_TOKEN = "123456:benchmark"
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+def write_corpus(directory, memos, duration, silence_ratio, seed=0):
+    """
+    Write `memos` 16-bit mono WAV files of `duration` seconds.
+
+    Returns:
+    - (memos, summary): a dictionary mapping memo IDs to file paths, and the corpus totals.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths, speech_seconds = {}, 0.0
+    for index in range(memos):
+        audio, intervals = synthesize(duration / 60, silence_ratio, seed=seed + index)
+        audio = audio[:int(duration * SAMPLE_RATE)]
+        speech_seconds += sum(max(0.0, min(end, duration) - start) for start, end in intervals if start < duration)
+        memo_id = f"memo-{index:05d}"
+        paths[memo_id] = os.path.join(directory, memo_id + ".wav")
+        with wave.open(paths[memo_id], 'wb') as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(SAMPLE_RATE)
+            file.writeframes((np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes())
+    return paths, {
+        "memos": memos,
+        "audio_seconds": round(memos * duration, 1),
+        "speech_share": round(speech_seconds / (memos * duration), 3) if memos else None,
+        "bytes": sum(os.path.getsize(path) for path in paths.values()),
+    }
+
+def run_application(args):
+    """
+    The application side, run in the child interpreter. Prints the measurements as one JSON line.
+    """
+    import functools
+    import threading
+    import requests
+    from app.cache import PipelineCache
+    from app.main import process_backlog
+    from app.metrics import metrics
+    from app.pipeline import MemoPipeline
+    from app.registry import registry
+    from benchmarks.fakes import FakeSpeakerEmbedder, FakeWhisperEngine
+
+    registry.set("speaker_embedder", FakeSpeakerEmbedder(real_time_factor=args.ecapa_rtf))
+    engine_factory = functools.partial(FakeWhisperEngine, real_time_factor=args.whisper_rtf)
+    start = time.perf_counter()
+    with MemoPipeline(cache=PipelineCache(), transcription_workers=args.transcription_workers,
+                      engine_factory=engine_factory) as pipeline:
+        process_backlog(pipeline)
+    pipeline_seconds = time.perf_counter() - start
+
+    query_seconds = None
+    if args.queries:
+        import telebot
+        from app.query_service import QueryService
+        from app.user_interaction import answer_message, create_bot
+
+        telebot.apihelper.API_URL = args.telegram_api_url
+        bot = create_bot(BOT_TOKEN)
+        service = QueryService(bot, answer_message, concurrency=args.query_concurrency)
+        registry.set("telegram_bot", bot)
+        registry.set("query_service", service)
+        threading.Thread(target=bot.infinity_polling, kwargs={"timeout": 5, "long_polling_timeout": 1},
+                         daemon=True).start()
+        words = ("project", "budget", "meeting", "deadline", "design", "customer", "launch", "travel")
+        start = time.perf_counter()
+        for index in range(args.queries):
+            requests.post(args.telegram_api_url.format(BOT_TOKEN, "injectMessage"),
+                          data={"chat_id": 1000 + index % args.users,
+                                "text": f"What did I say about the {words[index % len(words)]}?"}).raise_for_status()
+            time.sleep(args.query_interval)
+        # Every query is counted once it is answered, expired or turned away
+        while sum(value for series, value in metrics.snapshot()['counters'].items()
+                  if series.startswith("queries_total")) < args.queries:
+            time.sleep(0.05)
+        service.close()
+        bot.stop_polling()
+        query_seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        "pipeline_seconds": pipeline_seconds,
+        "query_seconds": query_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        # The transcription workers have exited by now, so they are accounted as children
+        "peak_worker_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "metrics": metrics.snapshot(),
+    }))
+
+def stage_report(snapshot, series, seconds, items=None):
+    """
+    Summarise a latency histogram. `items` is the number of memos handled, when runs are batches.
+    """
+    summary = snapshot['histograms'].get(series)
+    if summary is None:
+        return None
+    items = summary['count'] if items is None else items
+    return {
+        "runs": summary['count'],
+        "items": items,
+        "busy_seconds": round(summary['sum'], 3),
+        # Memos per second of the whole run, and per second spent in the stage (its capacity per worker)
+        "per_second": round(items / seconds, 3) if seconds else None,
+        "per_busy_second": round(items / summary['sum'], 3) if summary['sum'] else None,
+        **{key: round(summary[key], 4) if summary[key] is not None else None for key in ("p50", "p95", "p99")},
+    }
+
+def build_report(args, corpus, result, telegram, icloud, completion):
+    snapshot = result['metrics']
+    counters = snapshot['counters']
+    seconds = result['pipeline_seconds']
+    stages = {"import": stage_report(snapshot, "import_download_seconds", seconds)}
+    for stage in STAGES:
+        batches = snapshot['histograms'].get(f'pipeline_batch_size{{stage="{stage}"}}')
+        stages[stage] = stage_report(snapshot, f'pipeline_stage_seconds{{stage="{stage}"}}', seconds,
+                                     items=int(batches['sum']) if batches else None)
+    stages["memo"] = stage_report(snapshot, "pipeline_memo_seconds", seconds)
+
+    report = {
+        "benchmark": "pipeline",
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                 text=True).stdout.strip() or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {key: value for key, value in vars(args).items()
+                       if key not in ("case", "output", "baseline", "telegram_api_url")},
+        "corpus": corpus,
+        "pipeline": {
+            "seconds": round(seconds, 3),
+            "memos_done": counters.get('pipeline_memos_total{status="done"}', 0),
+            "memos_failed": counters.get('pipeline_memos_total{status="failed"}', 0),
+            "memos_per_second": round(counters.get('pipeline_memos_total{status="done"}', 0) / seconds, 3),
+            "audio_seconds_per_second": round(corpus['audio_seconds'] / seconds, 1),
+            "transcribed_audio_seconds": round(counters.get("transcription_audio_seconds_total", 0.0), 1),
+        },
+        "stages": {stage: summary for stage, summary in stages.items() if summary is not None},
+        "memory": {"peak_rss_mb": result['peak_rss_mb'], "peak_worker_rss_mb": result['peak_worker_rss_mb']},
+        "services": {
+            "icloud_downloaded_bytes": icloud.downloaded_bytes,
+            "completion_requests": completion.requests,
+            "telegram_calls": len(telegram.sent),
+        },
+        "metrics": snapshot,
+    }
+    if args.queries:
+        results = latencies(telegram, sorted(telegram.received_at))
+        final = [entry[1] for entry in results if entry[1] is not None and not entry[2]]
+        report["queries"] = {
+            "sent": len(results),
+            "answered": len(final),
+            "timed_out": sum(entry[2] for entry in results),
+            "seconds": round(result['query_seconds'], 3),
+            "reply_p50": percentile(final, 50),
+            "reply_p95": percentile(final, 95),
+            "reply_p99": percentile(final, 99),
+            "answer": stage_report(snapshot, "query_seconds", result['query_seconds']),
+        }
+    return report
+
+def compare(report, baseline):
+    """
+    Print, per stage, the throughput, capacity and p95 latency against a baseline report.
+    """
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for stage, summary in report["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before:
+            continue
+        changes = []
+        for key in ("per_second", "per_busy_second", "p95"):
+            if summary.get(key) and before.get(key):
+                changes.append(f"{key} {before[key]:.4g} -> {summary[key]:.4g} ({summary[key] / before[key] - 1:+.0%})")
+        print(f"  {stage}: {', '.join(changes)}")
+    for key in ("peak_rss_mb", "peak_worker_rss_mb"):
+        print(f"  {key}: {baseline.get('memory', {}).get(key)} -> {report['memory'][key]}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--memos", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds of audio per memo")
+    parser.add_argument("--silence-ratio", type=float, default=0.3, help="Share of each memo that is silence (0-1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--whisper-rtf", type=float, default=0.05, help="Fake Whisper seconds per second of speech")
+    parser.add_argument("--ecapa-rtf", type=float, default=0.01, help="Fake ECAPA seconds per second of speech")
+    parser.add_argument("--transcription-workers", type=int, default=2)
+    parser.add_argument("--icloud-latency", type=float, default=0.05)
+    parser.add_argument("--completion-latency", type=float, default=0.3)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--queries", type=int, default=20, help="Questions sent to the bot after processing (0: none)")
+    parser.add_argument("--users", type=int, default=5, help="Chats the questions come from")
+    parser.add_argument("--query-interval", type=float, default=0.05, help="Seconds between questions")
+    parser.add_argument("--query-concurrency", type=int, default=8)
+    parser.add_argument("--output", default="bench_pipeline.json", help="Report file")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    parser.add_argument("--case", choices=["application"], help=argparse.SUPPRESS)
+    parser.add_argument("--telegram-api-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not 0 <= args.silence_ratio < 1:
+        parser.error("--silence-ratio must be at least 0 and below 1")
+
+    if args.case == "application":
+        run_application(args)
+        return
+
+    scratch = tempfile.mkdtemp(prefix="bench_pipeline_")
+    try:
+        memos, corpus = write_corpus(os.path.join(scratch, "corpus"), args.memos, args.duration,
+                                     args.silence_ratio, args.seed)
+        application_dir = os.path.join(scratch, "application")
+        os.makedirs(application_dir)
+        with FakeICloudServer(memos, latency=args.icloud_latency) as icloud, \
+                FakeCompletionServer(latency=args.completion_latency) as completion, \
+                FakeTelegramServer(latency=args.telegram_latency) as telegram:
+            env = dict(os.environ)
+            env.update({
+                # Some modules import their siblings by bare name, so the app directory is on the path as well
+                "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, os.path.join(ROOT, "app"), env.get("PYTHONPATH")])),
+                "ICLOUD_API_URL": icloud.url,
+                "OPENAI_API_BASE": completion.api_base,
+                "OPENAI_REQUESTS_PER_MINUTE": str(10 ** 6),
+                "OPENAI_TOKENS_PER_MINUTE": str(10 ** 9),
+                "METRICS_PORT": "0",
+            })
+            if "ENCRYPTION_KEY" not in env:
+                from cryptography.fernet import Fernet
+                env["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+            command = [sys.executable, "-m", "benchmarks.bench_pipeline", "--case", "application",
+                       "--telegram-api-url", telegram.api_url] + sys.argv[1:]
+            # STORAGE_PATH is relative, so the application keeps its data in the scratch directory
+            output = subprocess.run(command, env=env, cwd=application_dir, capture_output=True, text=True)
+            if output.returncode != 0:
+                sys.exit(f"The application failed:\n{output.stderr[-4000:]}")
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            report = build_report(args, corpus, result, telegram, icloud, completion)
+    finally:
+        if args.keep:
+            print(f"Scratch directory kept at {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps({key: report[key] for key in ("pipeline", "memory") + (("queries",) if args.queries else ())}))
+    for stage, summary in report["stages"].items():
+        print(json.dumps(dict(stage=stage, **summary)))
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(report, json.load(file))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Measure Telegram reply latency under concurrent users against a local fake Telegram Bot API.
+
+Simulated users each send a series of questions, waiting a random think time between them. The
+bot long-polls the fake API and answers through the QueryService, with answering replaced by a
+sleep drawn from a log-normal distribution around --answer-seconds (retrieval plus completion).
+Reported per worker count: percentiles of the time from a question arriving to its final answer
+being sent (or edited into the acknowledgement), of the time to the first reply of any kind,
+and the outcome counts. --concurrency 1 approximates the former one-at-a-time handler.
+
+Usage:
+    python -m benchmarks.bench_query_service --users 40 --questions 3 --concurrency 1 8 32
+"""
+import argparse
+import json
+import math
+import random
+import statistics
+import threading
+import time
+
+from app.query_service import ACKNOWLEDGEMENT_REPLY, TIMEOUT_REPLY, QueryService
+from app.registry import registry
+from benchmarks.stubs import FakeTelegramServer
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(math.ceil(q / 100 * len(values))) - 1)], 3)
+
+def simulate_users(server, users, questions, think_seconds):
+    """
+    Send every user's questions from one thread per user. Returns the injected message IDs.
+    """
+    injected, lock = [], threading.Lock()
+
+    def user(chat_id):
+        for number in range(questions):
+            time.sleep(random.expovariate(1 / think_seconds))
+            message_id = server.inject_message(chat_id, f"what did I say about project {chat_id}-{number}?")
+            with lock:
+                injected.append(message_id)
+
+    threads = [threading.Thread(target=user, args=(1000 + index,)) for index in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return injected
+
+def latencies(server, injected):
+    """
+    Return, per question, (seconds to the first reply, seconds to the final reply, whether it timed
+    out); None for replies that were never sent.
+    """
+    replies = {event["reply_to"]: event for event in server.sent if event["reply_to"] is not None}
+    edits = {}
+    for event in server.sent:
+        if event["method"] == "editMessageText":
+            edits.setdefault(event["message_id"], event)
+    results = []
+    for message_id in injected:
+        reply = replies.get(message_id)
+        if reply is None:
+            results.append((None, None, False))
+            continue
+        final = edits.get(reply["message_id"]) if reply["text"] == ACKNOWLEDGEMENT_REPLY else reply
+        received = server.received_at[message_id]
+        results.append((reply["time"] - received, final["time"] - received if final else None,
+                        final is not None and final["text"] == TIMEOUT_REPLY))
+    return results
+
+def run(args, concurrency):
+    import telebot
+    from app.user_interaction import create_bot
+
+    def answer(text):
+        time.sleep(random.lognormvariate(math.log(args.answer_seconds), args.answer_spread))
+        return f"Here is what I found about {text}"
+
+    with FakeTelegramServer(latency=args.api_latency) as server:
+        telebot.apihelper.API_URL = server.api_url
+        bot = create_bot("123456:benchmark")
+        service = QueryService(bot, answer, concurrency=concurrency, ack_seconds=args.ack_seconds,
+                               deadline_seconds=args.deadline_seconds)
+        registry.set("telegram_bot", bot)
+        registry.set("query_service", service)
+        poller = threading.Thread(target=bot.infinity_polling, kwargs={"timeout": 5, "long_polling_timeout": 1},
+                                  daemon=True)
+        poller.start()
+
+        start = time.perf_counter()
+        injected = simulate_users(server, args.users, args.questions, args.think_seconds)
+        server.wait_until_polled()
+        service.close()
+        # Edits of acknowledgements may still be on their way
+        time.sleep(args.api_latency + 0.5)
+        seconds = time.perf_counter() - start
+        bot.stop_polling()
+        results = latencies(server, injected)
+
+    first = [result[0] for result in results if result[0] is not None]
+    final = [result[1] for result in results if result[1] is not None and not result[2]]
+    return {
+        "concurrency": concurrency,
+        "questions": len(injected),
+        "seconds": round(seconds, 2),
+        "answered": len(final),
+        "timed_out": sum(result[2] for result in results),
+        "unanswered": len(injected) - len(final) - sum(result[2] for result in results),
+        "reply_p50": percentile(final, 50),
+        "reply_p95": percentile(final, 95),
+        "reply_p99": percentile(final, 99),
+        "first_response_p99": percentile(first, 99),
+        "reply_mean": round(statistics.mean(final), 3) if final else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--questions", type=int, default=3, help="Questions per user")
+    parser.add_argument("--think-seconds", type=float, default=2.0, help="Mean pause before each question")
+    parser.add_argument("--answer-seconds", type=float, default=1.0, help="Median time to answer a question")
+    parser.add_argument("--answer-spread", type=float, default=0.6, help="Log-normal sigma of the answer time")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="Seconds each Bot API call takes")
+    parser.add_argument("--ack-seconds", type=float, default=2.0)
+    parser.add_argument("--deadline-seconds", type=float, default=60.0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    args = parser.parse_args()
+    for concurrency in args.concurrency:
+        print(json.dumps(run(args, concurrency)))
+
+if __name__ == "__main__":
+    main()
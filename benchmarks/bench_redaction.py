@@ -0,0 +1,124 @@
+"""
+Measure redaction throughput (MB/s of transcript text).
+
+Cases, per dictionary size (--terms names):
+- single-pass: Redactor.redact, one scan of the combined pattern, against the naive approach of one
+  re.sub per built-in pattern and per dictionary term.
+- stream: Redactor.redact_stream over --chunk-kb chunks.
+- bulk: Redactor.redact_many over the corpus, per process count. Parallel speedup needs as many
+  free cores.
+
+The corpus is synthetic transcript text in which about --density of the words are names, phone
+numbers, email addresses or street addresses.
+
+Usage:
+    python -m benchmarks.bench_redaction --size-mb 16 --terms 100 1000 10000 --workers 1 2 4
+"""
+import argparse
+import json
+import random
+import re
+import time
+
+from app.redaction import PATTERNS, Redactor
+
+WORDS = ("so the meeting about the budget went fine and we agreed to follow up with the team next week "
+         "on the launch plan then I need to call about the design review and send the notes").split()
+STREETS = ("Elm", "Oak", "Baker", "Main", "Maple", "Harbor", "Mill")
+SUFFIXES = ("Street", "Avenue", "Road", "Lane", "Drive")
+
+def throughput(function, characters, repeat=3):
+    """
+    Best of `repeat` runs, in MB/s of text.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return round(characters / best / 1e6, 3)
+
+def make_names(count, rng):
+    first = ["Ann", "Bob", "Carla", "Dev", "Elif", "Farid", "Grace", "Hiro", "Ines", "Jon", "Kemal", "Lena"]
+    return sorted({f"{rng.choice(first)} {''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(7)).title()}"
+                   for _ in range(count)})
+
+def make_corpus(size_mb, names, density, rng):
+    """
+    Return transcripts of about 20 kB each, together about size_mb megabytes.
+    """
+    entities = [
+        lambda: rng.choice(names),
+        lambda: f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(1000, 9999)}",
+        lambda: f"{rng.choice(names).split()[0].lower()}@example.com",
+        lambda: f"{rng.randint(1, 999)} {rng.choice(STREETS)} {rng.choice(SUFFIXES)}",
+    ]
+    transcripts, total = [], 0
+    while total < size_mb * 1e6:
+        words = [rng.choice(entities)() if rng.random() < density else rng.choice(WORDS) for _ in range(3500)]
+        transcripts.append(" ".join(words))
+        total += len(transcripts[-1])
+    return transcripts
+
+def naive_redact(text, patterns):
+    for pattern in patterns:
+        text = pattern.sub("[REDACTED]", text)
+    return text
+
+def bench(size_mb, term_count, workers, chunk_kb, density, seed):
+    rng = random.Random(seed)
+    names = make_names(term_count, rng)
+    transcripts = make_corpus(size_mb, names, density, rng)
+    total = sum(len(text) for text in transcripts)
+    redactor = Redactor({"NAME": names}, workers=1)
+    results = [{
+        "case": "single-pass",
+        "terms": len(names),
+        "size_mb": round(total / 1e6, 1),
+        "mb_s": throughput(lambda: [redactor.redact(text) for text in transcripts], total),
+    }]
+
+    # The naive approach scans the text once per term, so it is measured on a few transcripts
+    sample = transcripts[:4]
+    naive = [re.compile(pattern, re.IGNORECASE) for _, pattern in PATTERNS.values()]
+    naive += [re.compile(r"\b" + re.escape(name) + r"\b", re.IGNORECASE) for name in names]
+    results[0]["naive_mb_s"] = throughput(lambda: [naive_redact(text, naive) for text in sample],
+                                          sum(len(text) for text in sample), repeat=1)
+
+    chunk = chunk_kb * 1024
+    results.append({
+        "case": "stream",
+        "terms": len(names),
+        "chunk_kb": chunk_kb,
+        "mb_s": throughput(lambda: [list(redactor.redact_stream(text[i:i + chunk] for i in range(0, len(text), chunk)))
+                                    for text in transcripts], total),
+    })
+
+    for count in workers:
+        bulk = Redactor({"NAME": names}, workers=count)
+        bulk.redact_many(transcripts[:count * 2])  # start the worker processes outside the measurement
+        results.append({
+            "case": "bulk",
+            "terms": len(names),
+            "workers": count,
+            "mb_s": throughput(lambda: bulk.redact_many(transcripts), total),
+        })
+        bulk.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=16, help="Text per measurement")
+    parser.add_argument("--terms", type=int, nargs="+", default=[100, 1000, 10000], help="Dictionary sizes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--chunk-kb", type=int, default=4, help="Chunk size in the stream case")
+    parser.add_argument("--density", type=float, default=0.02, help="Share of words that are personal information")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for term_count in args.terms:
+        for result in bench(args.size_mb, term_count, args.workers, args.chunk_kb, args.density, args.seed):
+            print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
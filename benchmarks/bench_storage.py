@@ -0,0 +1,91 @@
+"""
+Compare peak RSS and throughput of StorageManager's streaming encryption against the previous
+whole-file Fernet path.
+
+Each case runs in its own interpreter so peak RSS is measured independently.
+
+Usage:
+    python -m benchmarks.bench_storage --size-mb 256
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+CHUNK = 1024 * 1024
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_legacy(storage_manager, size_mb, storage_dir):
+    """
+    The pre-streaming path: the whole payload as a string, Fernet over all of it, base64 text on disk.
+    """
+    file_path = os.path.join(storage_dir, "legacy.txt")
+    start = time.perf_counter()
+    data = "x" * (size_mb * CHUNK)
+    with open(file_path, 'w') as file:
+        file.write(storage_manager.fernet.encrypt(data.encode()).decode())
+    del data
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(file_path, 'r') as file:
+        data = storage_manager.fernet.decrypt(file.read().encode()).decode()
+    assert len(data) == size_mb * CHUNK
+    read_seconds = time.perf_counter() - start
+    return write_seconds, read_seconds
+
+def run_stream(storage_manager, size_mb, storage_dir):
+    storage_manager.storage_path = storage_dir
+    start = time.perf_counter()
+    storage_manager.save_stream((b"x" * CHUNK for _ in range(size_mb)), "stream", "transcription")
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    total = sum(len(chunk) for chunk in storage_manager.iter_data("stream", "transcription", chunk_size=CHUNK))
+    assert total == size_mb * CHUNK
+    read_seconds = time.perf_counter() - start
+    return write_seconds, read_seconds
+
+def run_case(case, size_mb):
+    from app.storage import StorageManager
+    storage_manager = StorageManager()
+    with tempfile.TemporaryDirectory() as storage_dir:
+        runner = run_legacy if case == "legacy" else run_stream
+        write_seconds, read_seconds = runner(storage_manager, size_mb, storage_dir)
+    return {
+        "case": case,
+        "size_mb": size_mb,
+        "write_mb_per_s": round(size_mb / write_seconds, 1),
+        "read_mb_per_s": round(size_mb / read_seconds, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--case", choices=["legacy", "stream"], help="Run a single case in this process")
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.size_mb)))
+        return
+
+    env = dict(os.environ)
+    if "ENCRYPTION_KEY" not in env:
+        from cryptography.fernet import Fernet
+        env["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+    for case in ("legacy", "stream"):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_storage", "--case", case,
+                                 "--size-mb", str(args.size_mb)], env=env, check=True, capture_output=True, text=True)
+        print(output.stdout.strip())
+
+if __name__ == "__main__":
+    main()
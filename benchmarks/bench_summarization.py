@@ -0,0 +1,43 @@
+"""
+Measure AsyncSummarizer throughput against a local fake completion server as concurrency grows.
+
+Usage:
+    python -m benchmarks.bench_summarization --items 200 --latency 0.2 --concurrency 1 4 16 32
+"""
+import argparse
+import json
+import time
+
+from app.summarization import AsyncSummarizer
+from benchmarks.stubs import FakeCompletionServer
+
+def run(items, concurrency, server):
+    summarizer = AsyncSummarizer(concurrency=concurrency, requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9,
+                                 api_base=server.api_base, backoff_base=0.05)
+    transcriptions = [f"memo {index} " + "words spoken into the watch " * 50 for index in range(items)]
+    requests_before = server.requests
+    start = time.perf_counter()
+    summaries, errors = summarizer.run(transcriptions)
+    seconds = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "items": items,
+        "seconds": round(seconds, 2),
+        "summaries_per_s": round(items / seconds, 1),
+        "failed": len(errors),
+        "requests": server.requests - requests_before,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    args = parser.parse_args()
+    with FakeCompletionServer(latency=args.latency, rate_limit_ratio=args.rate_limit_ratio) as server:
+        for concurrency in args.concurrency:
+            print(json.dumps(run(args.items, concurrency, server)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measure how much audio the voice activity detector keeps for transcription and embedding, and how
+fast it runs, on synthetic recordings with a known share of silence.
+
+Speech is stood in for by amplitude-modulated noise at conversational level and silence by
+low-level background noise. The audio kept should track the speech share (plus padding) while
+covering all of the speech, so Whisper and ECAPA time falls roughly with the silence ratio.
+
+Usage:
+    python -m benchmarks.bench_vad --minutes 30 --silence-ratio 0.2 0.5 0.8
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from app.vad import SpeechDetector
+
+SAMPLE_RATE = 16000
+
+def synthesize(minutes, silence_ratio, seed=0):
+    """
+    Return (audio, speech_intervals) for a recording alternating speech and silence.
+    """
+    rng = np.random.default_rng(seed)
+    parts, intervals, position = [], [], 0.0
+    while position < minutes * 60:
+        speech = rng.uniform(1, 15)
+        silence = speech * silence_ratio / (1 - silence_ratio) * rng.uniform(0.5, 1.5)
+        parts.append(0.002 * rng.standard_normal(int(silence * SAMPLE_RATE)))
+        samples = int(speech * SAMPLE_RATE)
+        envelope = 0.5 + 0.5 * np.abs(np.sin(np.arange(samples) / SAMPLE_RATE * 2 * np.pi * 3))
+        parts.append(0.1 * rng.standard_normal(samples) * envelope)
+        intervals.append((position + silence, position + silence + speech))
+        position += silence + speech
+    return np.concatenate(parts).astype(np.float32), intervals
+
+def run(minutes, silence_ratio):
+    audio, intervals = synthesize(minutes, silence_ratio)
+    detector = SpeechDetector(SAMPLE_RATE)
+    blocks = (audio[start:start + 10 * SAMPLE_RATE] for start in range(0, len(audio), 10 * SAMPLE_RATE))
+    start = time.perf_counter()
+    segments = [(begin, end) for begin, end, _ in detector.segments(blocks)]
+    seconds = time.perf_counter() - start
+
+    duration = len(audio) / SAMPLE_RATE
+    speech = sum(end - begin for begin, end in intervals)
+    kept = sum(end - begin for begin, end in segments)
+    covered = sum(max(0.0, min(end, segment_end) - max(begin, segment_begin))
+                  for begin, end in intervals for segment_begin, segment_end in segments
+                  if segment_begin < end and begin < segment_end)
+    return {
+        "silence_ratio": silence_ratio,
+        "audio_minutes": round(duration / 60, 1),
+        "segments": len(segments),
+        "speech_share": round(speech / duration, 3),
+        "kept_share": round(kept / duration, 3),
+        "speech_covered": round(min(covered / speech, 1.0), 4),
+        "realtime_factor": round(duration / seconds),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=30)
+    parser.add_argument("--silence-ratio", type=float, nargs="+", default=[0.2, 0.5, 0.8])
+    args = parser.parse_args()
+    for silence_ratio in args.silence_ratio:
+        print(json.dumps(run(args.minutes, silence_ratio)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare brute-force and IVF search in VectorStore for recall@k and latency as the corpus grows.
+
+Vectors are synthetic: points scattered around random topic centres, with queries drawn near
+the same centres, which approximates how transcript chunks cluster by topic.
+
+Usage:
+    python -m benchmarks.bench_vector_search --sizes 10000 50000 200000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+if "ENCRYPTION_KEY" not in os.environ:
+    from cryptography.fernet import Fernet
+    os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+
+from app.vector_store import VectorStore
+
+class SyntheticEmbedder:
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.name = f"synthetic-{dimension}"
+
+    def __call__(self, texts):
+        raise NotImplementedError("The benchmark only searches precomputed vectors")
+
+def synthetic_vectors(rng, centres, count, noise):
+    picks = rng.integers(0, len(centres), count)
+    return (centres[picks] + noise * rng.standard_normal((count, centres.shape[1]))).astype(np.float32)
+
+def percentile_ms(latencies, percentile):
+    return round(float(np.percentile(latencies, percentile)) * 1000, 3)
+
+def run(size, dimension, queries, k, nprobes, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(16, size // 500), dimension))
+    vectors = synthetic_vectors(rng, centres, size, noise=0.6)
+    query_vectors = synthetic_vectors(rng, centres, queries, noise=0.6)
+
+    with tempfile.TemporaryDirectory() as store_path:
+        store = VectorStore(store_path, embedder=SyntheticEmbedder(dimension))
+        start = time.perf_counter()
+        store.add_vectors([[f"memo{row // 10}", row % 10] for row in range(size)], vectors)
+        append_seconds = time.perf_counter() - start
+
+        def timed(mode, nprobe=None):
+            latencies, results = [], []
+            for query in query_vectors:
+                start = time.perf_counter()
+                hits = store.search_vectors(query, k=k, mode=mode, nprobe=nprobe or 1)[0]
+                latencies.append(time.perf_counter() - start)
+                results.append({(hit['memo_id'], hit['chunk_index']) for hit in hits})
+            return latencies, results
+
+        exact_latencies, truth = timed("brute")
+        start = time.perf_counter()
+        batched = store.search_vectors(query_vectors, k=k)
+        batched_seconds = time.perf_counter() - start
+        assert len(batched) == queries
+
+        report = {
+            "size": size,
+            "append_rows_per_s": round(size / append_seconds),
+            "brute": {"p50_ms": percentile_ms(exact_latencies, 50), "p99_ms": percentile_ms(exact_latencies, 99),
+                      "batched_ms_per_query": round(batched_seconds / queries * 1000, 3)},
+        }
+        start = time.perf_counter()
+        store.build_ivf()
+        report["ivf_build_s"] = round(time.perf_counter() - start, 2)
+        for nprobe in nprobes:
+            latencies, results = timed("ivf", nprobe)
+            recall = np.mean([len(found & expected) / max(1, len(expected)) for found, expected in zip(results, truth)])
+            report[f"ivf_nprobe_{nprobe}"] = {"recall_at_k": round(float(recall), 4),
+                                              "p50_ms": percentile_ms(latencies, 50),
+                                              "p99_ms": percentile_ms(latencies, 99)}
+        return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16])
+    args = parser.parse_args()
+    for size in args.sizes:
+        print(json.dumps(run(size, args.dimension, args.queries, args.k, args.nprobe)))
+
+if __name__ == "__main__":
+    main()
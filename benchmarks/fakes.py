@@ -0,0 +1,88 @@
+"""
+Lightweight stand-ins for the Whisper and ECAPA models, for benchmarks and manual testing.
+
+They take the place of the models only: audio is still decoded, cut by voice activity detection
+and batched by the application's own code, and each model call sleeps for a configurable fraction
+of the audio it is given, so stage timings keep the shape of a real run.
+
+Usage:
+    registry.set("speaker_embedder", FakeSpeakerEmbedder(real_time_factor=0.01))
+    MemoPipeline(engine_factory=functools.partial(FakeWhisperEngine, real_time_factor=0.05))
+"""
+import time
+
+import numpy as np
+
+from app.config import (SPEAKER_EMBEDDING_BATCH_SIZE, SPEAKER_EMBEDDING_MAX_BATCH_SECONDS, SPEAKER_EMBEDDING_WORKERS,
+                        SPEAKER_SAMPLE_RATE, SPEAKER_WINDOW_SECONDS, TRANSCRIPTION_WINDOW_OVERLAP_SECONDS,
+                        TRANSCRIPTION_WINDOW_SECONDS, VAD_ENABLED)
+from app.metadata_extraction import SpeakerEmbedder
+from app.transcription import WHISPER_SAMPLE_RATE, WhisperEngine
+
+WORDS = ("project budget meeting deadline design review customer launch follow up idea schedule travel "
+         "research draft call team notes priority feedback plan").split()
+# ECAPA-TDNN embeddings have 192 dimensions
+EMBEDDING_DIMENSION = 192
+
+class FakeWhisperModel:
+    """
+    Stands in for a loaded Whisper model: one segment per 5 seconds of audio, with filler words
+    chosen from the audio itself, so the same audio always gets the same text.
+    """
+
+    def __init__(self, real_time_factor=0.05, words_per_second=2.5):
+        self.real_time_factor = real_time_factor
+        self.words_per_second = words_per_second
+
+    def transcribe(self, audio, **options):
+        seconds = len(audio) / WHISPER_SAMPLE_RATE
+        time.sleep(seconds * self.real_time_factor)
+        segments = []
+        for start in np.arange(0.0, seconds, 5.0):
+            end = min(seconds, start + 5.0)
+            piece = audio[int(start * WHISPER_SAMPLE_RATE):int(end * WHISPER_SAMPLE_RATE)]
+            seed = int(np.abs(piece[:1024]).sum() * 1e4) if len(piece) else 0
+            words = np.random.default_rng(seed).choice(WORDS, max(1, int((end - start) * self.words_per_second)))
+            segments.append({"start": float(start), "end": float(end), "text": " " + " ".join(words)})
+        return {"segments": segments}
+
+class FakeWhisperEngine(WhisperEngine):
+    """
+    WhisperEngine with FakeWhisperModel in place of the Whisper model. Picklable through
+    functools.partial, so it can be passed as the engine_factory of transcription worker processes.
+    """
+
+    def __init__(self, real_time_factor=0.05, window_seconds=TRANSCRIPTION_WINDOW_SECONDS,
+                 overlap_seconds=TRANSCRIPTION_WINDOW_OVERLAP_SECONDS, vad=VAD_ENABLED):
+        self.window_seconds = window_seconds
+        self.overlap_seconds = overlap_seconds
+        self.vad = vad
+        self.audio_seconds = 0.0
+        self.model_name = "fake-whisper"
+        self.model = FakeWhisperModel(real_time_factor)
+
+class FakeSpeakerEmbedder(SpeakerEmbedder):
+    """
+    SpeakerEmbedder with a spectral fingerprint in place of the ECAPA model: each window is
+    embedded as its normalised log energy in EMBEDDING_DIMENSION frequency bands.
+    """
+
+    def __init__(self, real_time_factor=0.01, sample_rate=SPEAKER_SAMPLE_RATE, batch_size=SPEAKER_EMBEDDING_BATCH_SIZE,
+                 max_batch_seconds=SPEAKER_EMBEDDING_MAX_BATCH_SECONDS, workers=SPEAKER_EMBEDDING_WORKERS,
+                 window_seconds=SPEAKER_WINDOW_SECONDS, vad=VAD_ENABLED):
+        self.real_time_factor = real_time_factor
+        self.sample_rate = sample_rate
+        self.batch_size = max(1, min(batch_size, int(max_batch_seconds // window_seconds)))
+        self.workers = workers
+        self.window_seconds = window_seconds
+        self.vad = vad
+
+    def encode_waveforms(self, waveforms):
+        time.sleep(sum(len(waveform) for waveform in waveforms) / self.sample_rate * self.real_time_factor)
+        embeddings = []
+        for waveform in waveforms:
+            spectrum = np.abs(np.fft.rfft(np.asarray(waveform, dtype=np.float32), n=4096)) ** 2
+            bands = np.log1p(np.add.reduceat(spectrum, np.linspace(0, len(spectrum) - 1, EMBEDDING_DIMENSION,
+                                                                   dtype=int)))
+            embeddings.append(bands / max(np.linalg.norm(bands), 1e-12))
+        return np.asarray(embeddings, dtype=np.float32)
@@ -0,0 +1,326 @@
+"""
+Local stand-ins for the external services the pipeline talks to, for benchmarks and manual testing.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+class _StubServer:
+    """
+    Base class running a ThreadingHTTPServer on a free local port in a background thread.
+    """
+
+    def __init__(self, handler_class):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. a long poll cut short when the bot stopped
+            pass
+
+class _CompletionHandler(_JsonHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        request = self._read_json()
+        stub.record_request()
+        time.sleep(stub.latency)
+        if random.random() < stub.rate_limit_ratio:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                            headers={"Retry-After": "0"})
+            return
+        if random.random() < stub.error_ratio:
+            self._send_json(503, {"error": {"message": "Service unavailable", "type": "server_error"}})
+            return
+        prompt = request.get("prompt", "")
+        words = prompt.split()
+        text = " ".join(words[-min(len(words), stub.completion_words):])
+        self._send_json(200, {
+            "id": "cmpl-stub",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"text": f" {text}", "index": 0, "logprobs": None, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(words), "completion_tokens": stub.completion_words,
+                      "total_tokens": len(words) + stub.completion_words},
+        })
+
+class FakeCompletionServer(_StubServer):
+    """
+    Fake OpenAI completion endpoint. Point OPENAI_API_BASE (or an AsyncSummarizer's api_base) at `url + "v1"`.
+
+    Parameters:
+    - latency: Seconds each request takes.
+    - rate_limit_ratio: Fraction of requests answered with 429.
+    - error_ratio: Fraction of requests answered with 503.
+    - completion_words: Number of words echoed back as the completion.
+    """
+
+    def __init__(self, latency=0.2, rate_limit_ratio=0.0, error_ratio=0.0, completion_words=30):
+        super().__init__(_CompletionHandler)
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.error_ratio = error_ratio
+        self.completion_words = completion_words
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def api_base(self):
+        return self.url + "v1"
+
+class _TelegramHandler(_JsonHandler):
+    def _params(self):
+        query = self.path.partition("?")[2]
+        params = {key: values[-1] for key, values in parse_qs(query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update({key: values[-1] for key, values in parse_qs(body.decode()).items()})
+        return params
+
+    def _handle(self):
+        stub = self.server.stub
+        method = self.path.partition("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        handler = getattr(stub, "api_" + method, None)
+        if handler is None:
+            self._send_json(404, {"ok": False, "error_code": 404, "description": f"Unknown method {method}"})
+            return
+        self._send_json(200, {"ok": True, "result": handler(self._params())})
+
+    do_GET = _handle
+    do_POST = _handle
+
+class FakeTelegramServer(_StubServer):
+    """
+    Fake Telegram Bot API. Point telebot at it with telebot.apihelper.API_URL = server.api_url.
+
+    inject_message() (or the injectMessage method, over HTTP) queues an incoming user message for
+    getUpdates; the bot's sendMessage and editMessageText calls are recorded with their arrival
+    time in `sent`, as dictionaries with 'time', 'method', 'chat_id', 'message_id', 'reply_to' and
+    'text'.
+
+    Parameters:
+    - latency: Seconds each Bot API call takes.
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__(_TelegramHandler)
+        self.latency = latency
+        self.sent = []
+        self.received_at = {}
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._condition = threading.Condition()
+
+    @property
+    def api_url(self):
+        return self.url + "bot{0}/{1}"
+
+    def _message(self, chat_id, text, from_bot):
+        with self._condition:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        sender = {"id": 1 if from_bot else int(chat_id), "is_bot": from_bot, "first_name": "Bot" if from_bot else "User"}
+        return {"message_id": message_id, "date": int(time.time()), "text": text, "from": sender,
+                "chat": {"id": int(chat_id), "type": "private"}}
+
+    def inject_message(self, chat_id, text):
+        """
+        Queue a message from a user. Returns its message ID.
+        """
+        message = self._message(chat_id, text, from_bot=False)
+        with self._condition:
+            self.received_at[message["message_id"]] = time.monotonic()
+            self._updates.append({"update_id": self._next_update_id, "message": message})
+            self._next_update_id += 1
+            self._condition.notify_all()
+        return message["message_id"]
+
+    def api_injectMessage(self, params):
+        """
+        inject_message() over HTTP, for a bot under test running in another process.
+        """
+        return {"message_id": self.inject_message(params["chat_id"], params["text"])}
+
+    def _record(self, method, chat_id, message_id, reply_to, text):
+        with self._condition:
+            self.sent.append({"time": time.monotonic(), "method": method, "chat_id": int(chat_id),
+                              "message_id": int(message_id), "reply_to": reply_to, "text": text})
+
+    def api_getMe(self, params):
+        return {"id": 1, "is_bot": True, "first_name": "Bot", "username": "stub_bot"}
+
+    def api_deleteWebhook(self, params):
+        return True
+
+    def api_setWebhook(self, params):
+        return True
+
+    def wait_until_polled(self, timeout=30.0):
+        """
+        Wait until the bot has confirmed receiving every injected message. Returns False on timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._updates, timeout)
+
+    def api_getUpdates(self, params):
+        offset = int(params.get("offset") or 0)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._condition:
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            self._condition.notify_all()
+            while not self._updates and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return list(self._updates)
+
+    def api_sendMessage(self, params):
+        time.sleep(self.latency)
+        reply_to = params.get("reply_to_message_id")
+        if params.get("reply_parameters"):
+            reply_to = json.loads(params["reply_parameters"]).get("message_id")
+        message = self._message(params["chat_id"], params.get("text", ""), from_bot=True)
+        self._record("sendMessage", params["chat_id"], message["message_id"],
+                     int(reply_to) if reply_to is not None else None, message["text"])
+        return message
+
+    def api_editMessageText(self, params):
+        time.sleep(self.latency)
+        self._record("editMessageText", params["chat_id"], params["message_id"], None, params.get("text", ""))
+        message = self._message(params["chat_id"], params.get("text", ""), from_bot=True)
+        message["message_id"] = int(params["message_id"])
+        return message
+
+class _ICloudHandler(_JsonHandler):
+    def do_POST(self):
+        stub = self.server.stub
+        self._read_json()
+        if self.path.rstrip("/").endswith("/auth"):
+            self._send_json(200, {"token": stub.token})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_GET(self):
+        stub = self.server.stub
+        if self.headers.get("Authorization") != f"Bearer {stub.token}":
+            self._send_json(401, {"error": "unauthorized"})
+            return
+        time.sleep(stub.latency)
+        parts = self.path.partition("?")[0].strip("/").split("/")
+        if parts == ["voice_memos"]:
+            self._send_json(200, {"voice_memos": stub.listing()})
+        elif len(parts) == 3 and parts[0] == "voice_memos" and parts[2] == "audio" and parts[1] in stub.memos:
+            self._send_audio(stub, stub.memos[parts[1]])
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _send_audio(self, stub, path):
+        size = os.path.getsize(path)
+        offset = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range") in (None, stub.etag(path)):
+            offset = int(match.group(1))
+            if offset >= size:
+                # As a real server does when nothing is left to send
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - offset))
+        self.send_header("ETag", stub.etag(path))
+        if offset:
+            self.send_header("Content-Range", f"bytes {offset}-{size - 1}/{size}")
+        self.end_headers()
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            for chunk in iter(lambda: file.read(256 * 1024), b""):
+                self.wfile.write(chunk)
+                stub.record_download(len(chunk))
+
+class FakeICloudServer(_StubServer):
+    """
+    Fake iCloud voice memo API (the auth, voice_memos and voice_memos/<id>/audio endpoints used by
+    data_import). Point ICLOUD_API_URL at `url`.
+
+    Memos are served from local audio files; ranged requests are honoured so resumed downloads work.
+
+    Parameters:
+    - memos: Dictionary mapping each memo ID to the path of its audio file.
+    - latency: Seconds each listing or download request takes before the first byte.
+    """
+
+    def __init__(self, memos, latency=0.0):
+        super().__init__(_ICloudHandler)
+        self.memos = {str(memo_id): path for memo_id, path in memos.items()}
+        self.latency = latency
+        self.token = "stub-session-token"
+        self.downloaded_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def etag(path):
+        stat = os.stat(path)
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+    def listing(self):
+        return [{"id": memo_id, "modified": os.path.getmtime(path), "size": os.path.getsize(path),
+                 "etag": self.etag(path), "extension": os.path.splitext(path)[1]}
+                for memo_id, path in sorted(self.memos.items())]
+
+    def record_download(self, size):
+        with self._lock:
+            self.downloaded_bytes += size
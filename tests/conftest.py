@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+class MemoryStorage:
+    """
+    In-memory stand-in for StorageManager, with the methods the caches use.
+    """
+
+    def __init__(self):
+        self.records = {}
+
+    def exists(self, file_name, data_type):
+        return (data_type, file_name) in self.records
+
+    def save_data(self, data, file_name, data_type):
+        self.records[(data_type, file_name)] = data if isinstance(data, str) else data.decode()
+
+    def load_data(self, file_name, data_type):
+        return self.records[(data_type, file_name)]
+
+    def delete_data(self, file_name, data_type):
+        self.records.pop((data_type, file_name), None)
+
+@pytest.fixture(autouse=True, scope="session")
+def event_log(tmp_path_factory):
+    """
+    Send the events logged during the tests to a temporary file instead of event_log.txt in the
+    working directory.
+    """
+    from app import utils
+
+    log_file = str(tmp_path_factory.mktemp("log") / "event_log.txt")
+    utils._event_writers["event_log.txt"] = utils._EventWriter(log_file)
+    return log_file
+
+@pytest.fixture
+def memory_storage():
+    return MemoryStorage()
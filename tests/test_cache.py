@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from app import redaction
+from app.cache import INDEX_FILE_NAME, PipelineCache, ResponseCache
+from app.redaction import Redactor
+from app.registry import registry
+
+def test_summary_key_follows_redaction_settings(memory_storage, monkeypatch):
+    cache = PipelineCache(storage_manager=memory_storage)
+    content_hash = "0" * 64
+    monkeypatch.setattr(redaction, "REDACTION_ENABLED", False)
+    disabled = cache._key("summary", content_hash)
+
+    monkeypatch.setattr(redaction, "REDACTION_ENABLED", True)
+    try:
+        registry.set("redactor", Redactor(terms=["Ann Lee"], salt="test", workers=1))
+        enabled = cache._key("summary", content_hash)
+        registry.set("redactor", Redactor(terms=["Ann Lee", "Bob"], salt="test", workers=1))
+        more_terms = cache._key("summary", content_hash)
+        registry.set("redactor", Redactor(terms=["Ann Lee", "Bob"], salt="other", workers=1))
+        other_salt = cache._key("summary", content_hash)
+    finally:
+        registry.unload("redactor")
+
+    assert len({disabled, enabled, more_terms, other_salt}) == 4
+    # Stages keyed on raw audio are unaffected
+    assert cache._key("transcription", content_hash) == PipelineCache(storage_manager=memory_storage)._key(
+        "transcription", content_hash)
+
+@pytest.mark.parametrize("cached, asked", [
+    ("when did I meet alice", "when did I meet bob"),
+    ("did I approve the budget", "did I not approve the budget"),
+    ("what is the deadline for project 7", "what is the deadline for project 8"),
+])
+def test_near_duplicate_needs_the_same_content_words(memory_storage, cached, asked):
+    cache = ResponseCache(storage_manager=memory_storage, similarity_threshold=0.5)
+    cache.put(cached, "gpt-4", {"temperature": 0}, "cached answer", context="passages")
+    assert cache.get(asked, "gpt-4", {"temperature": 0}, context="passages", near_duplicates=True) is None
+
+def test_near_duplicate_reuses_a_rephrased_question(memory_storage):
+    cache = ResponseCache(storage_manager=memory_storage, similarity_threshold=0.5)
+    cache.put("when did I meet alice", "gpt-4", {"temperature": 0}, "in May", context="passages")
+    assert cache.get("so when did I meet alice", "gpt-4", {"temperature": 0}, context="passages",
+                     near_duplicates=True) == "in May"
+    # Off by default
+    cache = ResponseCache(storage_manager=memory_storage)
+    assert cache.get("so when did I meet alice", "gpt-4", {"temperature": 0}, context="passages",
+                     near_duplicates=True) is None
+
+def test_concurrent_puts_keep_every_entry(memory_storage):
+    cache = PipelineCache(storage_manager=memory_storage)
+    contents = [f"chunk {worker} {i}" for worker in range(4) for i in range(50)]
+
+    def put(worker):
+        for content in contents[worker::4]:
+            cache.put_content("chunk_summary", content, {"summary": content})
+
+    threads = [threading.Thread(target=put, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cache.flush()
+
+    reloaded = PipelineCache(storage_manager=memory_storage)
+    assert reloaded.stats()['entries'] == len(contents)
+    assert all(reloaded.get_content("chunk_summary", content) == {"summary": content} for content in contents)
+
+def test_index_is_saved_in_batches(memory_storage):
+    cache = PipelineCache(storage_manager=memory_storage, save_every=4)
+    saves = []
+    save_data = memory_storage.save_data
+    memory_storage.save_data = lambda data, name, data_type: (saves.append(name), save_data(data, name, data_type))
+    for i in range(10):
+        cache.put_content("chunk_summary", f"chunk {i}", f"summary {i}")
+    assert saves.count(INDEX_FILE_NAME) == 2
+
+    # Entries put since the last save are still found, as after a crash
+    reloaded = PipelineCache(storage_manager=memory_storage)
+    assert reloaded.stats()['entries'] == 8
+    assert reloaded.get_content("chunk_summary", "chunk 9") == "summary 9"
+    assert reloaded.stats()['entries'] == 9
+
+    cache.flush()
+    assert PipelineCache(storage_manager=memory_storage).stats()['entries'] == 10
+
+def test_response_cache_is_saved_in_batches(memory_storage):
+    cache = ResponseCache(storage_manager=memory_storage, save_every=3)
+    for number in range(4):
+        cache.put(f"question {number}", "gpt-4", {}, f"answer {number}")
+    assert ResponseCache(storage_manager=memory_storage).stats()['entries'] == 3
+
+    cache.close()
+    assert ResponseCache(storage_manager=memory_storage).get("question 3", "gpt-4", {}) == "answer 3"
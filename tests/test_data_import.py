@@ -0,0 +1,80 @@
+import json
+
+from app import data_import
+from app.data_import import (LEGACY_MANIFEST_FILE_NAME, audio_file_path_for, import_voice_memos_incrementally,
+                             load_manifest, memo_file_name, save_manifest)
+
+def test_memo_file_names_stay_in_the_storage_directory():
+    assert memo_file_name({"id": "AB-12_c"}) == "AB-12_c"
+    names = {memo_file_name({"id": memo_id}) for memo_id in ("../secret", ".._secret", "a/b", "a_b", "")}
+    assert len(names) == 5
+    assert all(name and "/" not in name and "." not in name for name in names)
+    assert audio_file_path_for({"id": "../x"}, "/audio").startswith("/audio/___x-")
+
+def test_a_memo_named_manifest_does_not_overwrite_the_manifest(memory_storage, monkeypatch):
+    memos = [{"id": "manifest", "modified": 2}, {"id": "kept", "modified": 1}]
+    save_manifest({"kept": data_import.memo_version(memos[1]), "deleted": {"modified": 0}}, memory_storage)
+    monkeypatch.setattr(data_import, "fetch_voice_memos", lambda token: memos)
+    monkeypatch.setattr(data_import, "download_voice_memos",
+                        lambda token, changed: ((memo, f"/audio/{memo['id']}.m4a", None) for memo in changed))
+
+    assert import_voice_memos_incrementally("token", memory_storage) == ["/audio/manifest.m4a"]
+    assert json.loads(memory_storage.load_data("manifest", "voice_memos")) == memos[0]
+    # The deleted memo leaves the manifest
+    assert set(load_manifest(memory_storage)) == {"manifest", "kept"}
+
+def test_legacy_manifest_is_read(memory_storage):
+    memory_storage.save_data(json.dumps({"kept": {"modified": 1}}), LEGACY_MANIFEST_FILE_NAME, "voice_memos")
+    assert load_manifest(memory_storage) == {"kept": {"modified": 1}}
+
+class FakeResponse:
+    def __init__(self, status_code, body=b""):
+        self.status_code, self.body = status_code, body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+class FakeSession:
+    def __init__(self, response):
+        self.response, self.requests = response, []
+
+    def get(self, url, headers, **kwargs):
+        self.requests.append(headers)
+        return self.response
+
+def test_a_complete_part_file_is_renamed_into_place(tmp_path, monkeypatch):
+    session = FakeSession(FakeResponse(416))
+    monkeypatch.setattr(data_import, "get_http_session", lambda: session)
+    (tmp_path / "memo.m4a.part").write_bytes(b"audio")
+    path = data_import.download_voice_memo("token", {"id": "memo", "size": 5, "etag": "v1"}, str(tmp_path))
+    assert open(path, 'rb').read() == b"audio" and session.requests == []
+
+    # Size unknown: the server's 416 says nothing is left to send
+    (tmp_path / "other.m4a.part").write_bytes(b"audio")
+    path = data_import.download_voice_memo("token", {"id": "other", "etag": "v1"}, str(tmp_path))
+    assert open(path, 'rb').read() == b"audio" and session.requests[0]["Range"] == "bytes=5-"
+
+def test_a_part_file_is_not_resumed_without_an_etag(tmp_path, monkeypatch):
+    session = FakeSession(FakeResponse(200, b"new version"))
+    monkeypatch.setattr(data_import, "get_http_session", lambda: session)
+    (tmp_path / "memo.m4a.part").write_bytes(b"old ver")
+    path = data_import.download_voice_memo("token", {"id": "memo", "size": 11}, str(tmp_path))
+    assert open(path, 'rb').read() == b"new version"
+    assert "Range" not in session.requests[0]
+
+def test_the_manifest_is_saved_in_batches(memory_storage, monkeypatch):
+    memos = [{"id": f"memo{number}", "modified": 1} for number in range(150)]
+    monkeypatch.setattr(data_import, "fetch_voice_memos", lambda token: memos)
+    monkeypatch.setattr(data_import, "download_voice_memos",
+                        lambda token, changed: ((memo, f"/audio/{memo['id']}.m4a", None) for memo in changed))
+    saves = []
+    monkeypatch.setattr(data_import, "save_manifest", lambda manifest, storage: saves.append(len(manifest)))
+
+    assert len(import_voice_memos_incrementally("token", memory_storage)) == 150
+    assert saves == [64, 128, 150]
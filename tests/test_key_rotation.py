@@ -0,0 +1,66 @@
+import json
+
+import pytest
+from cryptography.fernet import Fernet
+
+from app import key_rotation as key_rotation_module
+from app.key_rotation import KeyRotation
+
+class RotatingStorage:
+    """
+    Stand-in for StorageManager that records the re-encrypted records, stopping the rotation
+    after `stop_after` of them.
+    """
+
+    ENCRYPTED_DATA_TYPES = {"transcription", "metadata"}
+
+    def __init__(self, names, stop_after=None):
+        self.names = names
+        self.stop_after = stop_after
+        self.rotation = None
+        self.rewritten = []
+
+    def list_data(self, data_type):
+        return sorted(self.names)
+
+    def reencrypt(self, file_name, data_type):
+        self.rewritten.append((data_type, file_name))
+        if self.stop_after is not None and len(self.rewritten) >= self.stop_after:
+            self.rotation._stop.set()
+        return True
+
+@pytest.fixture(autouse=True)
+def encryption_key(monkeypatch):
+    monkeypatch.setattr(key_rotation_module.crypto, "encryption_key", Fernet.generate_key())
+
+def test_a_stopped_rotation_resumes_after_its_cursor(tmp_path, monkeypatch):
+    monkeypatch.setattr(key_rotation_module, "ROTATION_BATCH_SIZE", 10)
+    monkeypatch.setattr(KeyRotation, "_stores", lambda self: [])
+    state_path = str(tmp_path / "rotation.json")
+    names = [f"memo-{i:03d}" for i in range(75)]
+
+    storage = RotatingStorage(names, stop_after=25)
+    storage.rotation = KeyRotation(storage, state_path=state_path)
+    assert storage.rotation.run()['finished'] is False
+    with open(state_path) as file:
+        state = json.load(file)
+    assert state['cursor'] == ["metadata", "memo-029"] and state['finished'] is False
+
+    resumed = RotatingStorage(names)
+    rotation = KeyRotation(resumed, state_path=state_path)
+    assert rotation.run() == {**rotation.result, 'rewritten': 120, 'finished': True}
+    assert resumed.rewritten[0] == ("metadata", "memo-030")
+    assert sorted(storage.rewritten[:30] + resumed.rewritten) == sorted(
+        (data_type, name) for data_type in RotatingStorage.ENCRYPTED_DATA_TYPES for name in names)
+    assert rotation.progress() == {'done': 150, 'total': 150}
+
+def test_a_rotation_resumes_from_a_legacy_done_list(tmp_path, monkeypatch):
+    monkeypatch.setattr(KeyRotation, "_stores", lambda self: [])
+    state_path = tmp_path / "rotation.json"
+    storage = RotatingStorage(["a", "b"])
+    rotation = KeyRotation(storage, state_path=str(state_path))
+    state_path.write_text(json.dumps({'key': rotation._fingerprint, 'done': ["metadata/a", "transcription/b"],
+                                      'finished': False}))
+
+    assert rotation.run()['rewritten'] == 2
+    assert storage.rewritten == [("metadata", "b"), ("transcription", "a")]
@@ -0,0 +1,35 @@
+import wave
+
+import numpy as np
+
+from app import metadata_extraction
+from app.metadata_extraction import anonymize_metadata, extract_metadata
+from app.vad import detect_speech_segments
+from benchmarks.fakes import FakeSpeakerEmbedder
+
+def write_wav(path, sample_rate=16000):
+    rng = np.random.default_rng(0)
+    silence = rng.normal(0, 0.001, sample_rate * 2)
+    speech = np.sin(np.arange(sample_rate * 2) * 2 * np.pi * 220 / sample_rate) * 0.5
+    audio = np.concatenate([silence, speech, silence, speech, silence])
+    with wave.open(str(path), 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes((audio * 32767).astype(np.int16).tobytes())
+
+def test_speech_segments_found_while_embedding_are_reused(tmp_path, monkeypatch):
+    path = str(tmp_path / "memo.wav")
+    write_wav(path)
+    speech_segments = {}
+    FakeSpeakerEmbedder(real_time_factor=0, vad=True).embed_files([path], speech_segments)
+    assert speech_segments[path] == detect_speech_segments(path)
+    assert len(speech_segments[path]) == 2
+
+    monkeypatch.setattr(metadata_extraction, "VAD_ENABLED", True)
+    monkeypatch.setattr(metadata_extraction, "detect_speech_segments", lambda path: 1 / 0)
+    assert extract_metadata(path, speech_segments=speech_segments[path])['speech_segments'] == speech_segments[path]
+
+def test_anonymized_metadata_keeps_the_speaker_ids():
+    metadata = anonymize_metadata({'location': "Home", 'speakers': ["spk_1a2b", "spk_3c4d"]})
+    assert metadata == {'location': "Anonymized", 'speakers': ["spk_1a2b", "spk_3c4d"]}
@@ -0,0 +1,46 @@
+import pytest
+
+from app import redaction
+from app.redaction import Redactor
+
+ORDINARY_SENTENCES = [
+    "I need 2 more days to drive",
+    "10 minutes down the road",
+    "3 options in place",
+    "5 people waiting in the square",
+    "we should be done in 2 weeks, one way or another",
+    "Take 3 copies to court on Monday",
+]
+
+@pytest.fixture
+def redactor():
+    return Redactor(terms={}, salt="test", workers=1)
+
+@pytest.mark.parametrize("sentence", ORDINARY_SENTENCES)
+def test_ordinary_sentences_pass_through(redactor, sentence):
+    assert redactor.redact(sentence) == sentence
+
+@pytest.mark.parametrize("address", ["12 Baker Street", "221 Baker St.", "1600 Pennsylvania Avenue", "42 Elm Road"])
+def test_street_addresses_are_redacted(redactor, address):
+    assert redactor.redact(f"Meet me at {address} tomorrow").startswith("Meet me at [ADDRESS_")
+
+def test_same_entity_gets_the_same_token():
+    redactor = Redactor(terms=["Ann Lee"], salt="test", workers=1)
+    redacted = redactor.redact("Ann Lee called. Later ann  lee called from (555) 010-2000, then 555.010.2000.")
+    tokens = [word.strip(".,") for word in redacted.split() if word.startswith("[")]
+    assert tokens[0] == tokens[1] and tokens[0].startswith("[NAME_")
+    assert tokens[2] == tokens[3] and tokens[2].startswith("[PHONE_")
+
+def test_stream_matches_whole_text():
+    redactor = Redactor(terms=["Ann Lee"], salt="test", workers=1)
+    text = " ".join(["call Ann Lee at 555-010-2000 about 12 Baker Street, then ann@example.com"] * 200)
+    chunks = [text[i:i + 37] for i in range(0, len(text), 37)]
+    assert "".join(redactor.redact_stream(chunks)) == redactor.redact(text)
+
+def test_bulk_batches_count_the_characters_scanned():
+    redaction._init_worker({}, "test")
+    text = "call 555-010-2000 or ann@example.com"
+    results, counts, characters = redaction._redact_batch([text, "nothing here"])
+    # Counted on the input: tokens make the output longer than the text scanned
+    assert characters == len(text) + len("nothing here") < sum(len(result) for result in results)
+    assert counts == {'PHONE': 1, 'EMAIL': 1}
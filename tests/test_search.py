@@ -0,0 +1,41 @@
+import os
+
+from cryptography.fernet import Fernet
+
+from app.search import MERGE_FACTOR, SearchIndex
+
+def test_segments_merge_by_size_tier(tmp_path, monkeypatch):
+    index = SearchIndex(str(tmp_path), encryption_key=Fernet.generate_key())
+    merged = []
+    merge_segments = index._merge_segments
+    monkeypatch.setattr(index, "_merge_segments", lambda names: (
+        merged.append(sum(len(index._segment_documents[name]) for name in names)), merge_segments(names)))
+
+    memo_count = MERGE_FACTOR ** 2 + 3
+    for number in range(memo_count):
+        # One commit per memo, as in watch mode
+        index.add_documents([(f"memo{number}", f"note {number} about the budget")])
+
+    # Each memo is rewritten once per tier rather than every few commits
+    assert sum(merged) == 2 * MERGE_FACTOR ** 2
+    assert len(index._segment_names) == 4
+    assert index.search("note 60", k=3)[0]['memo_id'] == "memo60"
+
+def test_merges_drop_deleted_documents_and_their_tombstones(tmp_path):
+    key = Fernet.generate_key()
+    index = SearchIndex(str(tmp_path), encryption_key=key)
+    for number in range(MERGE_FACTOR - 1):
+        index.add_documents([(f"memo{number}", f"draft {number}")])
+    index.remove_document("memo1")
+    assert index._deleted == {1}
+    # The eighth segment fills the tier and triggers a merge
+    index.add_documents([("memo0", "final version")])
+    assert index._deleted == set()
+    assert len(index._documents) == MERGE_FACTOR - 2
+
+    reopened = SearchIndex(str(tmp_path), encryption_key=key)
+    assert reopened.search("final", k=5)[0]['memo_id'] == "memo0"
+    assert reopened.search("draft", k=10) and all(result['memo_id'] not in ("memo0", "memo1")
+                                                  for result in reopened.search("draft", k=10))
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".documents")) == [
+        name + ".documents" for name in reopened._segment_names]
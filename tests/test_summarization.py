@@ -0,0 +1,56 @@
+import random
+
+from app import redaction
+from app.cache import PipelineCache
+from app.summarization import estimate_tokens, split_transcript, summarize_all_transcriptions
+from app.transcription import save_transcription
+
+def make_transcript(sentences, seed=0):
+    rng = random.Random(seed)
+    words = "we talked about the budget and the launch plan then agreed to follow up next week".split()
+    return " ".join(" ".join(rng.choice(words) for _ in range(rng.randint(5, 30))).capitalize() + "."
+                    for _ in range(sentences))
+
+def test_chunks_respect_the_budget_and_keep_the_text():
+    transcript = make_transcript(400)
+    chunks = split_transcript(transcript, max_tokens=300)
+    assert len(chunks) > 5
+    assert all(estimate_tokens(chunk) <= 300 for chunk in chunks)
+    assert " ".join(chunks) == transcript
+
+def test_an_early_edit_keeps_the_later_chunks():
+    transcript = make_transcript(400)
+    sentences = transcript.split(". ")
+    edited = ". ".join(sentences[:3] + ["An inserted sentence about something else entirely"] + sentences[3:])
+    original_chunks = split_transcript(transcript, max_tokens=300)
+    edited_chunks = split_transcript(edited, max_tokens=300)
+    # Only the chunks up to the next shared boundary differ
+    assert len(set(original_chunks) - set(edited_chunks)) <= 2
+    assert original_chunks[-5:] == edited_chunks[-5:]
+
+class EchoSummarizer:
+    def __init__(self):
+        self.calls = 0
+
+    def run(self, transcriptions):
+        self.calls += 1
+        return [f"summary of {transcription}" for transcription in transcriptions], {}
+
+def test_a_memo_transcribed_again_is_summarized_again(memory_storage):
+    cache, summarizer = PipelineCache(storage_manager=memory_storage), EchoSummarizer()
+    save_transcription("first take", "memo", memory_storage)
+    assert summarize_all_transcriptions(["/audio/memo.m4a"], cache, memory_storage, summarizer) == {
+        "/audio/memo.m4a": "summary of first take"}
+    summarize_all_transcriptions(["/audio/memo.m4a"], cache, memory_storage, summarizer)
+    assert summarizer.calls == 1
+
+    # Same audio, new transcript, e.g. after a change of the VAD settings
+    save_transcription("second take", "memo", memory_storage)
+    assert summarize_all_transcriptions(["/audio/memo.m4a"], cache, memory_storage, summarizer) == {
+        "/audio/memo.m4a": "summary of second take"}
+
+def test_transcripts_are_redacted_before_they_are_summarized(memory_storage, monkeypatch):
+    monkeypatch.setattr(redaction, "REDACTION_ENABLED", True)
+    save_transcription("call me on 555-010-2000", "memo", memory_storage)
+    summary = summarize_all_transcriptions(["/audio/memo.m4a"], None, memory_storage, EchoSummarizer())["/audio/memo.m4a"]
+    assert summary.startswith("summary of call me on [PHONE_") and "010-2000" not in summary
@@ -0,0 +1,16 @@
+from app import transcription
+from app.transcription import load_transcription, save_transcription
+
+def test_transcriptions_are_saved_encrypted_and_legacy_plaintext_is_migrated(memory_storage, tmp_path, monkeypatch):
+    monkeypatch.setattr(transcription, "STORAGE_PATH", str(tmp_path))
+    save_transcription("hello there", "memo", memory_storage)
+    assert memory_storage.records[("transcription", "memo")] == "hello there"
+    assert load_transcription("memo", memory_storage) == "hello there"
+    assert load_transcription("missing", memory_storage) is None
+
+    legacy = tmp_path / "transcriptions" / "old.txt"
+    legacy.parent.mkdir()
+    legacy.write_text("from before")
+    assert load_transcription("old", memory_storage) == "from before"
+    assert memory_storage.records[("transcription", "old")] == "from before"
+    assert not legacy.exists()
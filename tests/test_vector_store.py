@@ -0,0 +1,19 @@
+import numpy as np
+from cryptography.fernet import Fernet
+
+from app.vector_store import HashingEmbedder, VectorStore
+
+def test_feature_hashes_are_keyed_per_store(tmp_path):
+    key, embedder = Fernet.generate_key(), HashingEmbedder(dimension=64)
+    store = VectorStore(str(tmp_path / "a"), embedder=embedder, encryption_key=key)
+    store.add_memo("memo", "the budget meeting with the design team")
+
+    # Hashing a dictionary without the store's key does not reproduce the stored vectors
+    unkeyed = embedder(["the budget meeting with the design team"])
+    assert not np.allclose(store.embedder(["the budget meeting with the design team"]), unkeyed)
+    assert store.embedder.name == "hashing-64-keyed"
+    other = VectorStore(str(tmp_path / "b"), embedder=embedder, encryption_key=key)
+    assert not np.allclose(store.embedder(["budget"]), other.embedder(["budget"]))
+
+    reopened = VectorStore(str(tmp_path / "a"), embedder=embedder, encryption_key=key)
+    assert reopened.search("budget meeting", k=1)[0]['memo_id'] == "memo"
@@ -0,0 +1,41 @@
+import pytest
+
+from app import watcher as watcher_module
+from app.watcher import MemoWatcher
+
+class RecordingPipeline:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, path):
+        self.submitted.append(path)
+
+def test_a_dropped_memo_never_overwrites_one_already_taken(tmp_path):
+    drop, audio = tmp_path / "drop", tmp_path / "audio"
+    drop.mkdir()
+    audio.mkdir()
+    (audio / "memo.m4a").write_bytes(b"first")
+    pipeline = RecordingPipeline()
+    watcher = MemoWatcher(pipeline, interval=0, watch_directory=str(drop), audio_dir=str(audio))
+
+    for content in (b"second", b"third"):
+        (drop / "memo.m4a").write_bytes(content)
+        watcher._take(str(drop / "memo.m4a"))
+
+    assert pipeline.submitted == [str(audio / "memo-1.m4a"), str(audio / "memo-2.m4a")]
+    assert [(audio / name).read_bytes() for name in ("memo.m4a", "memo-1.m4a", "memo-2.m4a")] == [
+        b"first", b"second", b"third"]
+    assert not (drop / "memo.m4a").exists()
+
+def test_a_failed_move_leaves_no_placeholder(tmp_path, monkeypatch):
+    audio = tmp_path / "audio"
+    audio.mkdir()
+    watcher = MemoWatcher(RecordingPipeline(), interval=0, audio_dir=str(audio))
+
+    def fail(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(watcher_module.shutil, "move", fail)
+    with pytest.raises(OSError):
+        watcher._take(str(tmp_path / "memo.m4a"))
+    assert list(audio.iterdir()) == []